@@ -0,0 +1,91 @@
+import asyncio
+import itertools
+from collections import Counter
+from typing import Any, Awaitable, Callable
+
+
+class MicroBatcher:
+    """
+    Groups calls arriving within a short window into one batched call.
+
+    Callers await submit(*args). Jobs are collected for up to `window`
+    seconds, or until `max_batch` are waiting, then sent together with
+    send_batch({job_id: args}), which returns {job_id: result}. Each caller
+    gets its own result back. Jobs the batch did not answer (missing from the
+    result, or the whole batch failed) fall back to send_one(*args), so a bad
+    batch costs latency but never correctness. A batch of one goes straight
+    to send_one.
+    """
+
+    def __init__(self, send_one: Callable[..., Awaitable[Any]],
+                 send_batch: Callable[[dict[str, tuple]], Awaitable[dict[str, Any]]],
+                 window: float = 0.03, max_batch: int = 8):
+        self.send_one = send_one
+        self.send_batch = send_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.counts = Counter()
+        self._pending: list[tuple[str, tuple, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle = None
+        self._tasks: set[asyncio.Task] = set()
+        self._ids = itertools.count(1)
+
+    async def submit(self, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((f"job{next(self._ids)}", args, future))
+        self.counts["jobs"] += 1
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def stats(self) -> dict:
+        batches = self.counts["batches"]
+        return {
+            "jobs": self.counts["jobs"],
+            "batches": batches,
+            "batched_jobs": self.counts["batched_jobs"],
+            "single_calls": self.counts["single_calls"],
+            "fallbacks": self.counts["fallbacks"],
+            "mean_batch_size": self.counts["batched_jobs"] / batches if batches else None,
+        }
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)  # Keep a reference until it finishes
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: list[tuple[str, tuple, asyncio.Future]]) -> None:
+        results = {}
+        live = [job for job in batch if not job[2].done()]  # Skip callers that gave up
+        if len(live) > 1:
+            self.counts["batches"] += 1
+            self.counts["batched_jobs"] += len(live)
+            try:
+                results = await self.send_batch({job_id: args for job_id, args, _ in live})
+            except Exception as e:
+                print(f"Batched call failed, falling back to single calls: {e}")
+        await asyncio.gather(*(self._resolve(job_id, args, future, results, len(live) > 1)
+                               for job_id, args, future in live))
+
+    async def _resolve(self, job_id: str, args: tuple, future: asyncio.Future, results: dict, batched: bool) -> None:
+        if job_id in results:
+            if not future.done():
+                future.set_result(results[job_id])
+            return
+        self.counts["fallbacks" if batched else "single_calls"] += 1
+        try:
+            result = await self.send_one(*args)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
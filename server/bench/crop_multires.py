@@ -0,0 +1,108 @@
+"""Accuracy/speed comparison for coarse-to-fine document detection.
+
+For each synthetic photo, finds the page quad with the full resolution
+pipeline (locate_document at the working size) and with the proxy pipeline
+at each --proxy size. Reports the time taken and the corner error, in
+working-size pixels, against both the full resolution quad and the known
+ground-truth corners of the synthetic receipt.
+
+    python -m bench.crop_multires --proxy 360 480 --refine
+"""
+import argparse
+import json
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+import crop
+from bench.synth import make_receipt_photo
+
+
+def corner_error(quad_a: np.ndarray, quad_b: np.ndarray) -> float:
+    """Largest distance between matching corners of two quads."""
+    a = np.array(crop.order_points(quad_a.reshape(4, 2).tolist()), dtype=np.float64)
+    b = np.array(crop.order_points(quad_b.reshape(4, 2).tolist()), dtype=np.float64)
+    return float(np.linalg.norm(a - b, axis=1).max())
+
+
+def working_image(photo: np.ndarray, dim_limit: int = 1440) -> tuple[np.ndarray, float]:
+    """Resizes a photo the same way detect_document does, returning the image and scale."""
+    max_dim = max(photo.shape[:2])
+    if max_dim > dim_limit:
+        scale = dim_limit / max_dim
+        return cv2.resize(photo, None, fx=scale, fy=scale), scale
+    return photo, 1.0
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--proxy", type=int, nargs="+", default=[360, 480])
+    parser.add_argument("--refine", action="store_true", help="Also measure corner refinement")
+    parser.add_argument("--size", type=int, default=1440, help="Synthetic photo size")
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    modes = [(proxy, False) for proxy in args.proxy]
+    if args.refine:
+        modes += [(proxy, True) for proxy in args.proxy]
+
+    full_times, full_truth_errors = [], []
+    per_mode = {mode: {"times": [], "errors": [], "truth_errors": [], "misses": 0} for mode in modes}
+    for seed in range(args.samples):
+        photo, corners = make_receipt_photo(args.size, seed=seed)
+        image, scale = working_image(photo)
+        truth = corners * scale + 128  # Quads are in tiled-border coordinates
+        reference, elapsed = timed(crop.locate_document, image)
+        full_times.append(elapsed)
+        if reference is None:
+            print(f"seed {seed}: full resolution pipeline found no quad, skipped")
+            continue
+        full_truth_errors.append(corner_error(reference, truth))
+        for proxy, refine in modes:
+            quad, elapsed = timed(crop.locate_document_multires, image, proxy, refine)
+            stats = per_mode[(proxy, refine)]
+            stats["times"].append(elapsed)
+            if quad is None:
+                stats["misses"] += 1
+            else:
+                stats["errors"].append(corner_error(reference, quad))
+                stats["truth_errors"].append(corner_error(truth, quad))
+
+    full_ms = statistics.mean(full_times) * 1000
+    full_truth = statistics.mean(full_truth_errors) if full_truth_errors else None
+    print(f"{'full':<16} {full_ms:8.1f} ms        vs truth {full_truth if full_truth is None else round(full_truth, 1)} px")
+    results = [{"mode": "full", "mean_ms": full_ms, "mean_truth_error_px": full_truth}]
+    for (proxy, refine), stats in per_mode.items():
+        if not stats["times"]:
+            continue
+        row = {
+            "mode": f"proxy{proxy}" + ("+refine" if refine else ""),
+            "mean_ms": statistics.mean(stats["times"]) * 1000,
+            "mean_corner_error_px": statistics.mean(stats["errors"]) if stats["errors"] else None,
+            "max_corner_error_px": max(stats["errors"]) if stats["errors"] else None,
+            "mean_truth_error_px": statistics.mean(stats["truth_errors"]) if stats["truth_errors"] else None,
+            "misses": stats["misses"],
+        }
+        results.append(row)
+        error = "n/a" if row["max_corner_error_px"] is None else \
+            f"vs full mean {row['mean_corner_error_px']:6.1f} / max {row['max_corner_error_px']:6.1f} px, " \
+            f"vs truth {row['mean_truth_error_px']:6.1f} px"
+        print(f"{row['mode']:<16} {row['mean_ms']:8.1f} ms  x{full_ms / row['mean_ms']:.1f}  "
+              f"{error}  misses {row['misses']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "crop_multires", "size": args.size, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
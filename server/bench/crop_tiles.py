@@ -0,0 +1,113 @@
+"""Microbenchmark for the tile helpers in crop.py.
+
+Compares the vectorized create_tiled_border / process_image_tiles with the
+original per-tile Python loops (kept below as references), checks that the
+outputs are bit-identical and prints the speedup.
+
+    python -m bench.crop_tiles --sizes 720 1440 --repeat 5
+"""
+import argparse
+import json
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+
+import crop
+from bench.synth import make_receipt_photo
+
+
+def reference_create_tiled_border(image: np.ndarray, tile_size: int = 128, border_width: int = 128) -> np.ndarray:
+    """The loop based create_tiled_border this benchmark compares against."""
+    height, width = image.shape[:2]
+    num_channels = 1 if len(image.shape) == 2 else image.shape[2]
+    samples = []
+    for x in range(0, width - tile_size + 1, tile_size):
+        samples.append(image[0:tile_size, x:x + tile_size])
+        samples.append(image[height - tile_size:height, x:x + tile_size])
+    for y in range(tile_size, height - tile_size + 1, tile_size):
+        samples.append(image[y:y + tile_size, 0:tile_size])
+        samples.append(image[y:y + tile_size, width - tile_size:width])
+    average_colors = [tuple(np.mean(sample, axis=(0, 1)).astype(int)) for sample in samples]
+    color_counts = Counter(average_colors)
+    tile = None
+    for avg_color, count in color_counts.most_common():
+        if not crop.is_grayscale(avg_color):
+            tile = samples[average_colors.index(avg_color)]
+            break
+    if tile is None:
+        tile = np.full((tile_size, tile_size, num_channels), (128, 128, 128), dtype=np.uint8)
+    blurred_tile = cv2.GaussianBlur(tile, (15, 15), 0)
+    new_height = height + 2 * border_width
+    new_width = width + 2 * border_width
+    framed_image = np.full((new_height, new_width, num_channels), (128, 128, 128), dtype=np.uint8)
+    for x in range(0, new_width, tile_size):
+        framed_image[0:border_width, x:min(x + tile_size, new_width)] = blurred_tile[0:border_width, 0:min(tile_size, new_width - x)]
+        framed_image[new_height - border_width:new_height, x:min(x + tile_size, new_width)] = blurred_tile[0:border_width, 0:min(tile_size, new_width - x)]
+    for y in range(border_width, new_height - border_width, tile_size):
+        framed_image[y:min(y + tile_size, new_height - border_width), 0:border_width] = blurred_tile[0:min(tile_size, new_height - border_width - y), 0:border_width]
+        framed_image[y:min(y + tile_size, new_height - border_width), new_width - border_width:new_width] = blurred_tile[0:min(tile_size, new_height - border_width - y), 0:border_width]
+    framed_image[border_width:border_width + height, border_width:border_width + width] = image
+    return framed_image
+
+
+def reference_process_image_tiles(image: np.ndarray, tile_size: int = 16) -> np.ndarray:
+    """The loop based process_image_tiles this benchmark compares against."""
+    height, width = image.shape[:2]
+    mask = np.zeros_like(image)
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = image[y:min(y + tile_size, height), x:min(x + tile_size, width)]
+            avg_color = np.mean(tile, axis=(0, 1))
+            if (np.sum(avg_color > 100) >= 2) and (np.max(avg_color) - np.min(avg_color) <= 24):
+                mask[y:min(y + tile_size, height), x:min(x + tile_size, width)] = [255, 255, 255]
+    return np.where(mask == [255, 255, 255], image, 0)
+
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[720, 1440])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        # Mimic what detect_document feeds these functions: a closed photo, then its bordered version.
+        photo = make_receipt_photo(size, seed=size)[0]
+        closed = cv2.morphologyEx(photo, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8), iterations=4)
+        bordered = crop.create_tiled_border(closed)
+
+        assert np.array_equal(bordered, reference_create_tiled_border(closed)), "create_tiled_border differs"
+        assert np.array_equal(crop.process_image_tiles(bordered), reference_process_image_tiles(bordered)), \
+            "process_image_tiles differs"
+
+        for name, new, old, arg in [
+            ("create_tiled_border", crop.create_tiled_border, reference_create_tiled_border, closed),
+            ("process_image_tiles", crop.process_image_tiles, reference_process_image_tiles, bordered),
+        ]:
+            new_time = best_of(lambda: new(arg), args.repeat)
+            old_time = best_of(lambda: old(arg), args.repeat)
+            row = {"function": name, "size": size, "loop_ms": old_time * 1000,
+                   "vectorized_ms": new_time * 1000, "speedup": old_time / new_time}
+            results.append(row)
+            print(f"{name:<22} {size:>5}px  loop {row['loop_ms']:8.2f} ms  "
+                  f"vectorized {row['vectorized_ms']:8.2f} ms  x{row['speedup']:.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "crop_tiles", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
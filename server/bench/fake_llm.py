@@ -0,0 +1,170 @@
+"""A local OpenAI-compatible chat completions server for benchmarks.
+
+Vision requests (any message with an image part) and text requests for a
+receipt_extraction get a canned receipt extraction, other text requests get
+a canned list compare answer. Every response
+is delayed by a configurable latency so the server behaves like a slow
+remote model without costing anything. Requests with "stream": true get the
+answer as server-sent event chunks spread evenly over that latency.
+
+To exercise the retry, hedging and circuit breaker logic, a share of the
+requests can fail with 429 (with Retry-After) or 5xx, and a share can be
+slowed down by a factor.
+
+Run standalone with:
+    python -m bench.fake_llm --port 8100 --latency 1.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+
+RECEIPT = {
+    "receipts": [{
+        "Store": "FRESH MART #123",
+        "Address": "1 Main St",
+        "Date": "2025-03-01",
+        "numItems": 3,
+        "totalCost": 10.47,
+        "items": [
+            {"category": "Dairy", "name": "GV WHL MILK", "friendly_name": "Whole Milk", "quantity": 1,
+             "price": 3.49, "unit_price": "3.49", "unit": "ea", "upc": "Not Found"},
+            {"category": "Produce", "name": "BANANAS", "friendly_name": "Bananas", "quantity": 1,
+             "price": 1.99, "unit_price": "0.59", "unit": "/LB", "upc": "Not Found"},
+            {"category": "Bakery", "name": "WHT BREAD", "friendly_name": "White Bread", "quantity": 1,
+             "price": 4.99, "unit_price": "4.99", "unit": "ea", "upc": "Not Found"},
+        ],
+    }]
+}
+
+LIST_COMPARE = {
+    "items_for_removal": ["milk", "bread"],
+    "matched_items": [
+        {"name_on_list": "milk", "name_on_receipt": "GV WHL MILK"},
+        {"name_on_list": "bread", "name_on_receipt": "WHT BREAD"},
+    ],
+}
+
+
+def is_vision_request(payload: dict) -> bool:
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def text_answer(payload: dict) -> dict:
+    """RECEIPT for a text-only receipt extraction, else LIST_COMPARE, or one LIST_COMPARE per job ID for a
+    batched (list_compare_batch) request."""
+    schema = payload.get("response_format", {}).get("json_schema", {})
+    if schema.get("name") == "receipt_extraction":
+        return RECEIPT
+    if schema.get("name") == "list_compare_batch":
+        return {job_id: LIST_COMPARE for job_id in schema.get("schema", {}).get("required", [])}
+    return LIST_COMPARE
+
+
+def completion(content: str, model: str) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+    }
+
+
+async def completion_chunks(content: str, model: str, latency: float, chunk_size: int = 24):
+    """Yields content as chat.completion.chunk server-sent events, spread over latency seconds."""
+    pieces = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+    for piece in pieces:
+        await asyncio.sleep(latency / len(pieces))
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": model, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def create_app(latency: float = 0.5, vision_latency: float = None, error_rate: float = 0.0,
+               errors: tuple[int, ...] = (429, 500, 503), retry_after: float = 1.0, slow_rate: float = 0.0,
+               slow_factor: float = 5.0, seed: int = 0) -> FastAPI:
+    """
+    Creates the fake server. vision_latency defaults to latency.
+
+    A share error_rate of the requests answers with a random status from
+    errors (429s carry Retry-After: retry_after), and a share slow_rate takes
+    slow_factor times longer. app.state.down = True fails every request with 503.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    app.state.down = False
+    app.state.errors = 0
+    app.state.calls = {"vision": 0, "text": 0}
+    app.state.connections = set()  # Client (host, port) pairs seen, i.e. TCP connections opened
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        if request.client is not None:
+            app.state.connections.add((request.client.host, request.client.port))
+        payload = await request.json()
+        model = payload.get("model", "fake")
+        if app.state.down or rng.random() < error_rate:
+            app.state.errors += 1
+            status = 503 if app.state.down else rng.choice(errors)
+            headers = {"Retry-After": str(retry_after)} if status == 429 else None
+            return JSONResponse({"error": {"message": "injected failure", "code": status}}, status_code=status,
+                                headers=headers)
+        if is_vision_request(payload):
+            app.state.calls["vision"] += 1
+            content, delay = json.dumps(RECEIPT), latency if vision_latency is None else vision_latency
+        else:
+            app.state.calls["text"] += 1
+            content, delay = json.dumps(text_answer(payload)), latency
+        if rng.random() < slow_rate:
+            delay *= slow_factor
+        if payload.get("stream"):
+            return StreamingResponse(completion_chunks(content, model, delay), media_type="text/event-stream")
+        await asyncio.sleep(delay)
+        return completion(content, model)
+
+    return app
+
+
+class ServerThread:
+    """Runs a uvicorn server on a background thread, for use inside benchmarks."""
+
+    def __init__(self, app, port: int, host: str = "127.0.0.1"):
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible LLM server")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to wait before answering")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 429/5xx")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of requests answered slowly")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, error_rate=args.error_rate, slow_rate=args.slow_rate),
+                host="127.0.0.1", port=args.port)
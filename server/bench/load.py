@@ -0,0 +1,92 @@
+"""Load benchmark for /process-images/.
+
+Starts the fake LLM server and the app on local ports, then fires batches of
+concurrent uploads and reports latency percentiles per concurrency level.
+With a non-blocking pipeline the p95 should stay close to the single request
+latency until the crop pool saturates.
+
+    python -m bench.load --concurrency 1 2 4 8 16 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import httpx
+
+from bench.fake_llm import ServerThread, create_app
+from bench.synth import encode_jpeg, make_receipt_photo
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def fire(url: str, images: list[bytes], concurrency: int, rounds: int) -> list[float]:
+    """Sends `rounds` waves of `concurrency` simultaneous uploads and returns the latencies."""
+    latencies = []
+    counter = iter(range(10 ** 9))
+    async with httpx.AsyncClient(timeout=300) as client:
+        async def one():
+            image = images[next(counter) % len(images)]
+            start = time.perf_counter()
+            response = await client.post(url, files={"files": ("receipt.jpg", image, "image/jpeg")},
+                                         data={"reference_list": "milk,eggs,bread"})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+        for _ in range(rounds):
+            await asyncio.gather(*(one() for _ in range(concurrency)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake LLM latency per call (s)")
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--llm-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8101)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    # Distinct photos, and no OCR cache, so every upload runs the full pipeline.
+    images = [encode_jpeg(make_receipt_photo(args.image_size, seed=seed)[0]) for seed in range(8)]
+    os.environ["API_URL"] = f"http://127.0.0.1:{args.llm_port}/v1/chat/completions"
+    os.environ.setdefault("OCR_CACHE", "off")
+    import main as app_module  # Reads API_URL at import time
+
+    results = []
+    fake_llm = create_app(args.latency)
+    with ServerThread(fake_llm, args.llm_port), \
+            ServerThread(app_module.app, args.app_port) as app_server:
+        url = f"{app_server.url}/process-images/"
+        asyncio.run(fire(url, images, 1, 1))  # Warm up the crop pool
+        print(f"{'conc':>5} {'p50':>8} {'p95':>8} {'max':>8}")
+        for concurrency in args.concurrency:
+            latencies = asyncio.run(fire(url, images, concurrency, args.rounds))
+            row = {
+                "concurrency": concurrency,
+                "p50": statistics.median(latencies),
+                "p95": percentile(latencies, 95),
+                "max": max(latencies),
+            }
+            results.append(row)
+            print(f"{concurrency:>5} {row['p50']:>8.3f} {row['p95']:>8.3f} {row['max']:>8.3f}")
+
+    calls = sum(fake_llm.state.calls.values())
+    print(f"LLM calls: {calls} ({fake_llm.state.calls['vision']} vision, {fake_llm.state.calls['text']} text), "
+          f"TCP connections opened: {len(fake_llm.state.connections)}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "load", "llm_latency": args.latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Benchmark suite: crop stages, throughput per core, memory and end to end.
+
+Runs over a synthetic corpus (bench.synth.make_corpus) and writes one JSON
+document, so two runs can be compared across commits:
+
+    python -m bench.suite --json before.json
+    git checkout other-branch
+    python -m bench.suite --json after.json
+    python -m bench.suite --compare before.json after.json
+
+Sections:
+    crop        per-stage timings of detect_document, both forced through
+                GrabCut and with the default fast path cascade
+    memory      peak Python/NumPy allocation per crop (tracemalloc) and the
+                process max RSS
+    throughput  crops per second with 1..N pool workers, and per worker
+    handoff     pickled vs shared memory transfer to the crop pool, for
+                encoded uploads and decoded frames: the cost of the
+                transfer alone (an echo job) and crops per second per
+                pool size
+    e2e         /process-images/ latency against the fake LLM server
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+
+from bench.synth import make_corpus
+from crop import detect_document_bytes
+from crop_pool import SharedMemoryCropPool, call, detect_frame, init_worker, opencv_threads_per_worker
+
+
+def summarize(values: list[float]) -> dict:
+    ordered = sorted(values)
+    return {
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))],
+        "n": len(ordered),
+    }
+
+
+def bench_crop(corpus: list[dict], fast_threshold) -> dict:
+    """Times detect_document_bytes over the corpus; returns per-stage and total summaries (seconds)."""
+    stages = defaultdict(list)
+    totals = []
+    outcomes = defaultdict(int)
+    for entry in corpus:
+        start = time.perf_counter()
+        _, info = detect_document_bytes(entry["jpeg"], fast_threshold=fast_threshold)
+        totals.append(time.perf_counter() - start)
+        outcomes[info.get("stage", "failed")] += 1
+        for stage, seconds in info.get("timings", {}).items():
+            stages[stage].append(seconds)
+    return {
+        "total": summarize(totals),
+        "stages": {stage: summarize(values) for stage, values in stages.items()},
+        "outcomes": dict(outcomes),
+    }
+
+
+def bench_memory(corpus: list[dict]) -> dict:
+    """Peak traced allocation per crop, by image size. OpenCV's own buffers are not traced, see max_rss_mb."""
+    peaks = defaultdict(list)
+    for entry in corpus:
+        tracemalloc.start()
+        detect_document_bytes(entry["jpeg"], fast_threshold=None)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks[entry["size"]].append(peak / 2 ** 20)
+    return {
+        "peak_traced_mb": {str(size): max(values) for size, values in peaks.items()},
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_throughput(corpus: list[dict], workers: list[int], fast_threshold) -> list[dict]:
+    """Crops the corpus on process pools of each size and reports images per second."""
+    jobs = [entry["jpeg"] for entry in corpus]
+    results = []
+    for count in workers:
+        with ProcessPoolExecutor(count) as pool:
+            list(pool.map(detect_document_bytes, jobs[:count]))  # Warm up the workers
+            start = time.perf_counter()
+            list(pool.map(partial(detect_document_bytes, fast_threshold=fast_threshold), jobs))
+            elapsed = time.perf_counter() - start
+        rate = len(jobs) / elapsed
+        results.append({"workers": count, "images_per_s": rate, "per_worker": rate / count})
+        print(f"  {count} worker(s): {rate:.2f} img/s, {rate / count:.2f} per worker")
+    return results
+
+
+def echo(data, **kwargs):
+    """A crop function that returns its input, to time the transfer alone."""
+    return data, {}
+
+
+async def run_on_shm_pool(pool: SharedMemoryCropPool, func, jobs: list) -> list:
+    return await asyncio.gather(*(pool.run(func, job) for job in jobs))
+
+
+def bench_handoff(corpus: list[dict], workers: list[int], frame_size: tuple[int, int], rounds: int) -> dict:
+    """
+    Compares pickled and shared memory handoff to the crop pool.
+
+    Payloads are the corpus uploads (encoded JPEG, what the server sends)
+    and decoded frames resized to frame_size (width, height).
+    """
+    payloads = {
+        "upload": ([entry["jpeg"] for entry in corpus], partial(detect_document_bytes, fast_threshold=0.6)),
+        "frame": ([cv2.resize(entry["photo"], frame_size) for entry in corpus], partial(detect_frame, fast_threshold=0.6)),
+    }
+    largest = max(max(len(job) if isinstance(job, bytes) else job.nbytes for job in jobs) for jobs, _ in payloads.values())
+    results = {"frame_size": list(frame_size), "echo": [], "crop": []}
+
+    def run(transfer: str, count: int, func, jobs: list) -> float:
+        """Seconds to run every job `rounds` times on a fresh pool (after a warm up)."""
+        if transfer == "pickle":
+            with ProcessPoolExecutor(count, initializer=init_worker,
+                                     initargs=(opencv_threads_per_worker(count),)) as pool:
+                list(pool.map(call, [func] * count, jobs[:count], [{}] * count))
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    list(pool.map(call, [func] * len(jobs), jobs, [{}] * len(jobs)))
+                return time.perf_counter() - start
+
+        async def timed():
+            pool = SharedMemoryCropPool(count, slot_bytes=largest)
+            try:
+                await run_on_shm_pool(pool, func, jobs[:count])
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    await run_on_shm_pool(pool, func, jobs)
+                return time.perf_counter() - start
+            finally:
+                pool.shutdown()
+        return asyncio.run(timed())
+
+    for payload, (jobs, crop) in payloads.items():
+        for transfer in ("pickle", "shm"):
+            elapsed = run(transfer, 1, echo, jobs)
+            per_job = elapsed / (rounds * len(jobs))
+            results["echo"].append({"payload": payload, "transfer": transfer, "seconds_per_job": per_job})
+            print(f"  echo {payload:<6} {transfer:<6} {per_job * 1000:.2f} ms/job")
+        for count in workers:
+            for transfer in ("pickle", "shm"):
+                rate = rounds * len(jobs) / run(transfer, count, crop, jobs)
+                results["crop"].append({"payload": payload, "transfer": transfer, "workers": count,
+                                        "images_per_s": rate, "per_worker": rate / count})
+                print(f"  crop {payload:<6} {transfer:<6} {count} worker(s): {rate:.2f} img/s, "
+                      f"{rate / count:.2f} per worker")
+    return results
+
+
+def bench_e2e(corpus: list[dict], latency: float, concurrency: list[int], rounds: int,
+              llm_port: int, app_port: int) -> dict:
+    """Drives /process-images/ against the fake LLM; OCR cache off so every upload runs the pipeline."""
+    from bench.fake_llm import ServerThread, create_app
+    from bench.load import fire, percentile
+
+    os.environ["API_URL"] = f"http://127.0.0.1:{llm_port}/v1/chat/completions"
+    os.environ["OCR_CACHE"] = "off"
+    import main as app_module  # Reads its settings at import time
+
+    images = [entry["jpeg"] for entry in corpus]
+    fake_llm = create_app(latency)
+    levels = []
+    with ServerThread(fake_llm, llm_port), ServerThread(app_module.app, app_port) as app_server:
+        url = f"{app_server.url}/process-images/"
+        asyncio.run(fire(url, images, 1, 1))
+        for level in concurrency:
+            latencies = asyncio.run(fire(url, images, level, rounds))
+            levels.append({"concurrency": level, "p50": statistics.median(latencies),
+                           "p95": percentile(latencies, 95), "max": max(latencies)})
+            print(f"  concurrency {level}: p50 {levels[-1]['p50']:.3f}s p95 {levels[-1]['p95']:.3f}s")
+    return {"llm_latency": latency, "levels": levels, "llm_calls": dict(fake_llm.state.calls)}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "opencv": cv2.__version__, "numpy": np.__version__, "cpus": os.cpu_count()}
+
+
+def compare(before_path: str, after_path: str, threshold: float = 0.10) -> None:
+    """Prints mean stage timings of two runs side by side, flagging slowdowns above threshold."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['environment'].get('commit')} -> {after['environment'].get('commit')}")
+
+    def rows():
+        for mode in ("grabcut", "cascade"):
+            old, new = before.get("crop", {}).get(mode, {}), after.get("crop", {}).get(mode, {})
+            if "total" in old and "total" in new:
+                yield f"{mode}.total", old["total"]["mean"], new["total"]["mean"]
+            for stage in sorted(set(old.get("stages", {})) & set(new.get("stages", {}))):
+                yield f"{mode}.{stage}", old["stages"][stage]["mean"], new["stages"][stage]["mean"]
+        old_levels = {level["concurrency"]: level for level in before.get("e2e", {}).get("levels", [])}
+        for level in after.get("e2e", {}).get("levels", []):
+            if level["concurrency"] in old_levels:
+                yield f"e2e.c{level['concurrency']}.p50", old_levels[level["concurrency"]]["p50"], level["p50"]
+        old_echo = {(row["payload"], row["transfer"]): row for row in before.get("handoff", {}).get("echo", [])}
+        for row in after.get("handoff", {}).get("echo", []):
+            if (row["payload"], row["transfer"]) in old_echo:
+                yield (f"handoff.{row['payload']}.{row['transfer']}", old_echo[row["payload"], row["transfer"]]["seconds_per_job"],
+                       row["seconds_per_job"])
+
+    print(f"{'metric':<28} {'before':>10} {'after':>10} {'change':>8}")
+    for name, old, new in rows():
+        change = (new - old) / old if old else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{name:<28} {old * 1000:>9.2f}ms {new * 1000:>9.2f}ms {change:>+7.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[800, 1440])
+    parser.add_argument("--lines", type=int, nargs="+", default=[15, 35])
+    parser.add_argument("--backgrounds", type=int, default=3, help="How many of the corpus backgrounds to use")
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="Pool sizes (default 1..cpu count)")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["crop", "memory", "throughput", "handoff", "e2e"])
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake LLM latency per call (s)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--frame-size", type=int, nargs=2, default=[4000, 3000], metavar=("WIDTH", "HEIGHT"),
+                        help="Decoded frame size for the handoff section")
+    parser.add_argument("--llm-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8101)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    from bench.synth import BACKGROUNDS
+    corpus = make_corpus(tuple(args.sizes), tuple(args.lines), BACKGROUNDS[:args.backgrounds])
+    print(f"Corpus: {len(corpus)} images ({', '.join(map(str, args.sizes))} px)")
+    results = {"environment": environment(), "corpus": [entry["name"] for entry in corpus]}
+
+    if "crop" not in args.skip:
+        print("Crop stages")
+        results["crop"] = {"grabcut": bench_crop(corpus, None), "cascade": bench_crop(corpus, 0.6)}
+        for mode, summary in results["crop"].items():
+            stages = ", ".join(f"{stage} {values['mean'] * 1000:.1f}" for stage, values in summary["stages"].items())
+            print(f"  {mode}: {summary['total']['mean'] * 1000:.1f} ms/image ({stages} ms) {summary['outcomes']}")
+    if "memory" not in args.skip:
+        results["memory"] = bench_memory(corpus)
+        print(f"Memory: {results['memory']}")
+    if "throughput" not in args.skip:
+        print("Throughput (cascade)")
+        workers = args.workers or list(range(1, (os.cpu_count() or 1) + 1))
+        results["throughput"] = bench_throughput(corpus, workers, 0.6)
+    if "handoff" not in args.skip:
+        print("Handoff to the crop pool")
+        workers = args.workers or list(range(1, (os.cpu_count() or 1) + 1))
+        results["handoff"] = bench_handoff(corpus, workers, tuple(args.frame_size), args.rounds)
+    if "e2e" not in args.skip:
+        print("End to end")
+        results["e2e"] = bench_e2e(corpus, args.latency, args.concurrency, args.rounds, args.llm_port, args.app_port)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Synthetic receipt photos for the benchmarks.
+
+Renders a receipt (white paper with printed lines) onto a coloured, noisy
+background and warps it with a random perspective, so the crop pipeline has
+something realistic to find without shipping real receipts.
+"""
+import cv2
+import numpy as np
+
+ITEM_NAMES = ["GV WHL MILK", "BNLS CHKN BRST", "BANANAS", "EGGS LG 12CT", "WHT BREAD",
+              "CHDR CHS SHRD", "RED ONIONS", "GRND BEEF 80/20", "OJ NO PULP", "BUTTER SLTD",
+              "SPAGHETTI", "TOMATO SAUCE", "GALA APPLES", "YOGURT GRK", "COFFEE GRND"]
+
+
+def render_receipt(num_lines: int = 20, width: int = 360, rng: np.random.Generator = None) -> np.ndarray:
+    """Renders a flat receipt image with a header, item lines and a total."""
+    rng = rng if rng is not None else np.random.default_rng(0)
+    line_height = 28
+    height = (num_lines + 6) * line_height
+    receipt = np.full((height, width, 3), 245, dtype=np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    cv2.putText(receipt, "FRESH MART #123", (20, line_height), font, 0.7, (20, 20, 20), 2)
+    total = 0.0
+    for i in range(num_lines):
+        name = ITEM_NAMES[int(rng.integers(len(ITEM_NAMES)))]
+        price = float(rng.integers(99, 1999)) / 100
+        total += price
+        y = (i + 3) * line_height
+        cv2.putText(receipt, name, (15, y), font, 0.5, (30, 30, 30), 1)
+        cv2.putText(receipt, f"{price:.2f}", (width - 80, y), font, 0.5, (30, 30, 30), 1)
+    cv2.putText(receipt, f"TOTAL {total:.2f}", (15, (num_lines + 4) * line_height), font, 0.6, (20, 20, 20), 2)
+    return receipt
+
+
+def make_receipt_photo(size: int = 1024, num_lines: int = 20, seed: int = 0,
+                       background: tuple[int, int, int] = None) -> tuple[np.ndarray, np.ndarray]:
+    """Warps a rendered receipt onto a coloured background.
+
+    Returns:
+        The photo (BGR) and the four receipt corners in photo coordinates,
+        ordered top-left, top-right, bottom-right, bottom-left.
+    """
+    rng = np.random.default_rng(seed)
+    receipt = render_receipt(num_lines, rng=rng)
+    rh, rw = receipt.shape[:2]
+
+    if background is None:
+        background = tuple(int(c) for c in rng.integers(30, 200, size=3))
+    photo = np.empty((size, size, 3), dtype=np.uint8)
+    photo[:] = background
+    noise = rng.normal(0, 8, size=photo.shape)
+    photo = np.clip(photo.astype(np.float64) + noise, 0, 255).astype(np.uint8)
+
+    # Place the receipt so it covers a good part of the frame, with some jitter per corner.
+    scale = 0.8 * size / max(rh, rw)
+    cw, ch = rw * scale, rh * scale
+    x0, y0 = (size - cw) / 2, (size - ch) / 2
+    jitter = 0.04 * size
+    dst = np.float32([[x0, y0], [x0 + cw, y0], [x0 + cw, y0 + ch], [x0, y0 + ch]])
+    dst += rng.uniform(-jitter, jitter, size=dst.shape).astype(np.float32)
+    src = np.float32([[0, 0], [rw - 1, 0], [rw - 1, rh - 1], [0, rh - 1]])
+    matrix = cv2.getPerspectiveTransform(src, dst)
+    warped = cv2.warpPerspective(receipt, matrix, (size, size))
+    paper = cv2.warpPerspective(np.full((rh, rw), 255, dtype=np.uint8), matrix, (size, size))
+    photo[paper > 0] = warped[paper > 0]
+    return photo, dst
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 90) -> bytes:
+    """Encodes an image as JPEG bytes."""
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+# Backgrounds for the corpus: dark wood, light table, blue cloth, green mat, grey counter.
+BACKGROUNDS = [(40, 60, 90), (190, 200, 205), (150, 90, 40), (60, 120, 60), (120, 120, 120)]
+
+
+def make_corpus(sizes: tuple[int, ...] = (800, 1440), line_counts: tuple[int, ...] = (15, 35),
+                backgrounds: list[tuple[int, int, int]] = None, seed: int = 0) -> list[dict]:
+    """Builds a corpus of receipt photos covering every size, receipt length and background.
+
+    Returns:
+        One dict per photo with "name", "size", "lines", "background",
+        "photo" (BGR), "corners" and "jpeg" (the encoded upload).
+    """
+    corpus = []
+    backgrounds = backgrounds if backgrounds is not None else BACKGROUNDS
+    for size in sizes:
+        for lines in line_counts:
+            for index, background in enumerate(backgrounds):
+                photo, corners = make_receipt_photo(size, lines, seed=seed + len(corpus), background=background)
+                corpus.append({"name": f"{size}px-{lines}l-bg{index}", "size": size, "lines": lines,
+                               "background": background, "photo": photo, "corners": corners,
+                               "jpeg": encode_jpeg(photo)})
+    return corpus
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LRUCache:
+    """In-process cache with least-recently-used eviction and a per-entry TTL.
+
+    Thread safe, so it can be shared between the event loop and worker threads.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: Optional[float] = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached value, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key: str) -> Optional[Any]:
+        """Like get, but without touching the counters or the LRU order."""
+        with self._lock:
+            entry = self._live_entry(key)
+            return None if entry is None else entry[1]
+
+    def _live_entry(self, key: str) -> Optional[tuple[float, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            return None
+        return entry
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class SQLiteCache:
+    """On-disk cache of JSON values in a SQLite file, with TTL and size-bounded eviction.
+
+    Survives restarts and can be shared by several server processes. Calls
+    block on disk I/O, so async code runs them in a thread.
+
+    Eviction is least recently used. A hit only writes the new access time
+    back when the stored one is older than `touch_interval` seconds, so a
+    busy key does not cost a write per hit.
+    """
+
+    def __init__(self, path: str = "ocr_cache.sqlite3", max_entries: int = 10000, ttl: Optional[float] = 86400,
+                 touch_interval: float = 300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[2] >= self.touch_interval:
+                self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+def make_cache(backend: str, max_entries: int, ttl: Optional[float], path: str = None):
+    """Creates a cache from a backend name: "memory", "sqlite" or "off" (returns None)."""
+    if backend == "off":
+        return None
+    if backend == "memory":
+        return LRUCache(max_entries=max_entries, ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteCache(path=path or "ocr_cache.sqlite3", max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"Unknown cache backend '{backend}', expected 'memory', 'sqlite' or 'off'")
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases and collapses whitespace, so trivially different inputs share a key."""
+    return " ".join(str(text).lower().split())
+
+
+def parse_reference_list(reference_list: str) -> list[str]:
+    """Splits the comma-separated reference list into entries, dropping blanks and duplicates."""
+    entries = []
+    seen = set()
+    for entry in reference_list.split(","):
+        entry = entry.strip()
+        if entry and normalize_text(entry) not in seen:
+            seen.add(normalize_text(entry))
+            entries.append(entry)
+    return entries
+
+
+class ListCompareMemo:
+    """Memoizes list compare answers per receipt and per reference list entry.
+
+    Decisions are stored per normalized entry rather than per whole list.
+    When a user edits the list and resends the same receipt, only the new or
+    changed entries have to be evaluated again.
+    """
+
+    def __init__(self, max_receipts: int = 512, ttl: Optional[float] = 3600):
+        self._store = LRUCache(max_entries=max_receipts, ttl=ttl)
+        self.entries_reused = 0
+        self.entries_evaluated = 0
+
+    @staticmethod
+    def receipt_key(purchase_data_str: str) -> str:
+        return hashlib.sha256(normalize_text(purchase_data_str).encode("utf-8")).hexdigest()
+
+    def lookup(self, purchase_data_str: str, entries: list[str]) -> tuple[dict, list[str]]:
+        """Splits entries into known decisions (keyed by normalized entry) and entries still to evaluate."""
+        decisions = self._store.get(self.receipt_key(purchase_data_str)) or {}
+        known = {}
+        missing = []
+        for entry in entries:
+            decision = decisions.get(normalize_text(entry))
+            if decision is None:
+                missing.append(entry)
+            else:
+                known[normalize_text(entry)] = decision
+        self.entries_reused += len(known)
+        self.entries_evaluated += len(missing)
+        return known, missing
+
+    @staticmethod
+    def decisions_from_result(entries: list[str], result: dict, drop_unknown: bool = False) -> Optional[dict]:
+        """Splits a list compare result for entries into decisions keyed by normalized entry.
+
+        Returns None if the answer names items that do not map back to one of
+        the entries. Such an answer cannot be split per entry safely. With
+        `drop_unknown` those items are left out instead.
+        """
+        by_entry = {normalize_text(entry): {"remove": False, "matches": []} for entry in entries}
+        for item in result.get('items_for_removal', []):
+            decision = by_entry.get(normalize_text(item))
+            if decision is None:
+                if drop_unknown:
+                    continue
+                return None
+            decision["remove"] = True
+        for match in result.get('matched_items', []):
+            name_on_list = match.get('name_on_list') if isinstance(match, dict) else None
+            decision = by_entry.get(normalize_text(name_on_list)) if name_on_list else None
+            if decision is not None:
+                decision["matches"].append(match)
+        return by_entry
+
+    def remember(self, purchase_data_str: str, decisions: dict) -> None:
+        """Adds decisions (from decisions_from_result) to the memo for this receipt."""
+        key = self.receipt_key(purchase_data_str)
+        merged = dict(self._store.peek(key) or {})
+        merged.update(decisions)
+        self._store.set(key, merged)
+
+    @staticmethod
+    def assemble(entries: list[str], decisions: dict) -> dict:
+        """Builds a list compare result for entries from per-entry decisions."""
+        result = {'items_for_removal': [], 'matched_items': []}
+        for entry in entries:
+            decision = decisions[normalize_text(entry)]
+            if decision["remove"]:
+                result['items_for_removal'].append(entry)
+                result['matched_items'].extend(decision["matches"])
+        return result
+
+    def stats(self) -> dict:
+        stats = self._store.stats()
+        stats.update({"entries_reused": self.entries_reused, "entries_evaluated": self.entries_evaluated})
+        return stats
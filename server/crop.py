@@ -3,7 +3,11 @@ import numpy as np
 from collections import Counter
 import uuid
 import os
-from typing import Optional
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from strips import split_into_strips
 
 def add_black_frame(image: np.ndarray, frame_width: int = 120) -> np.ndarray:
     """Adds a black frame of specified width around an image."""
@@ -36,102 +40,132 @@ def create_tiled_border(image: np.ndarray, tile_size: int = 128, border_width: i
     """Creates a tiled border using the most common non-grayscale color."""
     height, width = image.shape[:2]
     num_channels = 1 if len(image.shape) == 2 else image.shape[2]
-    #print(f"Image dimensions: {height}x{width}, Channels: {num_channels}") # Debug
-
-    # 1. Sample squares around the border
-    #print("1. Sampling squares around the border...") # Debug
-    samples = []
-    for x in range(0, width - tile_size + 1, tile_size):
-        samples.append(image[0:tile_size, x:x + tile_size])
-        samples.append(image[height - tile_size:height, x:x + tile_size])
-    for y in range(tile_size, height - tile_size + 1, tile_size):
-        samples.append(image[y:y + tile_size, 0:tile_size])
-        samples.append(image[y:y + tile_size, width - tile_size:width])
-    #print(f" Sampled {len(samples)} tiles.") # Debug
+
+    # 1. Sample squares around the border. The tiles along each edge are read
+    # as one strip and reduced with a reshape instead of one slice per tile.
+    samples = border_samples(image, tile_size)
 
     # 2. Calculate average colors and find the most common non-grayscale
-    #print("2. Finding most common non-grayscale color...") # Debug
-    average_colors = [tuple(np.mean(sample, axis=(0, 1)).astype(int)) for sample in samples]
+    average_colors = [tuple(color) for color in border_sample_means(image, tile_size).astype(int)]
     color_counts = Counter(average_colors)
 
     tile = None
     for avg_color, count in color_counts.most_common():
-        #print(f" Checking color: {avg_color}, Count: {count}") # Debug
         if not is_grayscale(avg_color):
-            # Find a sample that matches that average color.
-            try:
-                most_common_index = average_colors.index(avg_color)
-                tile = samples[most_common_index]
-                #print(f" Found non-grayscale tile at index {most_common_index}") # Debug
-                break
-            except ValueError:
-                print("Error: Color somehow not in list") # Keep this error message
-                continue
+            # Take the first sample that has that average color.
+            tile = samples(average_colors.index(avg_color))
+            break
 
     # 3. Default to a gray tile if no non-grayscale color is found
     if tile is None:
-        #print(" No suitable non-grayscale tile found. Defaulting to gray.") # Debug
         gray_color = (128, 128, 128)  # Default gray
         if num_channels == 1:
             tile = np.full((tile_size, tile_size), gray_color[0], dtype=np.uint8)
         else:
             tile = np.full((tile_size, tile_size, num_channels), gray_color, dtype=np.uint8)
 
-
     # 4. Blur the tile
-    #print("4. Blurring the tile...") # Debug
     blurred_tile = cv2.GaussianBlur(tile, (15, 15), 0)
-    #print(" Tile blurred.") # Debug
 
-    # 5. Create the new image (filled with neutral gray)
-    #print("5. Creating the new image...") # Debug
+    # 5. Create the new image
     new_height = height + 2 * border_width
     new_width = width + 2 * border_width
+    # (Every pixel is written below, so the buffer needs no fill.)
     if num_channels == 1:
-        framed_image = np.full((new_height, new_width), 128, dtype=np.uint8)  # grayscale
+        framed_image = np.empty((new_height, new_width), dtype=np.uint8)  # grayscale
     else:
-        framed_image = np.full((new_height, new_width, num_channels), (128,128,128), dtype=np.uint8)
-    #print(f" New image dimensions: {new_height}x{new_width}") # Debug
+        framed_image = np.empty((new_height, new_width, num_channels), dtype=np.uint8)
 
-    # 6. Tile the border
-    #print("6. Tiling the border...") # Debug
-    for x in range(0, new_width, tile_size):
-        framed_image[0:border_width, x:min(x + tile_size, new_width)] = blurred_tile[0:border_width, 0:min(tile_size, new_width - x)]
-        framed_image[new_height - border_width:new_height, x:min(x + tile_size, new_width)] = blurred_tile[0:border_width, 0:min(tile_size, new_width - x)]
+    # 6. Tile the border: repeat the tile along each strip with np.tile and
+    # cut it to length, which matches pasting it tile by tile.
+    reps = (1, -(-new_width // tile_size)) + (1,) * (blurred_tile.ndim - 2)
+    horizontal = np.tile(blurred_tile[0:border_width], reps)[:, :new_width]
+    framed_image[0:border_width] = horizontal
+    framed_image[new_height - border_width:new_height] = horizontal
 
     # Left and Right borders
-    for y in range(border_width, new_height - border_width, tile_size):
-        framed_image[y:min(y + tile_size, new_height-border_width), 0:border_width] = blurred_tile[0:min(tile_size, new_height-border_width-y), 0:border_width]
-        framed_image[y:min(y + tile_size, new_height-border_width), new_width - border_width:new_width] = blurred_tile[0:min(tile_size, new_height-border_width-y), 0:border_width]
-    #print(" Border tiled.") # Debug
+    inner_height = new_height - 2 * border_width
+    reps = (-(-inner_height // tile_size), 1) + (1,) * (blurred_tile.ndim - 2)
+    vertical = np.tile(blurred_tile[:, 0:border_width], reps)[:inner_height]
+    framed_image[border_width:new_height - border_width, 0:border_width] = vertical
+    framed_image[border_width:new_height - border_width, new_width - border_width:new_width] = vertical
 
     # 7. Copy the original image
-    #print("7. Copying the original image into the center...") # Debug
     framed_image[border_width:border_width + height, border_width:border_width + width] = image
-    #print(" Image copied.") # Debug
 
     return framed_image
 
+def border_samples(image: np.ndarray, tile_size: int):
+    """Returns a lookup from sample index to the tile that create_tiled_border samples.
+
+    Samples alternate top/bottom along the width, then left/right down the
+    height (skipping the corners), in the same order as border_sample_means.
+    """
+    height, width = image.shape[:2]
+    num_columns = len(range(0, width - tile_size + 1, tile_size))
+
+    def sample(index: int) -> np.ndarray:
+        if index < 2 * num_columns:
+            x = (index // 2) * tile_size
+            y = 0 if index % 2 == 0 else height - tile_size
+            return image[y:y + tile_size, x:x + tile_size]
+        index -= 2 * num_columns
+        y = tile_size + (index // 2) * tile_size
+        x = 0 if index % 2 == 0 else width - tile_size
+        return image[y:y + tile_size, x:x + tile_size]
+
+    return sample
+
+def border_sample_means(image: np.ndarray, tile_size: int) -> np.ndarray:
+    """Mean color of every border sample tile, as an (n, channels) float array."""
+    height, width = image.shape[:2]
+    pixels = image.reshape(height, width, -1)
+    channels = pixels.shape[2]
+    num_columns = len(range(0, width - tile_size + 1, tile_size))
+    num_rows = len(range(tile_size, height - tile_size + 1, tile_size))
+    area = tile_size * tile_size
+
+    def strip_means(strip: np.ndarray, count: int, axis: int) -> np.ndarray:
+        # Integer sums are exact, so dividing once gives the same value as np.mean per tile.
+        if axis == 1:
+            blocks = strip[:, :count * tile_size].reshape(tile_size, count, tile_size, channels)
+            sums = blocks.sum(axis=(0, 2), dtype=np.uint32)
+        else:
+            blocks = strip[:count * tile_size].reshape(count, tile_size, tile_size, channels)
+            sums = blocks.sum(axis=(1, 2), dtype=np.uint32)
+        return sums / area
+
+    top = strip_means(pixels[0:tile_size], num_columns, axis=1)
+    bottom = strip_means(pixels[height - tile_size:height], num_columns, axis=1)
+    left = strip_means(pixels[tile_size:, 0:tile_size], num_rows, axis=0)
+    right = strip_means(pixels[tile_size:, width - tile_size:width], num_rows, axis=0)
+    return np.concatenate([
+        np.stack([top, bottom], axis=1).reshape(-1, channels),
+        np.stack([left, right], axis=1).reshape(-1, channels),
+    ])
+
 def process_image_tiles(image: np.ndarray, tile_size: int = 16) -> np.ndarray:
     """Processes an image in tiles, blacking out tiles that don't meet criteria."""
     height, width = image.shape[:2]
-    mask = np.zeros_like(image)
-
-    for y in range(0, height, tile_size):
-        for x in range(0, width, tile_size):
-            tile = image[y:min(y + tile_size, height), x:min(x + tile_size, width)]
-            avg_color = np.mean(tile, axis=(0, 1))
-
-            # Check the color criteria
-            criteria_met = (
-                (np.sum(avg_color > 100) >= 2) and  # At least two values > 100
-                (np.max(avg_color) - np.min(avg_color) <= 24)  # All within 24 of each other
-            )
 
-            if criteria_met:
-                mask[y:min(y + tile_size, height), x:min(x + tile_size, width)] = [255, 255, 255]  # white
-
-    processed_image = np.where(mask == [255, 255, 255], image, 0)
+    # Per-tile channel sums in one pass; reduceat also covers the partial
+    # tiles on the right and bottom edges.
+    row_starts = np.arange(0, height, tile_size)
+    col_starts = np.arange(0, width, tile_size)
+    sums = np.add.reduceat(image, row_starts, axis=0, dtype=np.uint32)
+    sums = np.add.reduceat(sums, col_starts, axis=1)
+    tile_heights = np.diff(np.append(row_starts, height))
+    tile_widths = np.diff(np.append(col_starts, width))
+    avg_colors = sums / (tile_heights[:, None] * tile_widths[None, :])[:, :, None]
+
+    # Check the color criteria
+    criteria_met = (
+        (np.sum(avg_colors > 100, axis=2) >= 2) &  # At least two values > 100
+        (np.max(avg_colors, axis=2) - np.min(avg_colors, axis=2) <= 24)  # All within 24 of each other
+    )
+
+    keep = np.repeat(np.repeat(criteria_met, tile_size, axis=0)[:height], tile_size, axis=1)[:, :width]
+    processed_image = image * keep[:, :, np.newaxis].astype(image.dtype)
     return processed_image
 
 def order_points(points: list[list[int]]) -> list[list[int]]:
@@ -215,8 +249,203 @@ def perspective_transform(image: np.ndarray, corners: list[list[int]]) -> tuple[
     warped_image = cv2.warpPerspective(image, transform_matrix, (max_width, max_height))
     return warped_image, max_width, max_height
 
-def detect_document(image: np.ndarray, min_dim_threshold: int = 500, dim_limit: int = 1440) -> np.ndarray:
-    """Detects and extracts a document from an image."""
+@contextmanager
+def stage_timer(timings: Optional[dict], name: str):
+    """Adds the duration of the block (seconds) to timings[name], if timings is given."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+def locate_document(image: np.ndarray, timings: Optional[dict] = None) -> Optional[np.ndarray]:
+    """Finds the document outline in an image with the closing / GrabCut pipeline.
+
+    If timings is given, the duration of each sub-stage is added to it.
+
+    Returns:
+        The largest quadrilateral as a (4, 1, 2) contour in the coordinates of
+        the tiled-border image (i.e. offset by the 128 px border), or None.
+    """
+    # Repeated Closing operation to remove text.
+    with stage_timer(timings, "closing"):
+        kernel = np.ones((5, 5), np.uint8)
+        closed_image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel, iterations=4)
+    
+    #create tiled border
+    with stage_timer(timings, "tiled_border"):
+        bordered_image = create_tiled_border(closed_image)
+
+    # Process the image to remove noise
+    with stage_timer(timings, "tile_filter"):
+        processed_image = process_image_tiles(bordered_image)
+
+    # GrabCut for foreground extraction
+    with stage_timer(timings, "grabcut"):
+        mask = np.zeros(processed_image.shape[:2], np.uint8)
+        bgd_model = np.zeros((1, 65), np.float64)
+        fgd_model = np.zeros((1, 65), np.float64)
+        rect = (20, 20, processed_image.shape[1] - 20, processed_image.shape[0] - 20)
+        cv2.grabCut(processed_image, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
+        mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
+        grabcut_image = processed_image * mask2[:, :, np.newaxis]
+
+    # Edge Detection
+    with stage_timer(timings, "contours"):
+        gray = cv2.cvtColor(grabcut_image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (11, 11), 0)
+        canny = cv2.Canny(gray, 100, 200)
+        canny = cv2.dilate(canny, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+
+        # Finding contours
+        contours, _ = cv2.findContours(canny, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        page = sorted(contours, key=cv2.contourArea, reverse=True)[:5] # Keep top 5 largest
+
+    # Find the largest quadrilateral
+    with stage_timer(timings, "quad_fit"):
+        return find_largest_quadrilateral(page)
+
+def lift_quadrilateral(quadrilateral: np.ndarray, scale: float, border_width: int = 128) -> np.ndarray:
+    """Maps a quadrilateral found on a downscaled proxy back to the larger image.
+
+    Both quads are in tiled-border coordinates, so the border offset is removed
+    before scaling and added back afterwards.
+    """
+    points = (quadrilateral.astype(np.float64) - border_width) * scale + border_width
+    return np.rint(points).astype(np.int32)
+
+def refine_quadrilateral(image: np.ndarray, quadrilateral: np.ndarray, search_radius: int,
+                         border_width: int = 128) -> np.ndarray:
+    """Refines lifted corners against the edges of the working resolution image.
+
+    Each side of the quad is re-fitted to the Canny edge pixels within
+    search_radius of it, and the corners become the intersections of the
+    fitted sides. Sides without enough edge support keep their lifted
+    position, and corners that would move further than 2 * search_radius are
+    left alone.
+    """
+    # Same closing as locate_document, so printed text does not produce edges.
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8), iterations=4)
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    corners = np.array(order_points((quadrilateral.reshape(4, 2) - border_width).tolist()), dtype=np.float64)
+
+    lines = []
+    for i in range(4):
+        start, end = corners[i], corners[(i + 1) % 4]
+        band = np.zeros_like(edges)
+        cv2.line(band, tuple(int(v) for v in start), tuple(int(v) for v in end), 255, 2 * search_radius + 1)
+        ys, xs = np.nonzero(edges & band)
+        if len(xs) < 0.25 * np.linalg.norm(end - start):
+            lines.append((start, end - start))  # Not enough support, keep the lifted side
+            continue
+        vx, vy, x0, y0 = cv2.fitLine(np.column_stack((xs, ys)).astype(np.float32), cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+        lines.append((np.array([x0, y0], dtype=np.float64), np.array([vx, vy], dtype=np.float64)))
+
+    refined = corners.copy()
+    for i in range(4):
+        (p, r), (q, s) = lines[i - 1], lines[i]  # Corner i joins the previous side and side i
+        denominator = r[0] * s[1] - r[1] * s[0]
+        if abs(denominator) < 1e-9:
+            continue
+        t = ((q[0] - p[0]) * s[1] - (q[1] - p[1]) * s[0]) / denominator
+        point = p + t * r
+        if np.linalg.norm(point - corners[i]) <= 2 * search_radius:
+            refined[i] = point
+    return np.rint(refined + border_width).astype(np.int32).reshape(4, 1, 2)
+
+def locate_document_multires(image: np.ndarray, proxy_dim: Optional[int] = None, refine: bool = False,
+                             timings: Optional[dict] = None) -> Optional[np.ndarray]:
+    """Coarse-to-fine variant of locate_document.
+
+    With proxy_dim set, GrabCut and the contour search run on a copy scaled so
+    its longest side is proxy_dim, and the quad is lifted back to the input
+    resolution (optionally refined there). Smaller proxies are faster but
+    less accurate; without proxy_dim this is plain locate_document.
+    """
+    height, width = image.shape[:2]
+    max_dim = max(height, width)
+    if not proxy_dim or max_dim <= proxy_dim:
+        return locate_document(image, timings)
+
+    proxy_scale = proxy_dim / max_dim
+    proxy = cv2.resize(image, None, fx=proxy_scale, fy=proxy_scale, interpolation=cv2.INTER_AREA)
+    quad = locate_document(proxy, timings)
+    if quad is None:
+        return None
+
+    quad = lift_quadrilateral(quad, 1 / proxy_scale)
+    if refine:
+        with stage_timer(timings, "refine"):
+            quad = refine_quadrilateral(image, quad, search_radius=int(np.ceil(12 / proxy_scale)))
+    return quad
+
+def find_quadrilateral_fast(image: np.ndarray, border_width: int = 128) -> Optional[np.ndarray]:
+    """Cheap page finder: closing, Canny and contours on the grayscale image, no GrabCut.
+
+    Works when the receipt lies on a contrasting surface. The quad is returned
+    in tiled-border coordinates, like locate_document, so both can feed the
+    same warp.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8), iterations=4)
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    canny = cv2.Canny(gray, 50, 150)
+    canny = cv2.dilate(canny, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    contours, _ = cv2.findContours(canny, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    page = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+    quad = find_largest_quadrilateral(page)
+    if quad is None:
+        return None
+    return quad + border_width
+
+def quad_confidence(quadrilateral: np.ndarray, image_shape: tuple[int, int], border_width: int = 128,
+                    min_area_ratio: float = 0.10, max_area_ratio: float = 0.95) -> float:
+    """Scores how much a quad looks like a photographed page, from 0 to 1.
+
+    The score is zero for non-convex quads and for quads covering less than
+    min_area_ratio or more than max_area_ratio of the image. More than that
+    usually means the image frame was found, not the page. Otherwise the
+    score falls linearly as the worst interior angle moves away from
+    90 degrees, and reaches zero at 45 degrees off.
+    """
+    points = quadrilateral.reshape(4, 2).astype(np.float64) - border_width
+    if not cv2.isContourConvex(points.astype(np.float32).reshape(4, 1, 2)):
+        return 0.0
+
+    height, width = image_shape[:2]
+    area_ratio = cv2.contourArea(points.astype(np.float32)) / float(height * width)
+    if not min_area_ratio <= area_ratio <= max_area_ratio:
+        return 0.0
+
+    ordered = np.array(order_points(points.tolist()), dtype=np.float64)
+    worst = 0.0
+    for i in range(4):
+        a = ordered[i - 1] - ordered[i]
+        b = ordered[(i + 1) % 4] - ordered[i]
+        cosine = np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-9)
+        angle = np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+        worst = max(worst, abs(angle - 90.0))
+    return float(max(0.0, 1.0 - worst / 45.0))
+
+def detect_document(image: np.ndarray, min_dim_threshold: int = 500, dim_limit: int = 1440,
+                    proxy_dim: Optional[int] = None, refine: bool = False,
+                    fast_threshold: Optional[float] = 0.6, info: Optional[dict] = None) -> np.ndarray:
+    """Detects and extracts a document from an image.
+
+    Detection is a cascade: find_quadrilateral_fast runs first and its quad is
+    used when quad_confidence reaches fast_threshold (None disables the fast
+    path). Otherwise the GrabCut pipeline runs. proxy_dim and refine select
+    its coarse-to-fine mode, see locate_document_multires.
+
+    If info is given, info["stage"] records what produced the result: "fast",
+    "grabcut", "too_small" (returned as is), or "original" (no usable quad,
+    so the original image is returned). info["timings"] receives the
+    seconds spent in each sub-stage.
+    """
+    info = info if info is not None else {}
+    timings = info.setdefault("timings", {})
     
     # Resize image
     orig_image = image.copy()
@@ -230,89 +459,151 @@ def detect_document(image: np.ndarray, min_dim_threshold: int = 500, dim_limit:
         useless = True
       
     if useless:
+        info["stage"] = "too_small"
         return orig_image
       
     framed_image = add_black_frame(image.copy())
 
-    # Repeated Closing operation to remove text.
-    kernel = np.ones((5, 5), np.uint8)
-    closed_image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel, iterations=4)
-    
-    #create tiled border
-    bordered_image = create_tiled_border(closed_image)
-
-    # Process the image to remove noise
-    processed_image = process_image_tiles(bordered_image)
-
-    # GrabCut for foreground extraction
-    mask = np.zeros(processed_image.shape[:2], np.uint8)
-    bgd_model = np.zeros((1, 65), np.float64)
-    fgd_model = np.zeros((1, 65), np.float64)
-    rect = (20, 20, processed_image.shape[1] - 20, processed_image.shape[0] - 20)
-    cv2.grabCut(processed_image, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
-    mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
-    grabcut_image = processed_image * mask2[:, :, np.newaxis]
-
-    # Edge Detection
-    gray = cv2.cvtColor(grabcut_image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (11, 11), 0)
-    canny = cv2.Canny(gray, 100, 200)
-    canny = cv2.dilate(canny, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
-
-    # Finding contours
-    contours, _ = cv2.findContours(canny, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-    page = sorted(contours, key=cv2.contourArea, reverse=True)[:5] # Keep top 5 largest
-
-    # Find the largest quadrilateral
-    largest_quad = find_largest_quadrilateral(page)
+    largest_quad = None
+    if fast_threshold is not None:
+        with stage_timer(timings, "fast_detect"):
+            fast_quad = find_quadrilateral_fast(image)
+        if fast_quad is not None:
+            confidence = quad_confidence(fast_quad, image.shape[:2])
+            info["fast_confidence"] = confidence
+            if confidence >= fast_threshold:
+                largest_quad = fast_quad
+                info["stage"] = "fast"
+
+    if largest_quad is None:
+        largest_quad = locate_document_multires(image, proxy_dim, refine, timings)
+        info["stage"] = "grabcut"
     
     if largest_quad is not None:
         #enlarge and refine
         largest_quad = enlarge_quadrilateral(largest_quad, framed_image.shape[:2])
             
         # Perspective transform
-        final_image, width, height = perspective_transform(framed_image, largest_quad.reshape(4, 2))
+        with stage_timer(timings, "warp"):
+            final_image, width, height = perspective_transform(framed_image, largest_quad.reshape(4, 2))
 
         fullheight, fullwidth = framed_image.shape[:2]
         
         if height < 0.20 * fullheight or width < 0.20 * fullwidth:
+            info["stage"] = "original"
             return orig_image
         return final_image
     else:
+      info["stage"] = "original"
       return orig_image
         
-def process_and_save_image(input_path: str, output_dir: str = ".") -> Optional[str]:
-    """Processes the image, saves it with a UUID, and returns the output path.
+def perceptual_hash(image: np.ndarray) -> str:
+    """64-bit difference hash (dHash) of an image, as 16 hex digits.
+
+    Near-identical photos of the same receipt (re-encoded, slightly resized)
+    get the same hash.
+    """
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f"{int(np.packbits(bits).view('>u8')[0]):016x}"
+
+def encode_jpeg(image: np.ndarray, info: Optional[dict] = None) -> bytes:
+    """Encodes an image as a JPEG at OpenCV's default quality."""
+    ok, encoded = cv2.imencode(".jpg", image)
+    if not ok:
+        raise ValueError("Could not encode the cropped image")
+    if info is not None:
+        info["bytes"] = len(encoded)
+    return encoded.tobytes()
+
+def detect_document_bytes(data: bytes, proxy_dim: Optional[int] = None, refine: bool = False,
+                          fast_threshold: Optional[float] = 0.6,
+                          encoder: Optional[Callable[..., bytes]] = None,
+                          strip_aspect: Optional[float] = None) -> tuple[Optional[bytes], dict]:
+    """Decodes an encoded image, crops the document and returns it as JPEG bytes.
+
+    Everything happens in memory, so the upload buffer can be handed straight
+    from the request to the OCR call without touching the disk.
 
     Args:
-        input_path: Path to the input image.
-        output_dir: Directory to save the output image (defaults to current directory).
+        data: The encoded input image (JPEG, PNG, ...).
+        proxy_dim: Run detection on a proxy of this size, see detect_document.
+        refine: Refine proxy corners at working resolution.
+        fast_threshold: Confidence needed to accept the fast detector's quad.
+        encoder: Called as encoder(image, info=...) to encode the crop, e.g.
+            a partial of encode.encode_for_ocr. Its info lands under
+            "encode". Defaults to a plain JPEG at OpenCV's default quality.
+        strip_aspect: If the crop is taller than this many times its width,
+            it is also cut into overlapping bands (see strips.split_into_strips),
+            encoded separately under "strips" so they can be OCR'd in parallel.
 
     Returns:
-        The full path to the saved output image, or None if processing failed.
+        The cropped image as JPEG bytes (None if processing failed) and the
+        info dict filled by detect_document plus the perceptual_hash of the
+        crop under "phash". It is returned rather than passed in, so it also
+        comes back from a process pool.
     """
+    info = {"timings": {}}
+    timings = info["timings"]
     try:
-        image = cv2.imread(input_path, cv2.IMREAD_COLOR)
+        with stage_timer(timings, "decode"):
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
         if image is None:
-            raise FileNotFoundError(f"Could not load image at {input_path}")
+            raise ValueError("Could not decode image data")
 
-        final_image = detect_document(image)
+        final_image = detect_document(image, proxy_dim=proxy_dim, refine=refine,
+                                      fast_threshold=fast_threshold, info=info)
+        with stage_timer(timings, "phash"):
+            info["phash"] = perceptual_hash(final_image)
 
-        # Create output directory if it doesn't exist
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        if encoder is None:
+            encoder = encode_jpeg
 
-        # Generate a unique filename using UUID
-        output_filename = f"{uuid.uuid4()}.jpg"
-        output_path = os.path.join(output_dir, output_filename)
+        with stage_timer(timings, "encode"):
+            if strip_aspect:
+                strips = split_into_strips(final_image, strip_aspect)
+                if len(strips) > 1:
+                    info["strips"] = [encoder(strip, info={}) for strip in strips]
 
-        cv2.imwrite(output_path, final_image)
-        #print(f"Image processing complete. Output saved as {output_path}") # Debug - now removed
-        return output_path
-    except FileNotFoundError as e:
+            info["encode"] = {}
+            return encoder(final_image, info=info["encode"]), info
+    except ValueError as e:
         print(f"Error: {e}")
-        return None
+        return None, info
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+        return None, info
+
+def process_and_save_image(input_path: str, output_dir: str = ".") -> Optional[str]:
+    """Processes the image, saves it with a UUID, and returns the output path.
+
+    Args:
+        input_path: Path to the input image.
+        output_dir: Directory to save the output image (defaults to current directory).
+
+    Returns:
+        The full path to the saved output image, or None if processing failed.
+    """
+    try:
+        with open(input_path, "rb") as input_file:
+            data = input_file.read()
+    except OSError:
+        print(f"Error: Could not load image at {input_path}")
         return None
-    
+
+    final_bytes, _ = detect_document_bytes(data)
+    if final_bytes is None:
+        return None
+
+    # Create output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Generate a unique filename using UUID
+    output_filename = f"{uuid.uuid4()}.jpg"
+    output_path = os.path.join(output_dir, output_filename)
+
+    with open(output_path, "wb") as output_file:
+        output_file.write(final_bytes)
+    return output_path
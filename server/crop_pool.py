@@ -0,0 +1,186 @@
+"""Process crop pool that hands images to its workers through shared memory.
+
+A plain ProcessPoolExecutor pickles every argument and result through a
+pipe: the upload going in, the crop and its strips coming out (and whole
+decoded frames when those are passed). Here the pool owns a ring of
+preallocated slots in one shared memory block. A job takes a free slot,
+the input is copied into it, and only (slot offset, shape, dtype) metadata
+travels over the pipe. The worker reads the input in place, writes its
+result back into the same slot, and the caller copies it out and returns
+the slot to the ring. With all slots busy, callers wait for one, which
+bounds the memory in flight.
+
+Inputs or results larger than a slot fall back to pickling, so the pool
+never refuses a job.
+
+Each worker also limits OpenCV to its share of the cores, so N workers
+running OpenCV's own thread pool do not oversubscribe the machine.
+"""
+import asyncio
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Optional, Union
+
+import cv2
+import numpy as np
+
+from crop import detect_document
+
+# The block of the pool being created (inherited by forked workers) or attached to by the worker.
+_block: Optional[shared_memory.SharedMemory] = None
+
+Part = Union[bytes, np.ndarray]
+
+
+def opencv_threads_per_worker(workers: int) -> int:
+    """Cores per worker, so the pool's OpenCV threads add up to the machine."""
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def init_worker(threads: int, block_name: Optional[str] = None) -> None:
+    """Process pool initializer: caps OpenCV threads and attaches the shared block."""
+    global _block
+    cv2.setNumThreads(threads)
+    if block_name is not None and (_block is None or _block.name != block_name):
+        _block = shared_memory.SharedMemory(name=block_name)  # Spawned, not forked, worker
+
+
+def detect_frame(image: np.ndarray, **kwargs) -> tuple[Optional[np.ndarray], dict]:
+    """crop.detect_document returning (image, info) like detect_document_bytes, for decoded frames."""
+    info = {}
+    return detect_document(image, info=info, **kwargs), info
+
+
+def write_parts(buffer: memoryview, offset: int, capacity: int, parts: list[Part]) -> Optional[list[tuple]]:
+    """Writes byte strings and arrays one after the other into a slot.
+
+    Returns:
+        The metadata to read them back (see read_parts), or None if they do not fit.
+    """
+    sizes = [part.nbytes if isinstance(part, np.ndarray) else len(part) for part in parts]
+    if sum(sizes) > capacity:
+        return None
+    meta = []
+    position = offset
+    for part, size in zip(parts, sizes):
+        if isinstance(part, np.ndarray):
+            view = np.ndarray(part.shape, dtype=part.dtype, buffer=buffer, offset=position)
+            view[...] = part
+            meta.append(("array", position, part.shape, part.dtype.str))
+        else:
+            buffer[position:position + size] = part
+            meta.append(("bytes", position, size))
+        position += size
+    return meta
+
+
+def read_parts(buffer: memoryview, meta: list[tuple], copy: bool = True) -> list[Part]:
+    """Reads back what write_parts wrote. Without `copy` the arrays are views into the slot."""
+    parts = []
+    for entry in meta:
+        if entry[0] == "array":
+            _, position, shape, dtype = entry
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer, offset=position)
+            parts.append(view.copy() if copy else view)
+        else:
+            _, position, size = entry
+            parts.append(bytes(buffer[position:position + size]) if copy else buffer[position:position + size])
+    return parts
+
+
+def call(func: Callable, data: Part, kwargs: dict):
+    return func(data, **kwargs)
+
+
+def run_in_slot(offset: int, capacity: int, input_meta: list[tuple], func: Callable, kwargs: dict):
+    """
+    Worker side of a job: runs func on the input read in place from the slot.
+
+    func returns (image, info) like the crop functions. The image and any
+    encoded strips under info["strips"] are written back into the slot.
+
+    Returns:
+        ("slot", output metadata, info without the strips) or, if the
+        result does not fit, ("pickled", (image, info)).
+    """
+    (data,) = read_parts(_block.buf, input_meta, copy=False)
+    image, info = func(data, **kwargs)
+    del data  # The input is consumed; the slot can now hold the output
+    strips = info.get("strips") or []
+    parts = ([image] if image is not None else []) + strips
+    output_meta = write_parts(_block.buf, offset, capacity, parts)
+    if output_meta is None:
+        return "pickled", (image, info)
+    info = {key: value for key, value in info.items() if key != "strips"}
+    return "slot", (output_meta, image is not None, len(strips)), info
+
+
+class SharedMemoryCropPool:
+    """
+    Process pool for crop functions with a ring of shared memory slots.
+
+    Use run() from the event loop. `executor` is the underlying
+    ProcessPoolExecutor, for jobs that do not need a slot.
+    """
+
+    def __init__(self, workers: int, slots: Optional[int] = None, slot_bytes: int = 16 * 2**20,
+                 threads: Optional[int] = None):
+        global _block
+        self.workers = workers
+        self.slots = slots or 2 * workers  # One being worked on and one being filled per worker
+        self.slot_bytes = slot_bytes
+        self.threads = threads or opencv_threads_per_worker(workers)
+        self.block = shared_memory.SharedMemory(create=True, size=self.slots * slot_bytes)
+        _block = self.block
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                            initargs=(self.threads, self.block.name))
+        self._free: asyncio.Queue = asyncio.Queue()
+        for slot in range(self.slots):
+            self._free.put_nowait(slot * slot_bytes)
+        self.counts = Counter()
+
+    async def run(self, func: Callable, data: Part, **kwargs) -> tuple[Any, dict]:
+        """
+        Runs func(data, **kwargs) -> (image, info) on a worker, passing data and the result through a slot.
+
+        func must be picklable (a module level function or a partial of one),
+        and data is encoded bytes or a NumPy array.
+        """
+        loop = asyncio.get_running_loop()
+        offset = await self._free.get()
+        input_meta = write_parts(self.block.buf, offset, self.slot_bytes, [data])
+        if input_meta is None:
+            self._free.put_nowait(offset)
+            self.counts["pickled"] += 1
+            return await loop.run_in_executor(self.executor, call, func, data, kwargs)
+
+        future = self.executor.submit(run_in_slot, offset, self.slot_bytes, input_meta, func, kwargs)
+        try:
+            result = await asyncio.wrap_future(future)
+            if result[0] == "pickled":
+                self.counts["pickled"] += 1
+                return result[1]
+            _, (output_meta, has_image, strip_count), info = result
+            parts = read_parts(self.block.buf, output_meta)
+        finally:
+            if future.done():
+                self._free.put_nowait(offset)
+            else:
+                # Cancelled while the worker still uses the slot: free it only once the worker is done.
+                future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._free.put_nowait, offset))
+        self.counts["shared"] += 1
+        image = parts.pop(0) if has_image else None
+        if strip_count:
+            info["strips"] = parts
+        return image, info
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "slots": self.slots, "slot_bytes": self.slot_bytes,
+                "free_slots": self._free.qsize(), "opencv_threads": self.threads, **self.counts}
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.block.close()
+        self.block.unlink()
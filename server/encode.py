@@ -0,0 +1,129 @@
+import cv2
+import numpy as np
+from typing import Optional
+
+ENCODE_MODES = ("color", "gray", "clahe", "binary")
+
+
+def estimate_line_pitch(gray: np.ndarray) -> Optional[float]:
+    """Estimates the distance in pixels between consecutive text lines.
+
+    The horizontal ink profile of a receipt is roughly periodic with the line
+    pitch, so the pitch is taken as the first peak of the profile's
+    autocorrelation. Returns None when no clear periodicity is found.
+    """
+    small_scale = min(1.0, 800 / max(gray.shape[:2]))
+    small = cv2.resize(gray, None, fx=small_scale, fy=small_scale, interpolation=cv2.INTER_AREA) if small_scale < 1 else gray
+    ink = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    profile = (ink > 0).mean(axis=1)
+    profile = profile - profile.mean()
+    if len(profile) < 16 or not profile.any():
+        return None
+
+    correlation = np.correlate(profile, profile, mode="full")[len(profile) - 1:]
+    correlation /= correlation[0]
+    max_lag = len(profile) // 4
+    for lag in range(3, max_lag):
+        if correlation[lag - 1] < correlation[lag] >= correlation[lag + 1] and correlation[lag] > 0.2:
+            return lag / small_scale
+    return None
+
+
+def text_aware_scale(shape: tuple[int, ...], line_pitch: Optional[float], max_dim: Optional[int],
+                     min_line_px: int) -> float:
+    """Downscale factor capping the long side at max_dim, unless that would bring the line pitch below min_line_px."""
+    if not max_dim or max(shape[:2]) <= max_dim:
+        return 1.0
+    scale = max_dim / max(shape[:2])
+    if line_pitch is not None and line_pitch * scale < min_line_px:
+        scale = min(1.0, min_line_px / line_pitch)
+    return scale
+
+
+def normalize_for_ocr(image: np.ndarray, mode: str) -> np.ndarray:
+    """Converts the crop for OCR: as is ("color"), grayscale, grayscale with CLAHE, or adaptively binarized."""
+    if mode == "color":
+        return image
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if mode == "gray":
+        return gray
+    if mode == "clahe":
+        return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gray)
+    if mode == "binary":
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+    raise ValueError(f"Unknown encode mode {mode!r}, expected one of {ENCODE_MODES}")
+
+
+def encode_jpeg_within(image: np.ndarray, byte_budget: Optional[int], min_quality: int = 40,
+                       max_quality: int = 90) -> tuple[bytes, int]:
+    """Encodes with the highest JPEG quality that fits in byte_budget (binary search).
+
+    Falls back to min_quality if nothing fits. Without a budget, max_quality is used.
+    """
+    def encode(quality: int) -> bytes:
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Could not encode the cropped image")
+        return encoded.tobytes()
+
+    best = encode(max_quality)
+    if not byte_budget or len(best) <= byte_budget:
+        return best, max_quality
+
+    low, high, best, best_quality = min_quality, max_quality - 1, None, min_quality
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = encode(quality)
+        if len(candidate) <= byte_budget:
+            best, best_quality = candidate, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = encode(min_quality)
+    return best, best_quality
+
+
+def encode_for_ocr(image: np.ndarray, mode: str = "gray", max_dim: Optional[int] = 2048,
+                   byte_budget: Optional[int] = 300_000, min_line_px: int = 20,
+                   info: Optional[dict] = None) -> bytes:
+    """Encodes a cropped receipt as a compact JPEG for the vision model.
+
+    The crop is converted per `mode` and downscaled so its long side is at
+    most `max_dim`, but never so far that text lines are less than
+    `min_line_px` pixels apart. It is then encoded at the highest JPEG quality
+    that fits `byte_budget`; if even the lowest quality does not fit, it is
+    downscaled further down to that same text limit.
+
+    Args:
+        image: The cropped receipt (BGR or grayscale).
+        mode: One of ENCODE_MODES.
+        max_dim: Cap on the long side in pixels, None for no cap.
+        byte_budget: Target size of the JPEG in bytes, None for no target.
+        min_line_px: Smallest acceptable line pitch after downscaling.
+        info: Optional dict that receives "bytes", "quality", "width",
+            "height", "mode" and "line_pitch".
+
+    Returns:
+        The JPEG bytes.
+    """
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    line_pitch = estimate_line_pitch(gray)
+    normalized = normalize_for_ocr(image, mode)
+
+    scale = text_aware_scale(normalized.shape, line_pitch, max_dim, min_line_px)
+    resized = cv2.resize(normalized, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else normalized
+    encoded, quality = encode_jpeg_within(resized, byte_budget)
+
+    # Over budget at the lowest quality: trade resolution for size while the text stays legible.
+    min_scale = min(1.0, min_line_px / line_pitch) if line_pitch else 0.5
+    while byte_budget and len(encoded) > byte_budget and scale * 0.8 >= min_scale:
+        scale *= 0.8
+        resized = cv2.resize(normalized, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        encoded, quality = encode_jpeg_within(resized, byte_budget)
+
+    if info is not None:
+        info.update({"bytes": len(encoded), "quality": quality, "width": resized.shape[1],
+                     "height": resized.shape[0], "mode": mode,
+                     "line_pitch": round(line_pitch * scale, 1) if line_pitch else None})
+    return encoded
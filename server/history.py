@@ -0,0 +1,266 @@
+"""Persistent receipt history and server-side shopping lists (SQLite, WAL mode).
+
+Lists are versioned per user: every change bumps the list version, and each
+entry remembers the version it was added and removed at. A client that
+knows version v can fetch only what changed since v, and can send its own
+changes as a delta instead of the whole list.
+
+Receipts and their items are stored as parsed from OCR, with indexes for
+lookups by store, date and item name (full text via FTS5).
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Iterable, Optional
+
+from cache import normalize_text
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lists (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS list_entries (
+    user_id TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    added_version INTEGER NOT NULL,
+    removed_version INTEGER,
+    PRIMARY KEY (user_id, entry)
+);
+CREATE INDEX IF NOT EXISTS list_entries_added ON list_entries (user_id, added_version);
+CREATE INDEX IF NOT EXISTS list_entries_removed ON list_entries (user_id, removed_version);
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    upload_hash TEXT,
+    store TEXT,
+    store_norm TEXT,
+    address TEXT,
+    date TEXT,
+    date_iso TEXT,
+    num_items INTEGER,
+    total_cost REAL,
+    created REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS receipts_upload ON receipts (user_id, upload_hash, store, date);
+CREATE INDEX IF NOT EXISTS receipts_user_date ON receipts (user_id, date_iso);
+CREATE INDEX IF NOT EXISTS receipts_user_store ON receipts (user_id, store_norm);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    receipt_id INTEGER NOT NULL REFERENCES receipts (id) ON DELETE CASCADE,
+    name TEXT,
+    friendly_name TEXT,
+    category TEXT,
+    quantity INTEGER,
+    price REAL,
+    unit_price TEXT,
+    unit TEXT,
+    upc TEXT
+);
+CREATE INDEX IF NOT EXISTS items_receipt ON items (receipt_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5 (
+    name, friendly_name, content='items', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, name, friendly_name) VALUES (new.id, new.name, new.friendly_name);
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, name, friendly_name) VALUES ('delete', old.id, old.name, old.friendly_name);
+END;
+"""
+
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d.%m.%Y", "%Y/%m/%d", "%b %d, %Y", "%B %d, %Y")
+
+ITEM_COLUMNS = ("name", "friendly_name", "category", "quantity", "price", "unit_price", "unit", "upc")
+
+
+def iso_date(date: str) -> Optional[str]:
+    """Parses a receipt date in one of the common formats to YYYY-MM-DD, or None."""
+    text = str(date or "").strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def fts_query(text: str) -> str:
+    """Turns free text into an FTS5 query matching every word as a prefix."""
+    words = normalize_text(text).replace('"', " ").split()
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class HistoryStore:
+    """Versioned per-user shopping lists and receipt history in one SQLite file.
+
+    Thread safe; one connection is shared behind a lock, as in SQLiteCache.
+    """
+
+    def __init__(self, path: str = "history.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    # Lists
+
+    def _version(self, user_id: str) -> int:
+        row = self._conn.execute("SELECT version FROM lists WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def list_entries(self, user_id: str) -> tuple[int, list[str]]:
+        """Returns the current (version, entries) of the user's list."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry FROM list_entries WHERE user_id = ? AND removed_version IS NULL ORDER BY added_version, entry",
+                (user_id,)).fetchall()
+            return self._version(user_id), [row[0] for row in rows]
+
+    def list_changes(self, user_id: str, since: int) -> dict:
+        """Entries added and removed after version `since`: {"version", "added", "removed"}."""
+        with self._lock:
+            return self._changes(user_id, since)
+
+    def _changes(self, user_id: str, since: int) -> dict:
+        added = self._conn.execute(
+            "SELECT entry FROM list_entries WHERE user_id = ? AND added_version > ? AND removed_version IS NULL"
+            " ORDER BY added_version, entry", (user_id, since)).fetchall()
+        removed = self._conn.execute(
+            "SELECT entry FROM list_entries WHERE user_id = ? AND removed_version > ? AND added_version <= ?"
+            " ORDER BY removed_version, entry", (user_id, since, since)).fetchall()
+        return {"version": self._version(user_id), "added": [row[0] for row in added],
+                "removed": [row[0] for row in removed]}
+
+    def apply_delta(self, user_id: str, base_version: int, add: Iterable[str] = (),
+                    remove: Iterable[str] = ()) -> dict:
+        """
+        Applies a client's list changes made on top of base_version.
+
+        Adds and removes are applied as set operations, so a delta based on an
+        older version merges with changes made since. Entries are matched
+        case- and whitespace-insensitively.
+
+        Returns:
+            The new version and the changes since base_version, so the client
+            also learns what other devices changed ({"version", "added", "removed"}).
+        """
+        add = [entry for entry in (normalize_text(e) for e in add) if entry]
+        remove = [entry for entry in (normalize_text(e) for e in remove) if entry]
+        with self._lock, self._conn:
+            listed = {row[0] for row in self._conn.execute(
+                "SELECT entry FROM list_entries WHERE user_id = ? AND removed_version IS NULL", (user_id,))}
+            add = [entry for entry in dict.fromkeys(add) if entry not in listed]
+            remove = [entry for entry in dict.fromkeys(remove) if entry in listed or entry in add]
+            if add or remove:  # Only real changes get a new version, so clients do not resync for nothing
+                version = self._version(user_id) + 1
+                self._conn.execute(
+                    "INSERT INTO lists (user_id, version, updated) VALUES (?, ?, ?)"
+                    " ON CONFLICT (user_id) DO UPDATE SET version = excluded.version, updated = excluded.updated",
+                    (user_id, version, time.time()))
+                self._conn.executemany(
+                    "INSERT INTO list_entries (user_id, entry, added_version) VALUES (?, ?, ?)"
+                    " ON CONFLICT (user_id, entry) DO UPDATE SET added_version = excluded.added_version,"
+                    " removed_version = NULL WHERE removed_version IS NOT NULL",
+                    [(user_id, entry, version) for entry in add])
+                self._conn.executemany(
+                    "UPDATE list_entries SET removed_version = ? WHERE user_id = ? AND entry = ? AND removed_version IS NULL",
+                    [(version, user_id, entry) for entry in remove])
+            return self._changes(user_id, base_version)
+
+    # Receipts
+
+    def add_receipts(self, user_id: str, purchase_data_json: dict, upload_hash: Optional[str] = None) -> list[int]:
+        """
+        Stores the receipts of one parsed OCR result and returns their IDs.
+
+        The same upload (by hash) stored twice for a user is kept once.
+        """
+        ids = []
+        now = time.time()
+        with self._lock, self._conn:
+            for receipt in purchase_data_json.get('receipts', []):
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO receipts (user_id, upload_hash, store, store_norm, address, date, date_iso,"
+                    " num_items, total_cost, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, upload_hash, receipt.get('Store'), normalize_text(receipt.get('Store', '')),
+                     receipt.get('Address'), receipt.get('Date'), iso_date(receipt.get('Date')),
+                     receipt.get('numItems'), receipt.get('totalCost'), now))
+                if cursor.rowcount == 0:
+                    continue  # Already stored
+                receipt_id = cursor.lastrowid
+                self._conn.executemany(
+                    f"INSERT INTO items (receipt_id, {', '.join(ITEM_COLUMNS)}) VALUES (?{', ?' * len(ITEM_COLUMNS)})",
+                    [(receipt_id, *(item.get(column) for column in ITEM_COLUMNS)) for item in receipt.get('items', [])])
+                ids.append(receipt_id)
+        return ids
+
+    def query_receipts(self, user_id: str, store: Optional[str] = None, date_from: Optional[str] = None,
+                       date_to: Optional[str] = None, item: Optional[str] = None, limit: int = 50,
+                       offset: int = 0) -> list[dict]:
+        """
+        Past receipts of a user, newest first, with their items.
+
+        Args:
+            store: Receipts whose store name starts with this (case-insensitive).
+            date_from: Earliest date, YYYY-MM-DD (inclusive).
+            date_to: Latest date, YYYY-MM-DD (inclusive).
+            item: Receipts with an item whose name or friendly name matches
+                these words (prefix match per word).
+        """
+        conditions, params = ["r.user_id = ?"], [user_id]
+        if store:
+            prefix = normalize_text(store)
+            conditions.append("r.store_norm >= ? AND r.store_norm < ?")
+            params += [prefix, prefix + "￿"]
+        if date_from:
+            conditions.append("r.date_iso >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("r.date_iso <= ?")
+            params.append(date_to)
+        if item and fts_query(item):
+            conditions.append("r.id IN (SELECT i.receipt_id FROM items_fts JOIN items i ON i.id = items_fts.rowid"
+                              " WHERE items_fts MATCH ?)")
+            params.append(fts_query(item))
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.id, r.store, r.address, r.date, r.num_items, r.total_cost FROM receipts r"
+                f" WHERE {' AND '.join(conditions)} ORDER BY r.date_iso DESC, r.id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset)).fetchall()
+            receipts = {row[0]: {"id": row[0], "Store": row[1], "Address": row[2], "Date": row[3],
+                                 "numItems": row[4], "totalCost": row[5], "items": []} for row in rows}
+            if receipts:
+                placeholders = ", ".join("?" * len(receipts))
+                for row in self._conn.execute(
+                        f"SELECT receipt_id, {', '.join(ITEM_COLUMNS)} FROM items WHERE receipt_id IN ({placeholders})"
+                        " ORDER BY id", tuple(receipts)):
+                    receipts[row[0]]["items"].append(dict(zip(ITEM_COLUMNS, row[1:])))
+        return list(receipts.values())
+
+    def query_items(self, user_id: str, item: str, limit: int = 50) -> list[dict]:
+        """Purchases of matching items, newest first, with the store, date and price of each."""
+        query = fts_query(item)
+        if not query:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join('i.' + column for column in ITEM_COLUMNS)}, r.id, r.store, r.date"
+                " FROM items_fts JOIN items i ON i.id = items_fts.rowid JOIN receipts r ON r.id = i.receipt_id"
+                " WHERE items_fts MATCH ? AND r.user_id = ? ORDER BY r.date_iso DESC, i.id DESC LIMIT ?",
+                (query, user_id, limit)).fetchall()
+        return [{**dict(zip(ITEM_COLUMNS, row[:len(ITEM_COLUMNS)])), "receipt_id": row[-3], "Store": row[-2],
+                 "Date": row[-1]} for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in ("lists", "list_entries", "receipts", "items")}
+        return {"path": self.path, **counts}
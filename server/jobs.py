@@ -0,0 +1,99 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Optional
+
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit when the queue is at capacity."""
+
+
+class JobQueue:
+    """
+    In-process job queue with a bounded worker pool and TTL-based result retention.
+
+    Work runs in worker tasks that do not depend on the submitting request,
+    so a client can disconnect and fetch the result later by job ID.
+    """
+
+    def __init__(self, handler: Callable[..., Awaitable[Any]], workers: int = 2, max_queued: int = 64,
+                 ttl: float = 3600):
+        """
+        Args:
+            handler: Coroutine function called with the job's arguments.
+            workers: Number of jobs processed at the same time.
+            max_queued: Jobs that may wait for a worker before submit is refused.
+            ttl: Seconds a finished job's result is kept.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.jobs: dict[str, dict] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, *args) -> str:
+        """
+        Queues a job and returns its ID.
+
+        Raises:
+            QueueFullError: If max_queued jobs are already waiting.
+        """
+        self.evict_expired()
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "status": "queued", "submitted": time.time(), "args": args}
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queued} waiting)")
+        self.jobs[job_id] = job
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Returns the public view of a job (status, result or error), or None if unknown or expired."""
+        self.evict_expired()
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != "args"}
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def evict_expired(self) -> None:
+        """Drops finished jobs whose results are older than the TTL."""
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if "finished" in job and now - job["finished"] > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            job = self.jobs.get(job_id)
+            try:
+                if job is None:
+                    continue
+                job["status"] = "running"
+                job["started"] = time.time()
+                try:
+                    job["result"] = await self.handler(*job.pop("args"))
+                    job["status"] = "done"
+                except Exception as e:
+                    job["status"] = "failed"
+                    job["error"] = getattr(e, "detail", None) or str(e) or type(e).__name__
+                job["finished"] = time.time()
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,306 @@
+"""Shared HTTP clients for the LLM calls.
+
+Both llm_ocr and llm_txt post to the same OpenAI-compatible API. They share
+one pooled, keep-alive client per process, so connections and TLS sessions
+are reused across requests. Timeouts and limits come from the environment:
+
+    LLM_CONNECT_TIMEOUT  seconds to establish a connection (default 10)
+    LLM_READ_TIMEOUT     seconds to wait for a response (default 120)
+    LLM_MAX_CONNECTIONS  pool size across all hosts (default 32)
+    LLM_MAX_KEEPALIVE    idle connections kept open (default 16)
+    LLM_MAX_PER_HOST     concurrent requests per host (default 8)
+
+Calls are retried, hedged and circuit broken per call type ("ocr" or
+"text"), see resilience for the LLM_OCR_* / LLM_TEXT_* settings.
+
+If LLM_BACKENDS is set, the async calls ignore the URL and token they are
+given and are routed across the configured backends instead (see router).
+The blocking helpers always use the URL they are given.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import resilience
+from router import Backend, load_router
+
+connect_timeout = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))
+read_timeout = float(os.environ.get("LLM_READ_TIMEOUT", 120))
+max_connections = int(os.environ.get("LLM_MAX_CONNECTIONS", 32))
+max_keepalive = int(os.environ.get("LLM_MAX_KEEPALIVE", 16))
+max_per_host = int(os.environ.get("LLM_MAX_PER_HOST", 8))
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_host_limits: dict[str, asyncio.Semaphore] = {}
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+# Vision calls are expensive, so they are not hedged by default; text calls are.
+policies = {
+    "ocr": resilience.Policy.from_env("LLM_OCR", attempts=3, base_delay=1.0),
+    "text": resilience.Policy.from_env("LLM_TEXT", attempts=3, base_delay=0.5, hedge="p95"),
+}
+latencies = {call_type: resilience.LatencyTracker() for call_type in policies}
+breaker_threshold = int(os.environ.get("LLM_BREAKER_THRESHOLD", 5))
+breaker_reset = float(os.environ.get("LLM_BREAKER_RESET", 30))
+_breakers: dict[str, resilience.CircuitBreaker] = {}
+
+router = load_router()
+capabilities = {"ocr": "vision", "text": "text"}
+
+
+def auth_headers(bearer_token: str) -> dict:
+    return {
+        "Authorization": f"Bearer {bearer_token}",
+        "Content-Type": "application/json"
+    }
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns the shared async client, creating it for the running event loop if needed."""
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_loop is not loop or _async_client.is_closed:
+        # Pools are bound to an event loop, so a new loop gets a new client.
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+        )
+        _async_loop = loop
+        _host_limits.clear()
+    return _async_client
+
+
+def breaker_for(url: str) -> resilience.CircuitBreaker:
+    """Circuit breaker of the host of url, shared by all call types."""
+    host = urlsplit(url).netloc
+    if host not in _breakers:
+        _breakers[host] = resilience.CircuitBreaker(breaker_threshold, breaker_reset)
+    return _breakers[host]
+
+
+def breaker_states() -> dict[str, str]:
+    return {host: breaker.state for host, breaker in _breakers.items()}
+
+
+def host_limit(url: str) -> asyncio.Semaphore:
+    """Semaphore capping the concurrent requests to the host of url."""
+    host = urlsplit(url).netloc
+    if host not in _host_limits:
+        _host_limits[host] = asyncio.Semaphore(max_per_host)
+    return _host_limits[host]
+
+
+async def post_json(url: str, payload: dict, bearer_token: str, timeout: Optional[float] = None,
+                    call_type: str = "text") -> dict:
+    """
+    Posts a JSON payload with the shared client and returns the decoded JSON response.
+
+    Retries, hedging and circuit breaking follow the policy of call_type.
+
+    Raises:
+        httpx.HTTPError: On connection errors, timeouts and 4xx/5xx responses
+            once retries are exhausted (resilience.CircuitOpenError if the
+            host's breaker is open).
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await _post_json(url, payload, bearer_token, timeout, call_type)
+        outcome = "ok"
+        return result
+    finally:
+        observe_call(call_type, outcome, time.perf_counter() - started)
+
+
+def observe_call(call_type: str, outcome: str, seconds: float) -> None:
+    metrics.llm_request_seconds.observe(seconds, call_type=call_type, outcome=outcome)
+    metrics.add_request_timing(f"llm_{call_type}", seconds)
+
+
+async def _post_json(url: str, payload: dict, bearer_token: str, timeout: Optional[float], call_type: str) -> dict:
+    client = get_async_client()
+    request_timeout = httpx.Timeout(timeout, connect=connect_timeout) if timeout is not None else httpx.USE_CLIENT_DEFAULT
+    content = json.dumps(payload)
+
+    if router is not None:
+        async def send_to(backend: Backend) -> dict:
+            body = json.dumps({**payload, "model": backend.model}) if backend.model else content
+            response = await client.post(backend.url, headers=auth_headers(backend.token(bearer_token)),
+                                         content=body, timeout=request_timeout)
+            response.raise_for_status()
+            return response.json()
+
+        started = time.monotonic()
+        result = await router.call(capabilities[call_type], send_to, policies[call_type],
+                                   resilience.hedge_delay(policies[call_type], latencies[call_type]))
+        latencies[call_type].add(time.monotonic() - started)
+        return result
+
+    async def send() -> dict:
+        async with host_limit(url):
+            response = await client.post(url, headers=auth_headers(bearer_token), content=content,
+                                         timeout=request_timeout)
+            response.raise_for_status()
+            return response.json()
+
+    return await resilience.call(send, policies[call_type], breaker_for(url), latencies[call_type])
+
+
+async def stream_chat(url: str, payload: dict, bearer_token: str, timeout: Optional[float] = None,
+                      call_type: str = "ocr"):
+    """
+    Posts a chat completion request with "stream": true and yields the content
+    deltas as the server sends them (OpenAI server-sent events format).
+
+    Failures before the stream starts are retried per the call_type policy;
+    once content has been yielded the request is not retried or hedged.
+    With LLM_BACKENDS set, the stream is routed like post_json: it holds a
+    backend slot until it ends, and fails over to the next backend if it
+    fails before the first delta (see Router.stream).
+
+    Raises:
+        httpx.HTTPError: On connection errors, timeouts and 4xx/5xx responses.
+    """
+    client = get_async_client()
+    request_timeout = httpx.Timeout(timeout, connect=connect_timeout) if timeout is not None else httpx.USE_CLIENT_DEFAULT
+    started = time.perf_counter()
+    outcome = "error"
+    if router is not None:
+        async def stream_from(backend: Backend):
+            body = {**payload, "model": backend.model} if backend.model else payload
+            request = client.build_request("POST", backend.url, headers=auth_headers(backend.token(bearer_token)),
+                                           content=json.dumps(body), timeout=request_timeout)
+            response = await client.send(request, stream=True)
+            try:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                async for content in content_deltas(response):
+                    yield content
+            finally:
+                await response.aclose()
+
+        try:
+            async for content in router.stream(capabilities[call_type], stream_from, policies[call_type]):
+                yield content
+            outcome = "ok"
+        finally:
+            observe_call(call_type, outcome, time.perf_counter() - started)
+        return
+
+    policy, breaker = policies[call_type], breaker_for(url)
+    async with host_limit(url):
+        for attempt in range(policy.attempts):
+            if not breaker.allow():
+                raise resilience.CircuitOpenError("Circuit breaker open, not calling the LLM API")
+            request = client.build_request("POST", url, headers=auth_headers(bearer_token),
+                                           content=json.dumps(payload), timeout=request_timeout)
+            try:
+                response = await client.send(request, stream=True)
+                if response.is_error:
+                    await response.aread()
+                    await response.aclose()
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                if not resilience.is_retryable(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt == policy.attempts - 1:
+                    raise
+                status_response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+                metrics.llm_retries.inc(reason=status_response.status_code if status_response is not None else type(e).__name__)
+                retry_after = resilience.retry_after_seconds(status_response)
+                await asyncio.sleep(policy.backoff(attempt, retry_after))
+                continue
+            except BaseException:
+                breaker.release_trial()  # Cancelled, or an error that says nothing about the host
+                raise
+            breaker.record_success()
+            break
+
+        try:
+            async for content in content_deltas(response):
+                yield content
+            outcome = "ok"
+        finally:
+            await response.aclose()
+            observe_call(call_type, outcome, time.perf_counter() - started)
+
+
+async def content_deltas(response: httpx.Response):
+    """Yields the content deltas of a streamed chat completion response (server-sent events)."""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        choices = json.loads(data).get("choices") or [{}]
+        content = choices[0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+async def aclose() -> None:
+    """Closes the shared async client (call on shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def get_session() -> requests.Session:
+    """Returns the shared requests session used by the blocking helpers."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_per_host, pool_maxsize=max_connections)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def post_json_sync(url: str, payload: dict, bearer_token: str, timeout: Optional[float] = None,
+                   call_type: str = "text") -> requests.Response:
+    """
+    Blocking counterpart of post_json. Returns the response after raise_for_status.
+
+    Retries 429, 5xx and connection errors with the call_type policy's
+    backoff. It is not hedged and does not use the circuit breakers.
+
+    Raises:
+        requests.exceptions.RequestException: On connection errors, timeouts and 4xx/5xx responses.
+    """
+    policy = policies[call_type]
+    for attempt in range(policy.attempts):
+        try:
+            response = get_session().post(url, headers=auth_headers(bearer_token), data=json.dumps(payload),
+                                          timeout=(connect_timeout, timeout if timeout is not None else read_timeout))
+            response.raise_for_status()
+            return response
+        except requests.exceptions.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            retryable = status in resilience.RETRYABLE_STATUS or isinstance(
+                e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            if not retryable or attempt == policy.attempts - 1:
+                raise
+            retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            time.sleep(policy.backoff(attempt, retry_after))
@@ -0,0 +1,299 @@
+"""Tolerant parsing and schema validation of LLM JSON answers.
+
+Models answering in JSON mode still return code fences, single quotes,
+trailing commas or an answer cut off at the token limit, and fill schema
+fields with the wrong type ("$3.49" for a number) or a near-miss key name.
+Each of these used to cost a full re-request. Here they are fixed locally:
+
+    validate = compile_schema(SCHEMA, aliases={"items_matched": "matched_items"})
+    answer = parse_answer(text, validate)
+
+compile_schema turns a JSON schema (the subset used by the response
+formats in this repo) into nested closures once, so validating an answer is
+a plain walk over it.
+"""
+import json
+import re
+from typing import Any, Callable, Optional
+
+import metrics
+
+CLOSERS = {"{": "}", "[": "]"}
+LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+FENCE = re.compile(r"```[a-zA-Z]*\s*\n?(.*?)(?:```|$)", re.DOTALL)
+WORD = re.compile(r"[A-Za-z_][\w-]*")
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?")
+
+
+class SchemaError(ValueError):
+    """An answer that does not fit the schema even after coercion."""
+
+    def __init__(self, path: str, problem: str):
+        super().__init__(f"{path or '$'}: {problem}")
+        self.path = path
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites almost-JSON into JSON.
+
+    Fixes code fences and prose around the value, single-quoted strings,
+    unquoted keys, Python literals (True/False/None), raw newlines in
+    strings, trailing commas and mismatched closers. An answer cut off
+    mid-way is closed after its last complete value, so a truncated item
+    array keeps every item that arrived whole.
+    """
+    fenced = FENCE.search(text)
+    if fenced and not text.lstrip().startswith(("{", "[")):
+        text = fenced.group(1)
+    starts = [position for position in (text.find("{"), text.find("[")) if position >= 0]
+    if not starts:
+        return text
+    text = text[min(starts):]
+
+    out: list[str] = []
+    stack: list[str] = []
+    # Last (output length, open containers) at which closing gives valid JSON. Points inside an
+    # object that is an array element are skipped, so a cut off element is dropped, not kept half.
+    safe = (0, [])
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\" and i + 1 < len(text):
+                following = text[i + 1]
+                out.append("'" if following == "'" else char + following)
+                i += 2
+                continue
+            if char == quote:
+                out.append('"')
+                quote = None
+            elif char == '"':
+                out.append('\\"')  # Inside a single-quoted string
+            elif char == "\n":
+                out.append("\\n")
+            else:
+                out.append(char)
+            i += 1
+            continue
+
+        if char in "\"'":
+            quote = char
+            out.append('"')
+        elif char in "{[":
+            stack.append(char)
+            out.append(char)
+            if char == "[" or "[" not in stack:
+                safe = (len(out), list(stack))
+        elif char in "}]":
+            while out and (out[-1].isspace() or out[-1] == ","):
+                out.pop()  # Trailing comma
+            expected = "{" if char == "}" else "["
+            if expected in stack:
+                while stack[-1] != expected:
+                    out.append(CLOSERS[stack.pop()])
+                stack.pop()
+                out.append(char)
+            if not stack:
+                return "".join(out)  # Anything after the value is prose
+            if stack[-1] == "[" or "[" not in stack:
+                safe = (len(out), list(stack))
+        elif char == ",":
+            if stack and (stack[-1] == "[" or "[" not in stack):
+                safe = (len(out), list(stack))
+            out.append(char)
+        elif (number := NUMBER.match(text, i)):
+            out.append(number.group())  # Whole, so an exponent is not read as a bare word
+            i = number.end()
+            continue
+        elif char.isalpha() or char == "_":
+            word = WORD.match(text, i).group()
+            out.append(LITERALS.get(word, json.dumps(word)))  # Unquoted keys become strings
+            i += len(word)
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    # Cut off: drop the incomplete tail and close what was open at the last complete value.
+    length, open_containers = safe
+    out = out[:length]
+    while out and (out[-1].isspace() or out[-1] == ","):
+        out.pop()
+    return "".join(out) + "".join(CLOSERS[container] for container in reversed(open_containers))
+
+
+def loads_lenient(text: str) -> Any:
+    """
+    json.loads, falling back to repair_json for answers that are not valid JSON.
+
+    Raises:
+        json.JSONDecodeError: The original error, if the repaired text does not parse either.
+    """
+    return _loads(text)[0]
+
+
+def _loads(text: str) -> tuple[Any, bool]:
+    """Returns the parsed value and whether it needed repairing."""
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as e:
+        error = e
+    try:
+        return json.loads(repair_json(text)), True
+    except json.JSONDecodeError:
+        raise error
+
+
+def key_form(key: str) -> str:
+    """Folds a key so that casing and separators do not matter: "Items Matched" == "itemsMatched"."""
+    return re.sub(r"[^a-z0-9]", "", str(key).lower())
+
+
+def parse_number(value: Any, path: str) -> float:
+    if isinstance(value, bool):
+        raise SchemaError(path, "expected a number, got a boolean")
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        text = value.strip().replace(" ", "")
+        if re.fullmatch(r"[^\d]*-?\d+,\d{2}[^\d]*", text):
+            text = text.replace(",", ".")  # Decimal comma
+        text = text.replace(",", "")
+        match = re.search(r"-?\d+(?:\.\d+)?", text)
+        if match:
+            number = float(match.group())
+            return -number if text.startswith("(") and number > 0 else number
+    raise SchemaError(path, f"expected a number, got {value!r}")
+
+
+def compile_schema(schema: dict, aliases: Optional[dict] = None, defaults: Optional[dict] = None) -> Callable[[Any], Any]:
+    """
+    Builds a validator for a JSON schema that coerces answers into shape.
+
+    Handles the keywords used by this repo's response formats: type
+    (object, array, string, number, integer, boolean), properties, items,
+    required and additionalProperties. On top of plain validation:
+
+    - Keys match regardless of case and separators, and `aliases` maps other
+      names to the schema's ({"items_matched": "matched_items"}).
+    - Numbers and integers are read from strings ("$3.49", "2 ea"), and
+      numbers are accepted where a string is expected.
+    - A bare list where an object with one required array is expected is
+      wrapped in that object, and a single object where an array is
+      expected becomes a list of one.
+    - `defaults` (by property name, at any depth) fill in missing or
+      unusable values. Unknown keys are dropped when additionalProperties
+      is false.
+
+    Returns:
+        A function taking the parsed answer and returning the coerced copy.
+        It raises SchemaError if the answer cannot be made to fit.
+    """
+    folded_aliases = {key_form(alias): name for alias, name in (aliases or {}).items()}
+    validate = _compile(schema, folded_aliases, defaults or {})
+    return lambda value: validate(value, "")
+
+
+def _compile(schema: dict, aliases: dict, defaults: dict) -> Callable[[Any, str], Any]:
+    kind = schema.get("type")
+
+    if kind == "object":
+        properties = {name: _compile(sub, aliases, defaults) for name, sub in schema.get("properties", {}).items()}
+        by_form = {key_form(name): name for name in properties}
+        by_form.update({alias: name for alias, name in aliases.items() if name in properties})
+        required = schema.get("required", [])
+        keep_extra = schema.get("additionalProperties", True) is not False
+        arrays = [name for name in required if schema["properties"].get(name, {}).get("type") == "array"]
+        wrap = arrays[0] if len(arrays) == 1 and len(required) == 1 else None
+
+        def check_object(value, path):
+            if isinstance(value, list) and wrap:
+                value = {wrap: value}
+            if not isinstance(value, dict):
+                raise SchemaError(path, f"expected an object, got {type(value).__name__}")
+            result = {}
+            for key, item in value.items():
+                name = key if key in properties else by_form.get(key_form(key))
+                if name is None:
+                    if keep_extra:
+                        result[key] = item
+                elif name not in result or key == name:  # The exact key wins over an alias
+                    result[name] = item
+            for name, validate in properties.items():
+                if result.get(name) is not None:
+                    try:
+                        result[name] = validate(result[name], f"{path}.{name}")
+                        continue
+                    except SchemaError:
+                        if name not in defaults:
+                            raise
+                    result[name] = defaults[name]
+                elif name in defaults:
+                    result[name] = defaults[name]
+                elif name in required:
+                    raise SchemaError(path, f"missing required key '{name}'")
+                else:
+                    result.pop(name, None)
+            return result
+        return check_object
+
+    if kind == "array":
+        validate_item = _compile(schema.get("items", {}), aliases, defaults)
+
+        def check_array(value, path):
+            if isinstance(value, dict):
+                value = [value]
+            if not isinstance(value, list):
+                raise SchemaError(path, f"expected an array, got {type(value).__name__}")
+            return [validate_item(item, f"{path}[{index}]") for index, item in enumerate(value)]
+        return check_array
+
+    if kind == "string":
+        def check_string(value, path):
+            if isinstance(value, str):
+                return value
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return str(value)
+            raise SchemaError(path, f"expected a string, got {type(value).__name__}")
+        return check_string
+
+    if kind == "number":
+        return parse_number
+
+    if kind == "integer":
+        def check_integer(value, path):
+            number = parse_number(value, path)
+            if number != int(number):
+                raise SchemaError(path, f"expected an integer, got {value!r}")
+            return int(number)
+        return check_integer
+
+    if kind == "boolean":
+        def check_boolean(value, path):
+            if isinstance(value, bool):
+                return value
+            if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+                return value.strip().lower() == "true"
+            raise SchemaError(path, f"expected a boolean, got {value!r}")
+        return check_boolean
+
+    return lambda value, path: value
+
+
+def parse_answer(text: str, validate: Callable[[Any], Any]) -> Any:
+    """
+    Parses and validates an LLM answer, repairing and coercing it where possible.
+
+    Raises:
+        ValueError: json.JSONDecodeError or SchemaError if it cannot be fixed.
+    """
+    try:
+        value, repaired = _loads(text)
+        value = validate(value)
+    except ValueError:
+        metrics.llm_answers.inc(outcome="invalid")
+        raise
+    metrics.llm_answers.inc(outcome="repaired" if repaired else "valid")
+    return value
@@ -1,9 +1,33 @@
 import base64
+import httpx
 import requests
-import json
+import llm_client
+from llm_json import compile_schema
+import metrics
+import os
+from stream_json import ReceiptItemStream
 import argparse
 import sys
 
+# Model named in the payload; a backend configured with a model in LLM_BACKENDS overrides it.
+ocr_model = os.environ.get("LLM_OCR_MODEL", "gpt-4o")
+# Model structuring locally OCR'd receipt text (OCR_LOCAL=1); it needs no vision support.
+text_ocr_model = os.environ.get("LLM_OCR_TEXT_MODEL", ocr_model)
+
+def bytes_to_base64(image_bytes):
+    """
+    Converts in-memory image bytes to their Base64 representation.
+
+    Args:
+        image_bytes: The encoded image (bytes, bytearray or memoryview).
+
+    Returns:
+        The Base64 encoded string.
+    """
+    with metrics.timer("base64"):
+        return base64.b64encode(image_bytes).decode('ascii')
+
+
 def jpg_to_base64(image_path):
     """
     Converts a JPG image file directly to its Base64 representation.
@@ -16,9 +40,7 @@ def jpg_to_base64(image_path):
     """
     try:
         with open(image_path, "rb") as image_file:
-            jpg_data = image_file.read()
-            encoded_string = base64.b64encode(jpg_data)
-            return encoded_string.decode('utf-8')
+            return bytes_to_base64(image_file.read())
     except FileNotFoundError:
         print(f"Error: Image file not found at '{image_path}'")
         return None
@@ -27,32 +49,94 @@ def jpg_to_base64(image_path):
         return None
 
 
-def send_receipt_image(image_path, bearer_token, api_url):
+RECEIPT_PROMPT = "whats on the receipt? return only a json list of items with their prices and quantities (in the form price = 'total price', unit = 'unit of sale, like ea or /LB', unit_price = 'price per unit'), and if available, the UPC or store number listed, the category if listed, as well as store info. For each item, extrapolate a friendly name based on the abbreviated name on the receipt and context clues. If you cant find a value for a field, use Not Found, but all fields must have a value set! The required properties for an item are: 'name', 'friendly_name', 'quantity', 'price', 'unit_price', 'unit', 'upc'"
+
+# Schema of the receipt extraction answer, shared by the vision and the text-only call.
+RECEIPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "receipts": { 
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "Store": {"type": "string"},
+                    "Address": {"type": "string"},
+                    "Date": {"type": "string"},
+                    "numItems": {"type": "integer"},
+                    "totalCost": {"type": "number"},
+                    "items": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "category": {"type": "string"},
+                                "name": {"type": "string"},
+                                "friendly_name": {"type": "string"},
+                                "quantity": {"type": "integer"},
+                                "price": {"type": "number"},
+                                "unit_price": {"type": "string"},
+                                "unit": {"type": "string"},
+                                "upc": {"type": "string"},
+                            },
+                            "required": ["name", "quantity", "price", "friendly_name", "category"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["Store", "Address", "Date", "numItems", "totalCost", "items"], #numItems and TotalCost might not always be available.
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["receipts"], # Important:  The top-level *must* be "receipts"
+    "additionalProperties": False
+}
+
+# Validates and coerces a receipt extraction answer (see llm_json). Missing fields
+# take the "Not Found" the prompt asks for, and unreadable numbers become null.
+validate_receipt = compile_schema(
+    RECEIPT_SCHEMA,
+    aliases={"store_name": "Store", "total": "totalCost", "item_count": "numItems", "qty": "quantity",
+             "description": "name"},
+    defaults={"Store": "Not Found", "Address": "Not Found", "Date": "Not Found", "numItems": None,
+              "totalCost": None, "category": "Not Found", "quantity": 1, "price": None, "unit_price": "Not Found",
+              "unit": "Not Found", "upc": "Not Found"},
+)
+
+
+def receipt_response_format():
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "receipt_extraction",
+            "schema": RECEIPT_SCHEMA,
+            "strict": True
+        }
+    }
+
+
+def build_receipt_payload(base64_image, stream=False):
     """
-    Sends a receipt image to the specified API endpoint and processes the response.
+    Builds the chat completion payload for a receipt image.
 
     Args:
-        image_path: Path to the JPEG image file.
-        bearer_token:  The Bearer token for authorization.
-        api_url: The API endpoint URL.
+        base64_image: The Base64 encoded JPEG image.
+        stream: Ask the API to stream the answer as server-sent events.
 
     Returns:
-        The JSON response from the API, or None if an error occurs.
+        The request payload as a dict.
     """
-    base64_image = jpg_to_base64(image_path)
-    if not base64_image:
-        return None
-
     payload = {
-        "stream": False,
-        "model": "gpt-4o",
+        "stream": stream,
+        "model": ocr_model,
         "messages": [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": "whats on the receipt? return only a json list of items with their prices and quantities (in the form price = 'total price', unit = 'unit of sale, like ea or /LB', unit_price = 'price per unit'), and if available, the UPC or store number listed, the category if listed, as well as store info. For each item, extrapolate a friendly name based on the abbreviated name on the receipt and context clues. If you cant find a value for a field, use Not Found, but all fields must have a value set! The required properties for an item are: 'name', 'friendly_name', 'quantity', 'price', 'unit_price', 'unit', 'upc'"
+                        "text": RECEIPT_PROMPT
                     },
                     {
                         "type": "image_url",
@@ -63,69 +147,89 @@ def send_receipt_image(image_path, bearer_token, api_url):
                 ]
             }
         ],
-        "response_format": { 
-            "type": "json_schema",
-            "json_schema": {
-                "name": "receipt_extraction",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "receipts": { 
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "Store": {"type": "string"},
-                                    "Address": {"type": "string"},
-                                    "Date": {"type": "string"},
-                                    "numItems": {"type": "integer"},
-                                    "totalCost": {"type": "number"},
-                                    "items": {
-                                        "type": "array",
-                                        "items": {
-                                            "type": "object",
-                                            "properties": {
-                                                "category": {"type": "string"},
-                                                "name": {"type": "string"},
-                                                "friendly_name": {"type": "string"},
-                                                "quantity": {"type": "integer"},
-                                                "price": {"type": "number"},
-                                                "unit_price": {"type": "string"},
-                                                "unit": {"type": "string"},
-                                                "upc": {"type": "string"},
-                                            },
-                                            "required": ["name", "quantity", "price", "friendly_name", "category"],
-                                            "additionalProperties": False
-                                        }
-                                    }
-                                },
-                                "required": ["Store", "Address", "Date", "numItems", "totalCost", "items"], #numItems and TotalCost might not always be available.
-                                "additionalProperties": False
-                            }
-                        }
-                    },
-                    "required": ["receipts"], # Important:  The top-level *must* be "receipts"
-                    "additionalProperties": False
-                },
-                "strict": True
-            }
-        }
+        "response_format": receipt_response_format()
     }
+    return payload
+
+
+def build_receipt_text_payload(lines):
+    """
+    Builds a text-only payload asking for the same receipt extraction from locally OCR'd lines.
+
+    Args:
+        lines: The receipt's text lines, top to bottom.
 
-    headers = {
-        "Authorization": f"Bearer {bearer_token}",
-        "Content-Type": "application/json"
+    Returns:
+        The request payload as a dict.
+    """
+    text = "\n".join(lines)
+    payload = {
+        "stream": False,
+        "model": text_ocr_model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"{RECEIPT_PROMPT}\nThe receipt was read by OCR, so expect some misread characters. Its text, line by line:\n{text}"
+                    }
+                ]
+            }
+        ],
+        "response_format": receipt_response_format()
     }
+    return payload
+
+
+def send_receipt_image(image_path, bearer_token, api_url):
+    """
+    Sends a receipt image to the specified API endpoint and processes the response.
+
+    Args:
+        image_path: Path to the JPEG image file.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+
+    Returns:
+        The JSON response from the API, or None if an error occurs.
+    """
+    base64_image = jpg_to_base64(image_path)
+    if not base64_image:
+        return None
+    return post_receipt_image(base64_image, bearer_token, api_url)
+
+
+def send_receipt_image_bytes(image_bytes, bearer_token, api_url):
+    """
+    Sends an in-memory JPEG receipt image to the specified API endpoint.
+
+    Args:
+        image_bytes: The JPEG encoded image.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+
+    Returns:
+        The JSON response from the API, or None if an error occurs.
+    """
+    return post_receipt_image(bytes_to_base64(image_bytes), bearer_token, api_url)
+
+
+def post_receipt_image(base64_image, bearer_token, api_url):
+    """
+    Posts a Base64 encoded receipt image and returns the JSON response, or None on error.
+    """
+    payload = build_receipt_payload(base64_image)
 
     try:
-        response = requests.post(api_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        response = llm_client.post_json_sync(api_url, payload, bearer_token, call_type="ocr")  # Raises HTTPError for 4xx or 5xx
         return response.json()
     except requests.exceptions.RequestException as e:
+        response = e.response
         print(f"Error during API request: {e}")
-        print(f"Response status code: {response.status_code if 'response' in locals() else 'N/A'}")
+        print(f"Response status code: {response.status_code if response is not None else 'N/A'}")
         try:
-            print(f"Response content: {response.text if 'response' in locals() else 'N/A'}") #print response text, even if there is an error
+            print(f"Response content: {response.text if response is not None else 'N/A'}") #print response text, even if there is an error
         except:
             print("could not decode response text")
         return None
@@ -133,3 +237,132 @@ def send_receipt_image(image_path, bearer_token, api_url):
         print(f"response error: {e}")
         return None
 
+
+async def send_receipt_image_async(image_path, bearer_token, api_url, timeout=None):
+    """
+    Async variant of send_receipt_image that does not block the event loop.
+
+    Args:
+        image_path: Path to the JPEG image file.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+        timeout: Read timeout in seconds (defaults to LLM_READ_TIMEOUT).
+
+    Returns:
+        The JSON response from the API, or None if an error occurs.
+    """
+    base64_image = jpg_to_base64(image_path)
+    if not base64_image:
+        return None
+    return await post_receipt_image_async(base64_image, bearer_token, api_url, timeout)
+
+
+async def send_receipt_image_bytes_async(image_bytes, bearer_token, api_url, timeout=None):
+    """
+    Async variant of send_receipt_image_bytes.
+
+    Args:
+        image_bytes: The JPEG encoded image.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+        timeout: Read timeout in seconds (defaults to LLM_READ_TIMEOUT).
+
+    Returns:
+        The JSON response from the API, or None if an error occurs.
+    """
+    return await post_receipt_image_async(bytes_to_base64(image_bytes), bearer_token, api_url, timeout)
+
+
+async def post_receipt_image_async(base64_image, bearer_token, api_url, timeout=None):
+    """
+    Async variant of post_receipt_image.
+    """
+    payload = build_receipt_payload(base64_image)
+
+    try:
+        return await llm_client.post_json(api_url, payload, bearer_token, timeout, call_type="ocr")
+    except httpx.HTTPStatusError as e:
+        print(f"Error during API request: {e}")
+        print(f"Response status code: {e.response.status_code}")
+        print(f"Response content: {e.response.text}")
+        return None
+    except httpx.HTTPError as e:
+        print(f"Error during API request: {e}")
+        return None
+    except Exception as e:
+        print(f"response error: {e}")
+        return None
+
+
+async def send_receipt_image_bytes_stream_async(image_bytes, bearer_token, api_url, on_item=None, timeout=None):
+    """
+    Streaming variant of send_receipt_image_bytes_async.
+
+    The answer is requested with "stream": true and parsed as it arrives, and
+    on_item is called with each receipt item as soon as its object closes, well
+    before the whole document is done.
+
+    Args:
+        image_bytes: The JPEG encoded image.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+        on_item: Optional callback receiving each completed item dict.
+        timeout: Read timeout in seconds (defaults to LLM_READ_TIMEOUT).
+
+    Returns:
+        A response shaped like the non-streaming one (the full JSON text in
+        choices[0].message.content), or None if an error occurs.
+    """
+    payload = build_receipt_payload(bytes_to_base64(image_bytes), stream=True)
+    parser = ReceiptItemStream()
+
+    try:
+        async for content in llm_client.stream_chat(api_url, payload, bearer_token, timeout, call_type="ocr"):
+            for item in parser.feed(content):
+                if on_item:
+                    on_item(item)
+    except httpx.HTTPStatusError as e:
+        print(f"Error during API request: {e}")
+        print(f"Response status code: {e.response.status_code}")
+        print(f"Response content: {e.response.text}")
+        return None
+    except httpx.HTTPError as e:
+        print(f"Error during API request: {e}")
+        return None
+    except Exception as e:
+        print(f"response error: {e}")
+        return None
+    return {"choices": [{"message": {"role": "assistant", "content": parser.text}}]}
+
+
+async def send_receipt_text_async(lines, bearer_token, api_url, timeout=None):
+    """
+    Sends locally OCR'd receipt lines to a text model for structuring.
+
+    The call is routed like a text call (no vision backend needed) and the
+    answer has the same shape as a vision answer.
+
+    Args:
+        lines: The receipt's text lines, top to bottom.
+        bearer_token:  The Bearer token for authorization.
+        api_url: The API endpoint URL.
+        timeout: Read timeout in seconds (defaults to LLM_READ_TIMEOUT).
+
+    Returns:
+        The JSON response from the API, or None if an error occurs.
+    """
+    payload = build_receipt_text_payload(lines)
+
+    try:
+        return await llm_client.post_json(api_url, payload, bearer_token, timeout, call_type="text")
+    except httpx.HTTPStatusError as e:
+        print(f"Error during API request: {e}")
+        print(f"Response status code: {e.response.status_code}")
+        print(f"Response content: {e.response.text}")
+        return None
+    except httpx.HTTPError as e:
+        print(f"Error during API request: {e}")
+        return None
+    except Exception as e:
+        print(f"response error: {e}")
+        return None
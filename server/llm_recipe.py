@@ -1,46 +1,182 @@
-import requests
+import asyncio
 import json
 import os
-from google import genai
-from dotenv import load_dotenv
+from typing import Iterable, Optional
 
-# Load environment variables from a .env file
-load_dotenv()
+from cache import LRUCache, normalize_text
+from llm_json import loads_lenient
+from matcher import singularize
 
-# Get the API key from environment variables
-api_key = os.getenv("GEMINI_API_KEY")
+# The Gemini client is created on first use, so importing this module costs nothing.
+_client = None
 
-# Initialize the client with the API key
-client = genai.Client(api_key=api_key)
-'''This part can be where when the user check boxes the ingredients
-and then presses "generate" it will add all the ingredients they checked
-to this list of ingredients. '''
-# Define the list of ingredients
-ingredients = ["potato", "porkchops", "garlic salt", "onion"]
+recipe_model = os.environ.get("RECIPE_MODEL", "gemini-2.0-flash")
 
-# Create the contents string using the list of ingredients
-prompt = f"""
+
+def get_client():
+    """Returns the shared genai.Client, loading .env and creating it on first use."""
+    global _client
+    if _client is None:
+        from google import genai
+        from dotenv import load_dotenv
+
+        # Load environment variables from a .env file
+        load_dotenv()
+        _client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _client
+
+
+def canonical_ingredients(ingredients: Iterable[str]) -> tuple[str, ...]:
+    """Normalizes an ingredient list into a sorted tuple without duplicates.
+
+    Case, whitespace, plurals and order don't matter, so "Onions, garlic"
+    and "garlic,onion" give the same key.
+    """
+    return tuple(sorted(prompt_ingredients(ingredients)))
+
+
+def prompt_ingredients(ingredients: Iterable[str]) -> dict[str, str]:
+    """Maps each canonical ingredient to the first normalized name the user gave for it, in the user's order.
+
+    The canonical form is only a cache key; the model is asked with these
+    names, so "Tomatoes" stays "tomatoes" and "Hummus" does not become "hummu".
+    """
+    names: dict[str, str] = {}
+    for ingredient in ingredients:
+        words = normalize_text(ingredient).split()
+        if words:
+            names.setdefault(" ".join(singularize(word) for word in words), " ".join(words))
+    return names
+
+
+def build_recipe_prompt(ingredients: Iterable[str]) -> str:
+    return f"""
 You are a recipe generator. Based on the following ingredients, and no additional ingredients, generate a recipe in JSON format with these keys: title, items_used, ingredients, instructions, prep_time, cook_time, and servings.
 The ingredients are: {', '.join(ingredients)}. Make sure the instructions are detailed and easy to follow.
 Please respond only with valid JSON.
 """
-# Define the request payload
-payload = {
-    "model": "gemini-2.0-flash",
-    "contents": [prompt]
-
-}
-
-# Make a request to the Gemini API to generate content
-response = client.models.generate_content(**payload)
-
-# Parse the JSON response
-response_json = response.model_dump_json()
-
-# Print the formatted JSON response
-try:
-    recipe_json = json.loads(response.text)
-    print(json.dumps(recipe_json, indent=2))
-except json.JSONDecodeError as e:
-    print("Error decoding JSON:", e)
-    print("Raw response:", response.text)
\ No newline at end of file
+
+
+def parse_recipe(text: str) -> dict:
+    """Parses the model's answer, tolerating a ```json fence and small syntax slips (see llm_json).
+
+    Raises:
+        json.JSONDecodeError: If the answer is not JSON.
+    """
+    return loads_lenient(text)
+
+
+def generate_recipe(ingredients: Iterable[str]) -> dict:
+    """Generates a recipe for the ingredients with a blocking Gemini call."""
+    response = get_client().models.generate_content(model=recipe_model,
+                                                    contents=[build_recipe_prompt(ingredients)])
+    return parse_recipe(response.text)
+
+
+async def generate_recipe_async(ingredients: Iterable[str]) -> dict:
+    """Async variant of generate_recipe."""
+    response = await get_client().aio.models.generate_content(model=recipe_model,
+                                                              contents=[build_recipe_prompt(ingredients)])
+    return parse_recipe(response.text)
+
+
+class RecipeCache:
+    """
+    Generated recipes keyed by canonical ingredient set, with LRU and TTL eviction.
+
+    A lookup first tries the exact set. Failing that it can serve the recipe
+    of the largest cached set that is a subset of the requested one, since
+    every ingredient that recipe needs is available. Concurrent requests for
+    the same set share one generation.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl: Optional[float] = 86400, min_subset: int = 2):
+        self.recipes = LRUCache(max_entries, ttl)
+        self.min_subset = min_subset
+        self.subset_hits = 0
+        self._sets: dict[str, frozenset] = {}
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key(canonical: tuple[str, ...]) -> str:
+        return "|".join(canonical)
+
+    def find_subset(self, canonical: tuple[str, ...]) -> Optional[tuple[str, dict]]:
+        """The cached (key, recipe) whose ingredients are the largest subset of canonical, if any."""
+        wanted = frozenset(canonical)
+        best_key, best_size = None, self.min_subset - 1
+        for key, ingredients in list(self._sets.items()):
+            if len(ingredients) > best_size and ingredients <= wanted:
+                if self.recipes.peek(key) is None:  # Evicted or expired
+                    del self._sets[key]
+                    continue
+                best_key, best_size = key, len(ingredients)
+        if best_key is None:
+            return None
+        return best_key, self.recipes.peek(best_key)
+
+    async def get_or_generate(self, ingredients: Iterable[str], allow_subset: bool = True,
+                              generate=generate_recipe_async) -> dict:
+        """
+        Returns {"recipe", "ingredients", "source"} where source is "exact",
+        "subset", "coalesced" (joined an identical in-flight generation) or
+        "generated". ingredients is the canonical set the recipe was made for.
+
+        Raises:
+            ValueError: If no ingredients are given.
+        """
+        names = prompt_ingredients(ingredients)
+        canonical = tuple(sorted(names))
+        if not canonical:
+            raise ValueError("No ingredients given")
+        key = self.key(canonical)
+
+        recipe = self.recipes.get(key)
+        if recipe is not None:
+            return {"recipe": recipe, "ingredients": list(canonical), "source": "exact"}
+        if allow_subset:
+            found = self.find_subset(canonical)
+            if found is not None:
+                self.subset_hits += 1
+                subset_key, recipe = found
+                return {"recipe": recipe, "ingredients": subset_key.split("|"), "source": "subset"}
+
+        if key in self._in_flight:
+            recipe = await asyncio.shield(self._in_flight[key])
+            return {"recipe": recipe, "ingredients": list(canonical), "source": "coalesced"}
+
+        future = asyncio.ensure_future(generate(list(names.values())))
+        self._in_flight[key] = future
+        # Stored by the generation itself, so it is cached even if this requester is cancelled meanwhile.
+        future.add_done_callback(lambda done: self._store(key, canonical, done))
+        recipe = await asyncio.shield(future)
+        return {"recipe": recipe, "ingredients": list(canonical), "source": "generated"}
+
+    def _store(self, key: str, canonical: tuple[str, ...], done: asyncio.Future) -> None:
+        """Caches a finished generation and ends its in-flight entry."""
+        if self._in_flight.get(key) is done:
+            del self._in_flight[key]
+        if done.cancelled() or done.exception() is not None:
+            return
+        self.recipes.set(key, done.result())
+        self._sets[key] = frozenset(canonical)
+        if len(self._sets) > self.recipes.max_entries:
+            # Forget the sets of recipes the cache has evicted or let expire.
+            self._sets = {key: ingredients for key, ingredients in self._sets.items()
+                          if self.recipes.peek(key) is not None}
+
+    def stats(self) -> dict:
+        return {**self.recipes.stats(), "subset_hits": self.subset_hits, "in_flight": len(self._in_flight)}
+
+
+if __name__ == "__main__":
+    '''This part can be where when the user check boxes the ingredients
+    and then presses "generate" it will add all the ingredients they checked
+    to this list of ingredients. '''
+    # Define the list of ingredients
+    ingredients = ["potato", "porkchops", "garlic salt", "onion"]
+
+    try:
+        print(json.dumps(generate_recipe(ingredients), indent=2))
+    except json.JSONDecodeError as e:
+        print("Error decoding JSON:", e)
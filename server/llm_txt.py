@@ -1,25 +1,79 @@
+import httpx
 import requests
-import json
+import llm_client
+from llm_json import compile_schema
+import os
 import argparse
 
-def send_text_prompt(user_input, bearer_token, api_url, static_prompt):
+# Schema of one list compare answer.
+LIST_COMPARE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items_for_removal": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "matched_items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name_on_list": {"type": "string"},
+                    "name_on_receipt": {"type": "string"}
+                }
+            }
+        }
+    },
+    "required": ["items_for_removal", "matched_items"]
+}
+
+# Validates and coerces a list compare answer (see llm_json). matched_items is only
+# informational, so an answer without it is still used.
+validate_list_compare = compile_schema(
+    LIST_COMPARE_SCHEMA,
+    aliases={"items_matched": "matched_items", "matches": "matched_items", "remove": "items_for_removal",
+             "items_to_remove": "items_for_removal"},
+    defaults={"matched_items": []},
+)
+
+
+# Model named in the payload; a backend configured with a model in LLM_BACKENDS overrides it.
+text_model = os.environ.get("LLM_TEXT_MODEL", "gemini-2.0-pro-exp-02-05")
+
+def list_compare_batch_schema(job_ids):
     """
-    Sends a text prompt to the specified API endpoint and processes the response.
+    Schema of a batched list compare answer: one list compare object per job ID.
 
     Args:
-    user_input: The user's input string.
-    bearer_token: The Bearer token for authorization.
-    api_url: The API endpoint URL.
-    static_prompt: The static prompt to prepend.
+    job_ids: The IDs of the jobs in the batch.
 
     Returns:
-    The text response from the API, or None if an error occurs.
+    The JSON schema as a dict.
     """
-    full_prompt = f"{static_prompt} {user_input}"
+    return {
+        "type": "object",
+        "properties": {job_id: LIST_COMPARE_SCHEMA for job_id in job_ids},
+        "required": list(job_ids)
+    }
+
+
+def build_text_payload(full_prompt, schema_name="list_compare", schema=LIST_COMPARE_SCHEMA):
+    """
+    Builds the chat completion payload for a list compare prompt.
 
+    Args:
+    full_prompt: The complete prompt text.
+    schema_name: Name of the response schema.
+    schema: JSON schema the response must follow.
+
+    Returns:
+    The request payload as a dict.
+    """
     payload = {
         "stream": False,
-        "model": "gemini-2.0-pro-exp-02-05",  # Or gpt-4o
+        "model": text_model,  # Or gpt-4o
         "messages": [
             {
                 "role": "user",
@@ -34,38 +88,32 @@ def send_text_prompt(user_input, bearer_token, api_url, static_prompt):
         "response_format": {  # require json schema compliant response
             "type": "json_schema",
             "json_schema": {
-                "name": "list_compare",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "items_for_removal": {
-                            "type": "array",
-                            "items": {
-                                "type": "string"
-                            }
-                        },
-                        "matched_items": {
-                            "type": "array",
-                            "items": {
-                                "name_on_list": {"type": "string"},
-                                "name_on_receipt": {"type": "string"}
-                            }
-                        }
-                    },
-                    "required": ["items_for_removal", "items_matched"]
-                }
+                "name": schema_name,
+                "schema": schema
             }
         }
     }
+    return payload
 
-    headers = {
-        "Authorization": f"Bearer {bearer_token}",
-        "Content-Type": "application/json"
-    }
+def send_text_prompt(user_input, bearer_token, api_url, static_prompt):
+    """
+    Sends a text prompt to the specified API endpoint and processes the response.
+
+    Args:
+    user_input: The user's input string.
+    bearer_token: The Bearer token for authorization.
+    api_url: The API endpoint URL.
+    static_prompt: The static prompt to prepend.
+
+    Returns:
+    The text response from the API, or None if an error occurs.
+    """
+    full_prompt = f"{static_prompt} {user_input}"
+
+    payload = build_text_payload(full_prompt)
 
     try:
-        response = requests.post(api_url, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        response = llm_client.post_json_sync(api_url, payload, bearer_token, call_type="text")  # Raises HTTPError for 4xx or 5xx
         json_response = response.json()
 
         # Extract the content, handling potential variations
@@ -73,13 +121,50 @@ def send_text_prompt(user_input, bearer_token, api_url, static_prompt):
         return content
 
     except requests.exceptions.RequestException as e:
+        response = e.response
         print(f"Error during API request: {e}")
-        print(f"Response status code: {response.status_code if 'response' in locals() else 'N/A'}")
+        print(f"Response status code: {response.status_code if response is not None else 'N/A'}")
         try:
-            print(f"Response content: {response.text if 'response' in locals() else 'N/A'}")
+            print(f"Response content: {response.text if response is not None else 'N/A'}")
         except:
             print("Could not decode response text")
         return None
     except Exception as e:
         print(f"Response error: {e}")
         return None
+
+
+async def send_text_prompt_async(user_input, bearer_token, api_url, static_prompt, timeout=None,
+                                 schema_name="list_compare", schema=LIST_COMPARE_SCHEMA):
+    """
+    Async variant of send_text_prompt that does not block the event loop.
+
+    Args:
+    user_input: The user's input string.
+    bearer_token: The Bearer token for authorization.
+    api_url: The API endpoint URL.
+    static_prompt: The static prompt to prepend.
+    timeout: Read timeout in seconds (defaults to LLM_READ_TIMEOUT).
+    schema_name: Name of the response schema.
+    schema: JSON schema the response must follow (defaults to a single list compare answer).
+
+    Returns:
+    The text response from the API, or None if an error occurs.
+    """
+    full_prompt = f"{static_prompt} {user_input}"
+    payload = build_text_payload(full_prompt, schema_name, schema)
+
+    try:
+        json_response = await llm_client.post_json(api_url, payload, bearer_token, timeout, call_type="text")
+        return json_response.get('choices', [{}])[0].get('message', {}).get('content', None)
+    except httpx.HTTPStatusError as e:
+        print(f"Error during API request: {e}")
+        print(f"Response status code: {e.response.status_code}")
+        print(f"Response content: {e.response.text}")
+        return None
+    except httpx.HTTPError as e:
+        print(f"Error during API request: {e}")
+        return None
+    except Exception as e:
+        print(f"Response error: {e}")
+        return None
@@ -0,0 +1,178 @@
+"""Local OCR pre-pass for cropped receipts (OCR_LOCAL=1).
+
+Receipts are printed in a few fonts on a plain background, which a local OCR
+engine reads well once the document has been cropped and flattened. The
+text lines are then turned into the receipt extraction JSON by a local
+parser (for the common "NAME ... PRICE" layout whose items add up to the
+total) or by a cheap text-only LLM call, and the vision model is only used
+when the local read is not confident.
+
+Needs pytesseract and the tesseract binary. Without them read_receipt
+reports itself unavailable and every receipt goes to the vision model.
+"""
+import re
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from matcher import normalize_tokens
+
+
+def segment_lines(gray: np.ndarray, min_height: int = 6, max_gap: int = 2) -> list[tuple[int, int]]:
+    """Finds the (top, bottom) row ranges of the printed lines of a flattened receipt.
+
+    Rows with clearly more ink than the blank rows count as text; runs of them
+    separated by at most `max_gap` blank rows form one line. The blank level
+    is measured rather than assumed to be zero, since paper edges and
+    background slivers left by the crop put some ink on every row.
+    """
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    row_ink = (ink > 0).mean(axis=1)
+    blank, busy = np.percentile(row_ink, 20), np.percentile(row_ink, 95)
+    if busy - blank < 0.02:
+        return []
+    is_text = row_ink > blank + 0.2 * (busy - blank)
+
+    lines, top, gap = [], None, 0
+    for row, text in enumerate(is_text):
+        if text:
+            top = row if top is None else top
+            gap = 0
+        elif top is not None:
+            gap += 1
+            if gap > max_gap:
+                lines.append((top, row - gap + 1))
+                top, gap = None, 0
+    if top is not None:
+        lines.append((top, len(is_text) - gap))
+    return [(top, bottom) for top, bottom in lines if bottom - top >= min_height]
+
+
+def stack_lines(gray: np.ndarray, lines: list[tuple[int, int]], pad: int = 4) -> np.ndarray:
+    """Rebuilds the receipt from its text lines only, on white paper with even gaps.
+
+    Creases, shadows and stains between lines are dropped, and the OCR engine
+    sees one clean block of text.
+    """
+    strips = [gray[max(0, top - pad):bottom + pad] for top, bottom in lines]
+    gap = np.full((2 * pad, gray.shape[1]), 255, dtype=np.uint8)
+    parts = [gap]
+    for strip in strips:
+        parts += [strip, gap]
+    return np.vstack(parts)
+
+
+def read_receipt(image_bytes: bytes, language: str = "eng") -> dict:
+    """
+    OCRs an encoded, cropped receipt image.
+
+    Runs in the crop executor, so it only takes and returns picklable values.
+
+    Returns:
+        {"available": bool, "lines": [str], "confidence": mean word
+        confidence 0-100, "segments": number of printed lines found}.
+    """
+    try:
+        import pytesseract
+    except ImportError:
+        return {"available": False, "lines": [], "confidence": 0.0, "segments": 0}
+
+    gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return {"available": True, "lines": [], "confidence": 0.0, "segments": 0}
+    segments = segment_lines(gray)
+    if not segments:
+        return {"available": True, "lines": [], "confidence": 0.0, "segments": 0}
+
+    try:
+        data = pytesseract.image_to_data(stack_lines(gray, segments), lang=language, config="--psm 6",
+                                         output_type=pytesseract.Output.DICT)
+    except pytesseract.TesseractNotFoundError:
+        return {"available": False, "lines": [], "confidence": 0.0, "segments": len(segments)}
+
+    words: dict[tuple[int, int, int], list[str]] = {}
+    confidence, weight = 0.0, 0
+    for i, text in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if not text.strip() or conf < 0:
+            continue
+        words.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(text)
+        confidence += conf * len(text)
+        weight += len(text)
+    return {"available": True, "lines": [" ".join(line) for line in words.values()],
+            "confidence": confidence / weight if weight else 0.0, "segments": len(segments)}
+
+
+def is_usable(result: dict, min_confidence: float = 80, min_coverage: float = 0.8) -> bool:
+    """Whether a local read can replace the vision call.
+
+    The mean word confidence must be high enough, and the engine must have
+    returned text for most of the printed lines found by segmentation, so
+    faint or skipped lines send the receipt to vision.
+    """
+    return (result.get("available", False) and result.get("segments", 0) >= 3
+            and result.get("confidence", 0.0) >= min_confidence
+            and len(result.get("lines", [])) >= min_coverage * result["segments"])
+
+
+PRICE = r"-?\d+[.,]\d{2}"
+ITEM_LINE = re.compile(rf"^(?P<name>[A-Za-z][\w /&'%.#-]*?)\s+(?P<price>{PRICE})(?:\s+[A-Z]{{1,2}})?$")
+TOTAL_LINE = re.compile(rf"^(?:GRAND\s+)?TOTAL\b\D*(?P<total>{PRICE})", re.IGNORECASE)
+TAX_LINE = re.compile(rf"\bTAX\b\D*(?P<tax>{PRICE})", re.IGNORECASE)
+DATE = re.compile(r"\b(\d{1,2}/\d{1,2}/\d{2,4}|\d{4}-\d{2}-\d{2})\b")
+# Lines with a price that are not items.
+NOT_ITEMS = re.compile(r"\b(SUB\s*TOTAL|SUBTOTAL|CHANGE|CASH|VISA|MASTERCARD|DEBIT|CREDIT|TEND|BALANCE|SAVINGS)\b",
+                       re.IGNORECASE)
+
+
+def parse_price(text: str) -> float:
+    return float(text.replace(",", "."))
+
+
+def friendly_name(name: str) -> str:
+    """Expands receipt abbreviations into a readable name, e.g. "GV WHL MILK" -> "Whole Milk"."""
+    return " ".join(normalize_tokens(name)).title() or name.title()
+
+
+def parse_receipt_lines(lines: list[str]) -> Optional[dict]:
+    """
+    Parses receipt text in the common one-item-per-line layout without an LLM.
+
+    The parse is only trusted when the item prices plus tax add up to the
+    printed total, which also catches misread digits.
+
+    Returns:
+        A receipt extraction dict ({"receipts": [...]}), or None when the
+        text does not follow the layout or does not add up.
+    """
+    store, address, date, total, tax, items = None, "Not Found", "Not Found", None, 0.0, []
+    for line in (line.strip() for line in lines):
+        if not line:
+            continue
+        if date == "Not Found" and (match := DATE.search(line)):
+            date = match.group(1)
+        if (match := TOTAL_LINE.match(line)):
+            total = parse_price(match.group("total"))
+            break
+        if (match := TAX_LINE.search(line)):
+            tax += parse_price(match.group("tax"))
+            continue
+        if NOT_ITEMS.search(line):
+            continue
+        if (match := ITEM_LINE.match(line)):
+            if store is None:
+                return None  # Layout without a store line first is not one we know
+            name, price = match.group("name").strip(), parse_price(match.group("price"))
+            items.append({"category": "Not Found", "name": name, "friendly_name": friendly_name(name),
+                          "quantity": 1, "price": price, "unit_price": f"{price:.2f}", "unit": "ea",
+                          "upc": "Not Found"})
+        elif store is None:
+            store = line
+        elif address == "Not Found" and not items and not DATE.search(line):
+            address = line
+
+    if not items or total is None or abs(sum(item["price"] for item in items) + tax - total) > 0.011:
+        return None
+    return {"receipts": [{"Store": store, "Address": address, "Date": date, "numItems": len(items),
+                          "totalCost": total, "items": items}]}
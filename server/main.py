@@ -1,129 +1,921 @@
-from llm_ocr import send_receipt_image
-from crop import process_and_save_image
-from llm_txt import send_text_prompt
+from llm_ocr import (send_receipt_image_bytes_async, send_receipt_image_bytes_stream_async, send_receipt_text_async,
+                     validate_receipt)
+from crop import detect_document_bytes
+from crop_pool import SharedMemoryCropPool, init_worker, opencv_threads_per_worker
+from encode import encode_for_ocr
+import local_ocr
+from cache import ListCompareMemo, make_cache, parse_reference_list
+from matcher import ReceiptIndex, match_list
+from llm_recipe import RecipeCache
+from strips import merge_strip_receipts
+from jobs import JobQueue, QueueFullError
+from history import HistoryStore
+import llm_client
+import metrics
+from llm_txt import list_compare_batch_schema, send_text_prompt_async, validate_list_compare
+from llm_json import SchemaError, loads_lenient, parse_answer
+from batcher import MicroBatcher
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
-from typing import List
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Callable, List, Optional
+import asyncio
+import hashlib
+import hmac
 import json
 import os
-import shutil
 import time
 
-app = FastAPI()
-
 bearer_token = os.environ.get("BEARER_TOKEN", "NULLAPIKEY") # Set the BEARER_TOKEN variable in env
 api_url = os.environ.get("API_URL", "http://localhost:11434/v1/chat/completions")
 
+# Cropping is CPU bound (OpenCV + GrabCut), so it runs off the event loop.
+# CROP_EXECUTOR is "process" (default), "shm" (processes, with uploads and crops
+# passed through CROP_SHM_SLOTS shared memory slots of CROP_SHM_SLOT_MB each
+# instead of pickled) or "thread"; CROP_WORKERS sizes the pool.
+crop_executor_kind = os.environ.get("CROP_EXECUTOR", "process")
+crop_workers = int(os.environ.get("CROP_WORKERS", os.cpu_count() or 1))
+crop_shm_slots = int(os.environ.get("CROP_SHM_SLOTS", 0)) or None
+crop_shm_slot_bytes = int(float(os.environ.get("CROP_SHM_SLOT_MB", 16)) * 2**20)
+crop_executor: Executor = None
+crop_pool: SharedMemoryCropPool = None
+
+# Coarse-to-fine cropping: find the page on a CROP_PROXY_DIM px proxy (0 = off)
+# and optionally refine the corners at working resolution (CROP_REFINE=1).
+crop_proxy_dim = int(os.environ.get("CROP_PROXY_DIM", 0)) or None
+crop_refine = os.environ.get("CROP_REFINE", "0") == "1"
+
+# Confidence needed to accept the cheap edge-based quad and skip GrabCut ("off" disables the fast path).
+crop_fast_threshold = None if os.environ.get("CROP_FAST_THRESHOLD") == "off" else float(os.environ.get("CROP_FAST_THRESHOLD", 0.6))
+
+# How often each detection stage produced the crop, to track the fast path hit rate.
+crop_stage_counts = Counter()
+
+# Encoding of the crop sent to the vision model. OCR_ENCODE is "gray" (default),
+# "clahe", "binary", "color" or "off" (plain JPEG as before). The long side is
+# capped at OCR_MAX_DIM px unless text lines would end up closer than OCR_MIN_LINE_PX,
+# and JPEG quality is tuned to fit OCR_BYTE_BUDGET bytes (0 = no target).
+ocr_encode_mode = os.environ.get("OCR_ENCODE", "gray")
+ocr_encoder = None if ocr_encode_mode == "off" else partial(
+    encode_for_ocr,
+    mode=ocr_encode_mode,
+    max_dim=int(os.environ.get("OCR_MAX_DIM", 2048)) or None,
+    byte_budget=int(os.environ.get("OCR_BYTE_BUDGET", 300_000)) or None,
+    min_line_px=int(os.environ.get("OCR_MIN_LINE_PX", 20)),
+)
+
+# Crops taller than OCR_STRIP_ASPECT times their width are OCR'd as overlapping
+# bands in parallel and the results merged (0 = always send the whole crop).
+ocr_strip_aspect = float(os.environ.get("OCR_STRIP_ASPECT", 2.5)) or None
+
+# Bytes of image sent to the vision model, and for how many receipts.
+ocr_bytes_sent = Counter()
+
+# Parsed OCR results keyed by upload hash (and crop perceptual hash).
+# OCR_CACHE is "memory" (default), "sqlite" or "off".
+ocr_cache = make_cache(
+    os.environ.get("OCR_CACHE", "memory"),
+    max_entries=int(os.environ.get("OCR_CACHE_SIZE", 256)),
+    ttl=float(os.environ.get("OCR_CACHE_TTL", 86400)),
+    path=os.environ.get("OCR_CACHE_PATH", "ocr_cache.sqlite3"),
+)
+# OCR_CACHE_PHASH=1 also keys results by the crop's perceptual hash, per user_id
+# only: receipts with the same layout can share a hash, so a hit across users
+# could answer with somebody else's receipt. Off by default.
+ocr_cache_phash = os.environ.get("OCR_CACHE_PHASH", "0") == "1"
+
+# Stream the vision answer and parse receipt items as they arrive (OCR_STREAM=1).
+ocr_stream = os.environ.get("OCR_STREAM", "0") == "1"
+
+# Read the cropped receipt with local OCR first (OCR_LOCAL=1, needs pytesseract).
+# Confident reads (OCR_LOCAL_MIN_CONF, 0-100) are parsed locally if they
+# follow the common layout (OCR_LOCAL_PARSER=1), else structured by a
+# text-only LLM call; the rest still go to the vision model.
+ocr_local = os.environ.get("OCR_LOCAL", "0") == "1"
+ocr_local_min_conf = float(os.environ.get("OCR_LOCAL_MIN_CONF", 80))
+ocr_local_parser = os.environ.get("OCR_LOCAL_PARSER", "1") == "1"
+ocr_local_lang = os.environ.get("OCR_LOCAL_LANG", "eng")
+# How receipts were read: "local_parser", "text_llm" or "vision".
+ocr_paths = Counter()
+
+# Per-entry memo of list compare answers, so an edited list only re-asks about changed entries.
+list_memo = ListCompareMemo(
+    max_receipts=int(os.environ.get("LIST_MEMO_SIZE", 512)),
+    ttl=float(os.environ.get("LIST_MEMO_TTL", 3600)),
+) if os.environ.get("LIST_MEMO", "1") == "1" else None
+
+# Local fuzzy matching of list entries against receipt items. Entries scoring at
+# least MATCH_ACCEPT are removed, below MATCH_REJECT kept; only those in between go to the LLM.
+local_matcher = os.environ.get("LOCAL_MATCHER", "1") == "1"
+match_accept = float(os.environ.get("MATCH_ACCEPT", 0.85))
+match_reject = float(os.environ.get("MATCH_REJECT", 0.35))
+
+# Upper bound on files of a single request that are processed at the same time.
+file_concurrency = int(os.environ.get("FILE_CONCURRENCY", 4))
+
+# List compare calls arriving within LIST_BATCH_WINDOW_MS of each other (up to
+# LIST_BATCH_MAX) are sent as one LLM request (LIST_BATCH_WINDOW_MS=0 disables).
+list_batch_window = float(os.environ.get("LIST_BATCH_WINDOW_MS", 30)) / 1000
+list_compare_batcher = MicroBatcher(
+    send_one=lambda *args: compare_with_list_single(*args),
+    send_batch=lambda jobs: compare_with_list_batch(jobs),
+    window=list_batch_window,
+    max_batch=int(os.environ.get("LIST_BATCH_MAX", 8)),
+) if list_batch_window > 0 else None
+
+# Generated recipes by canonical ingredient set. RECIPE_SUBSET=0 disables
+# serving a cached recipe made from a subset of the requested ingredients.
+recipe_cache = RecipeCache(
+    max_entries=int(os.environ.get("RECIPE_CACHE_SIZE", 128)),
+    ttl=float(os.environ.get("RECIPE_CACHE_TTL", 86400)),
+)
+recipe_subset = os.environ.get("RECIPE_SUBSET", "1") == "1"
+
+# Add a Server-Timing header with per-stage durations to responses (SERVER_TIMING=1).
+server_timing = os.environ.get("SERVER_TIMING", "0") == "1"
+
+# Asynchronous job API: JOB_WORKERS jobs run at once, JOB_QUEUE_SIZE may wait,
+# and finished results are kept for JOB_TTL seconds.
+job_queue: JobQueue = None
+job_workers = int(os.environ.get("JOB_WORKERS", 4))
+job_queue_size = int(os.environ.get("JOB_QUEUE_SIZE", 64))
+job_ttl = float(os.environ.get("JOB_TTL", 3600))
+job_retry_after = int(os.environ.get("JOB_RETRY_AFTER", 5))
+
+# Receipt history and versioned shopping lists per user_id, in a SQLite file
+# (HISTORY_DB, off unless set). Requests without a user_id are not stored.
+# A user_id is not a secret, so with HISTORY_TOKEN set the /lists and /history
+# routes also require "Authorization: Bearer <HISTORY_TOKEN>".
+history_db = os.environ.get("HISTORY_DB", "")
+history = HistoryStore(history_db) if history_db else None
+history_token = os.environ.get("HISTORY_TOKEN", "")
+
+
+def make_crop_executor(kind: str, workers: int) -> Executor:
+    """Creates the worker pool used for the CPU heavy image stages."""
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crop")
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(opencv_threads_per_worker(workers),))
+    raise ValueError(f"Unknown CROP_EXECUTOR '{kind}', expected 'process', 'shm' or 'thread'")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global crop_executor, crop_pool, job_queue
+    if crop_executor_kind == "shm":
+        crop_pool = SharedMemoryCropPool(crop_workers, slots=crop_shm_slots, slot_bytes=crop_shm_slot_bytes)
+        crop_executor = crop_pool.executor
+    else:
+        crop_executor = make_crop_executor(crop_executor_kind, crop_workers)
+    job_queue = JobQueue(process_batch, workers=job_workers, max_queued=job_queue_size, ttl=job_ttl)
+    await job_queue.start()
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        if crop_pool is not None:
+            crop_pool.shutdown()
+        else:
+            crop_executor.shutdown(wait=False, cancel_futures=True)
+        await llm_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def collect_timings(request: Request, call_next):
+    """
+    Collects the stage timings recorded while handling the request and, if
+    SERVER_TIMING is on, returns them as a Server-Timing header. Stages run
+    for several files of one request are summed.
+    """
+    timings = {}
+    token = metrics.request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_timings.reset(token)
+    if server_timing:
+        timings["total"] = time.perf_counter() - started
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return response
+
+
+async def run_crop(func, *args):
+    """Runs a blocking image function on the crop pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crop_executor, func, *args)
+
+
+async def compare_with_list(purchase_data_str: str, reference_list: str, filename: str) -> Optional[dict]:
+    """Asks the text LLM which reference list entries the purchase data covers.
+
+    Concurrent calls are batched into one LLM request when list_compare_batcher is enabled.
+    Returns None if no usable answer came back.
+    """
+    if list_compare_batcher is not None:
+        return await list_compare_batcher.submit(purchase_data_str, reference_list, filename)
+    return await compare_with_list_single(purchase_data_str, reference_list, filename)
+
+
+async def compare_with_list_batch(jobs: dict[str, tuple[str, str, str]]) -> dict[str, dict]:
+    """
+    Sends several list compare jobs as one multi-task prompt.
+
+    Args:
+        jobs: (purchase_data_str, reference_list, filename) by job ID.
+
+    Returns:
+        The answer for each job ID that came back well formed and only names
+        entries of that job's own list. Jobs missing from the result (for
+        instance because the model mixed up the tasks) are retried on their
+        own by the batcher.
+    """
+    tasks = "\n".join(
+        f"Task {job_id}:\nReference shopping list: {reference_list}\nPurchase data:\n{purchase_data_str}\n"
+        for job_id, (purchase_data_str, reference_list, _) in jobs.items()
+    )
+    batch_prompt = f"""
+You are a shopping list analyzer. Below are several independent tasks, each with a reference shopping list and purchase data (extracted from a receipt).
+For each task, decide which 'items' may be removed from its list since they have now been purchased. The names of items must be inferred from the purchase data and the reference list. Only return items you are confident are in the purchase data.
+Respond with a JSON object keyed by task id, where each value is like {{'items_for_removal': list[str], 'matched_items': list}}, matched_items listing each item you think should be removed and the entry on the reciept that you matched to it. Here are the tasks:\n{tasks}
+"""
+    llm_response = await send_text_prompt_async("", bearer_token, api_url, batch_prompt,
+                                                schema_name="list_compare_batch",
+                                                schema=list_compare_batch_schema(list(jobs)))
+    if not llm_response:
+        return {}
+    try:
+        answers = loads_lenient(llm_response)
+    except json.JSONDecodeError as e:
+        print(f"Error parsing batched LLM response: {e}")
+        return {}
+    if not isinstance(answers, dict):
+        return {}
+    results = {}
+    for job_id, answer in answers.items():
+        if job_id in jobs:
+            try:
+                answer = validate_list_compare(answer)
+            except SchemaError as e:
+                print(f"Invalid answer for batched job {job_id}: {e}")
+                continue
+            if ListCompareMemo.decisions_from_result(parse_reference_list(jobs[job_id][1]), answer) is None:
+                print(f"Answer for batched job {job_id} names items not on its list")
+                continue
+            results[job_id] = answer
+    return results
+
+
+async def compare_with_list_single(purchase_data_str: str, reference_list: str, filename: str) -> Optional[dict]:
+    """
+    Asks the text LLM which reference list entries the purchase data covers.
+
+    Answers are repaired and coerced locally (see llm_json); only an answer
+    that cannot be fixed is asked again. Failed requests are retried by the
+    client, not here.
+
+    Returns:
+        The validated answer, or None if no usable answer came back. Callers
+        must not memoize None as "nothing bought".
+    """
+    item_list_prompt = f"""
+You are a shopping list analyzer. Respond with a JSON list like {{'items_for_removal': list[str]}} of 'items' which may be removed from the list since they have now been purchased based on the following purchase data (extracted from a receipt).
+You are also provided with a reference shopping list: {reference_list}
+The names of items must be inferred from the purchase data and the reference list. Only return items you are confident are in the purchase data. Also respond with a json list matched_items of each item you think should be removed and the entry on the reciept that you matched to it. Here is the purchase \n{purchase_data_str}
+"""
+    max_retries = 3
+    items_to_remove = None
+    for attempt in range(max_retries):
+        llm_response = await send_text_prompt_async("", bearer_token, api_url, item_list_prompt)
+        if not llm_response:
+            # The client already retried the request (see resilience)
+            raise HTTPException(status_code=500, detail=f"LLM processing failed for {filename}")
+
+        try:
+            items_to_remove = parse_answer(llm_response, validate_list_compare)
+            break  # Success, exit retry loop
+        except SchemaError as e:
+            if attempt == max_retries - 1:
+                print(f"Unusable LLM response after multiple retries: {e}")
+                break  # No answer
+            print(f"Unusable LLM response (attempt {attempt + 1}): {e}, retrying...")
+            await asyncio.sleep(llm_client.policies["text"].backoff(attempt))
+        except json.JSONDecodeError as e:
+            if attempt == max_retries - 1:
+                print(f"Error parsing LLM response after multiple retries: {e}")
+                raise HTTPException(status_code=500,
+                                detail=f"Error parsing LLM response for {filename}.") from e
+            else:
+                print(f"Error parsing LLM response (attempt {attempt + 1}), retrying...")
+                await asyncio.sleep(llm_client.policies["text"].backoff(attempt))
+    return items_to_remove
+
+
+async def match_against_list(purchase_data_json: dict, purchase_data_str: str, reference_list: str, filename: str) -> dict:
+    """
+    Decides which reference list entries the receipt covers, asking the LLM as little as possible.
+
+    Entries with a decision in list_memo are reused. The local matcher then
+    settles the entries it is confident about. Only the remaining uncertain
+    entries go to the list compare LLM call.
+    """
+    entries = parse_reference_list(reference_list)
+    decisions, missing = list_memo.lookup(purchase_data_str, entries) if list_memo is not None else ({}, entries)
+
+    if missing and local_matcher:
+        purchase_items = [item for receipt in purchase_data_json.get('receipts', []) for item in receipt.get('items', [])]
+        with metrics.timer("match_local"):
+            local = match_list(missing, purchase_items, accept=match_accept, reject=match_reject)
+        resolved = [entry for entry in missing if entry not in local['uncertain']]
+        local_decisions = ListCompareMemo.decisions_from_result(resolved, local)
+        decisions.update(local_decisions)
+        if list_memo is not None:
+            list_memo.remember(purchase_data_str, local_decisions)
+        missing = local['uncertain']
+
+    if not missing:
+        return ListCompareMemo.assemble(entries, decisions)
+
+    result = await compare_with_list(purchase_data_str, ", ".join(missing), filename)
+    if result is None:
+        # No usable answer: remove nothing for the uncertain entries, and remember nothing about them.
+        return ListCompareMemo.assemble([entry for entry in entries if entry not in missing], decisions)
+    new_decisions = ListCompareMemo.decisions_from_result(missing, result)
+    if new_decisions is not None:
+        if list_memo is not None:
+            list_memo.remember(purchase_data_str, new_decisions)
+        return ListCompareMemo.assemble(entries, {**decisions, **new_decisions})
+
+    # The answer names items that are not on this list: never remove those from the user's list, and
+    # do not remember an answer that was partly about something else.
+    print(f"List compare answer for {filename} names items not on the list, dropping them")
+    new_decisions = ListCompareMemo.decisions_from_result(missing, result, drop_unknown=True)
+    return ListCompareMemo.assemble(entries, {**decisions, **new_decisions})
+
+
+def format_purchase_data(purchase_data_json: dict) -> str:
+    """Flattens the items of all receipts into the text used by the list compare prompt.
+
+    Raises:
+        KeyError: If an item lacks one of the required fields.
+    """
+    purchase_items = []
+    for receipt in purchase_data_json.get('receipts', []):
+        purchase_items.extend(receipt.get('items', []))
+    return "\n".join([f"{item['name']}[ {item['friendly_name']} ] (Qty: {item['quantity']}, Price: {item['price']}, Category: {item['category']})"
+                      for item in purchase_items])
+
+
+# Progress callback: called with an event name and its payload as each stage finishes.
+Emit = Optional[Callable[[str, dict], None]]
+
+
+async def ocr_image(filename: str, image_bytes: bytes, emit: Emit = None) -> dict:
+    """
+    Sends one encoded image to the vision model and returns the parsed receipt JSON.
+
+    Raises:
+        HTTPException: If the request fails or the answer is not JSON.
+    """
+    if ocr_stream:
+        on_item = (lambda item: emit("item", {"filename": filename, "item": item})) if emit else None
+        ocr_response = await send_receipt_image_bytes_stream_async(image_bytes, bearer_token, api_url, on_item)
+    else:
+        ocr_response = await send_receipt_image_bytes_async(image_bytes, bearer_token, api_url)
+    if not ocr_response:
+        raise HTTPException(status_code=500, detail=f"OCR processing failed for {filename}")
+
+    try:
+        purchase_data = ocr_response['choices'][0]['message']['content']
+        with metrics.timer("ocr_parse"):
+            return parse_answer(purchase_data, validate_receipt)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        print(f"Error extracting purchase  {e}")
+        raise HTTPException(status_code=500,
+                            detail=f"Error extracting purchase data from OCR result for {filename}")
+
+
+async def read_locally(filename: str, image_bytes: bytes) -> Optional[dict]:
+    """
+    Reads a cropped receipt with local OCR, returning the parsed receipt JSON
+    or None when the read is not good enough and vision is needed.
+    """
+    with metrics.timer("local_ocr"):
+        result = await run_crop(partial(local_ocr.read_receipt, language=ocr_local_lang), image_bytes)
+    if not local_ocr.is_usable(result, ocr_local_min_conf):
+        print(f"Local OCR not usable for {filename} (confidence {result['confidence']:.0f}, "
+              f"{len(result['lines'])}/{result['segments']} lines, available={result['available']})")
+        return None
+
+    if ocr_local_parser:
+        purchase_data_json = local_ocr.parse_receipt_lines(result["lines"])
+        if purchase_data_json is not None:
+            ocr_paths["local_parser"] += 1
+            return purchase_data_json
+
+    ocr_response = await send_receipt_text_async(result["lines"], bearer_token, api_url)
+    try:
+        purchase_data_json = parse_answer(ocr_response['choices'][0]['message']['content'], validate_receipt)
+        format_purchase_data(purchase_data_json)
+    except (TypeError, KeyError, IndexError, ValueError) as e:
+        print(f"Text-only extraction failed for {filename}, using vision: {e}")
+        return None
+    ocr_paths["text_llm"] += 1
+    return purchase_data_json
+
+
+async def extract_receipts(filename: str, contents: bytes, emit: Emit = None, user_id: Optional[str] = None) -> dict:
+    """
+    Crops the upload and OCRs it with the vision model, returning the parsed receipt JSON.
+
+    With OCR_LOCAL=1 the receipt is read locally first (see read_locally).
+    Tall receipts are OCR'd as overlapping bands in parallel and merged
+    (see OCR_STRIP_ASPECT). Results are cached under a hash of the uploaded bytes and, if enabled
+    and the request has a user_id, under that user's perceptual hash of the
+    crop. A re-upload of the same photo then skips both the crop and the
+    vision call, and a re-encoded copy of it skips the vision call.
+
+    Raises:
+        HTTPException: If cropping, OCR or parsing fails.
+    """
+    upload_key = f"sha256:{hashlib.sha256(contents).hexdigest()}"
+    if ocr_cache is not None:
+        cached = await asyncio.to_thread(ocr_cache.get, upload_key)  # May be on disk (OCR_CACHE=sqlite)
+        if cached is not None:
+            return cached
+
+    crop_started = time.perf_counter()
+    crop = partial(detect_document_bytes, proxy_dim=crop_proxy_dim, refine=crop_refine,
+                   fast_threshold=crop_fast_threshold, encoder=ocr_encoder, strip_aspect=ocr_strip_aspect)
+    if crop_pool is not None:
+        cropped_image, crop_info = await crop_pool.run(crop, contents)
+    else:
+        cropped_image, crop_info = await run_crop(crop, contents)
+    metrics.record_timing("crop", time.perf_counter() - crop_started)  # Executor queueing included
+    for stage, seconds in crop_info.get("timings", {}).items():
+        metrics.record_timing(f"crop_{stage}", seconds)
+    crop_stage_counts[crop_info.get("stage", "failed")] += 1
+    if emit:
+        emit("crop", {"filename": filename, "stage": crop_info.get("stage", "failed"),
+                      "bytes": crop_info.get("encode", {}).get("bytes")})
+    if not cropped_image:
+        raise HTTPException(status_code=500, detail=f"Image cropping failed for {filename}")
+
+    phash_key = (f"phash:{user_id}:{crop_info['phash']}"
+                 if ocr_cache_phash and user_id and "phash" in crop_info else None)
+    if ocr_cache is not None and phash_key:
+        cached = await asyncio.to_thread(ocr_cache.get, phash_key)
+        if cached is not None:
+            await asyncio.to_thread(ocr_cache.set, upload_key, cached)
+            return cached
+
+    purchase_data_json = await read_locally(filename, cropped_image) if ocr_local else None
+    if purchase_data_json is None:
+        images = crop_info.get("strips") or [cropped_image]
+        ocr_bytes_sent["bytes"] += sum(len(image) for image in images)
+        ocr_bytes_sent["receipts"] += 1
+        ocr_paths["vision"] += 1
+        if len(images) > 1:
+            # Bands of a tall receipt are read concurrently, so latency follows the band size.
+            results = await asyncio.gather(*(ocr_image(filename, image, emit) for image in images))
+            purchase_data_json = merge_strip_receipts(results)
+        else:
+            purchase_data_json = await ocr_image(filename, cropped_image, emit)
+
+    try:
+        format_purchase_data(purchase_data_json)  # Only cache results the rest of the pipeline can use
+    except KeyError as e:
+        print(f"Error extracting purchase  {e}")
+        raise HTTPException(status_code=500,
+                            detail=f"Error extracting purchase data from OCR result for {filename}")
+
+    if ocr_cache is not None:
+        await asyncio.to_thread(ocr_cache.set, upload_key, purchase_data_json)
+        if phash_key:
+            await asyncio.to_thread(ocr_cache.set, phash_key, purchase_data_json)
+    return purchase_data_json
+
+
+async def process_receipt(filename: str, contents: bytes, reference_list: str, emit: Emit = None,
+                          user_id: Optional[str] = None) -> dict:
+    """
+    Runs one receipt through crop, OCR and list compare, entirely in memory.
+
+    If `emit` is given it receives "crop" and "receipts" events as those
+    stages finish, so the parsed items can be shown before list compare is done.
+    With a `user_id` the receipts are saved to the history and the matched
+    entries are removed from the user's stored list ("list_version" in the result).
+
+    Raises:
+        HTTPException: If any stage fails for this file.
+    """
+    purchase_data_json = await extract_receipts(filename, contents, emit, user_id)
+    purchase_data_str = format_purchase_data(purchase_data_json)
+    if emit:
+        emit("receipts", {"filename": filename, "receipts": purchase_data_json.get('receipts', [])})
+
+    items_to_remove = await match_against_list(purchase_data_json, purchase_data_str, reference_list, filename)
+
+    # Merge the responses, correctly combining with the potentially multiple receipts.
+    combined_response = {} # Initialize empty dict
+    if 'receipts' in purchase_data_json:
+      combined_response['receipts'] = purchase_data_json['receipts']
+    else:
+      combined_response['receipts'] = []
+
+    combined_response['items_for_removal'] = items_to_remove.get('items_for_removal', []) # Get 'items', defaulting to [].
+    combined_response['matched_items'] = items_to_remove.get('matched_items', [])
+    if history is not None and user_id:
+        combined_response['list_version'] = await save_history(user_id, contents, purchase_data_json,
+                                                               combined_response['items_for_removal'])
+    return combined_response
+
+
+async def save_history(user_id: str, contents: bytes, purchase_data_json: dict, items_for_removal: list[str]) -> int:
+    """Stores the receipts and removes the bought entries from the user's list, returning the new list version."""
+    upload_hash = hashlib.sha256(contents).hexdigest()
+    with metrics.timer("history"):
+        await asyncio.to_thread(history.add_receipts, user_id, purchase_data_json, upload_hash)
+        changes = await asyncio.to_thread(history.apply_delta, user_id, 0, remove=items_for_removal)
+    return changes["version"]
+
+
+async def resolve_reference_list(request: Request, reference_list: Optional[str], user_id: Optional[str]) -> str:
+    """
+    Returns the reference list sent with the request, or the user's stored list if none was sent.
+
+    Raises:
+        HTTPException: If there is neither, or the request has a user_id
+            without the history token (see HISTORY_TOKEN).
+    """
+    if history is not None and user_id:
+        check_history_token(request)  # The upload reads and updates the user's stored list
+    if reference_list is not None:
+        return reference_list
+    if history is not None and user_id:
+        _, entries = await asyncio.to_thread(history.list_entries, user_id)
+        return ", ".join(entries)
+    raise HTTPException(status_code=422, detail="reference_list is required without a stored list (user_id)")
+
+
+async def process_batch(uploads: list[tuple[str, bytes]], reference_list: str, user_id: Optional[str] = None) -> dict:
+    """
+    Processes (filename, contents) uploads concurrently and builds the response body.
+
+    Files are processed at most FILE_CONCURRENCY at a time. A single file's
+    result is returned directly. With several files, results are wrapped in
+    "responses" in upload order, and a file that fails gets an
+    {"filename": ..., "error": ...} entry in its slot instead of failing the
+    whole batch.
+
+    Raises:
+        HTTPException: If the only file of a single-file batch fails.
+    """
+    semaphore = asyncio.Semaphore(file_concurrency)
+
+    async def process_slot(filename: str, contents: bytes):
+        async with semaphore:
+            try:
+                result = await process_receipt(filename, contents, reference_list, user_id=user_id)
+            except Exception:
+                metrics.receipts.inc(outcome="error")
+                raise
+            metrics.receipts.inc(outcome="ok")
+            return result
+
+    # gather keeps the results in upload order regardless of completion order.
+    results = await asyncio.gather(*(process_slot(filename, contents) for filename, contents in uploads),
+                                   return_exceptions=True)
+
+    if len(results) == 1:  # If just a single file, return that response directly
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        print(results[0])
+        return results[0]  # No need for a wrapper
+
+    all_responses = []
+    for (filename, _), result in zip(uploads, results):
+        if isinstance(result, HTTPException):
+            all_responses.append({"filename": filename, "error": result.detail})
+        elif isinstance(result, Exception):
+            print(f"Unexpected error processing {filename}: {result}")
+            all_responses.append({"filename": filename, "error": f"Unexpected error processing {filename}"})
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            all_responses.append(result)
+    return {"responses": all_responses} #wrap in 'responses'
+
+
+async def read_uploads(files: List[UploadFile]) -> list[tuple[str, bytes]]:
+    with metrics.timer("upload"):
+        return [(file.filename, await file.read()) for file in files]
+
 
 @app.post("/process-images/")
-async def process_images(files: List[UploadFile] = File(...), reference_list: str = Form(...)):
+async def process_images(request: Request, files: List[UploadFile] = File(...),
+                         reference_list: Optional[str] = Form(None), user_id: Optional[str] = Form(None)):
     """
     Processes uploaded receipt images, extracts purchase data, and compares it
     with a reference shopping list to determine items that can be removed.
 
+    See process_batch for how multiple files are handled.
+
     Args:
         files: A list of uploaded image files (receipts).
         reference_list: A comma-separated string representing the reference shopping list.
+            May be left out with a user_id, to compare against the stored list.
+        user_id: Optional. Saves the receipts to this user's history and
+            removes the matched entries from their stored list (with HISTORY_DB
+            set; needs the HISTORY_TOKEN bearer token if that is set).
 
     Returns:
         A JSON response containing a list of items that can be removed from the
         shopping list. Returns an appropriate error message on failure.
     """
-    all_responses = []  # Store combined responses for each file
-    temp_dir = "temp_images"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    reference_list = await resolve_reference_list(request, reference_list, user_id)
+    return JSONResponse(content=await process_batch(await read_uploads(files), reference_list, user_id))
 
-    try:
-        for file in files:
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/process-images/stream")
+async def process_images_stream(request: Request, files: List[UploadFile] = File(...),
+                                reference_list: Optional[str] = Form(None), user_id: Optional[str] = Form(None)):
+    """
+    Streaming variant of /process-images/ using server-sent events.
+
+    Events, per file and in the order they happen:
+        crop: {"filename", "stage", "bytes"} once the document has been cropped
+            and encoded for OCR.
+        item: {"filename", "item", "matches"} for each receipt item while the
+            vision answer is still streaming (OCR_STREAM=1 only). "matches" are
+            the list entries the item covers by local matching, a preview of
+            the final result.
+        receipts: {"filename", "receipts"} as soon as OCR has been parsed.
+        result: {"filename", ...} the same body /process-images/ returns for one file.
+        error: {"filename", "error"} if the file failed.
+    A final "done" event carries {"files": <count>}.
+    """
+    reference_list = await resolve_reference_list(request, reference_list, user_id)
+    uploads = await read_uploads(files)
+    events: asyncio.Queue = asyncio.Queue()
+    entries = parse_reference_list(reference_list)
+
+    def emit(event: str, data: dict):
+        if event == "item":
+            index = ReceiptIndex([data["item"]])
+            data["matches"] = [entry for entry in entries if index.best_match(entry)[0] >= match_accept]
+        events.put_nowait((event, data))
+
+    semaphore = asyncio.Semaphore(file_concurrency)
+
+    async def process_slot(filename: str, contents: bytes):
+        async with semaphore:
             try:
-                temp_filepath = os.path.join(temp_dir, file.filename)
-                with open(temp_filepath, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-
-                cropped_image_path = process_and_save_image(temp_filepath, temp_dir)
-                if not cropped_image_path:
-                    raise HTTPException(status_code=500, detail=f"Image cropping failed for {file.filename}")
-
-                ocr_response = send_receipt_image(cropped_image_path, bearer_token, api_url)
-                if not ocr_response:
-                    raise HTTPException(status_code=500, detail=f"OCR processing failed for {file.filename}")
-
-                try:
-                    purchase_data = ocr_response['choices'][0]['message']['content']
-                    purchase_data_json = json.loads(purchase_data)
-                    purchase_items = []
-                    for receipt in purchase_data_json.get('receipts', []):
-                        purchase_items.extend(receipt.get('items', []))
-                    purchase_data_str = "\n".join([f"{item['name']}[ {item['friendly_name']} ] (Qty: {item['quantity']}, Price: {item['price']}, Category: {item['category']})"
-                                                   for item in purchase_items])
-                except (KeyError, IndexError, json.JSONDecodeError) as e:
-                    print(f"Error extracting purchase  {e}")
-                    raise HTTPException(status_code=500,
-                                        detail=f"Error extracting purchase data from OCR result for {file.filename}")
-
-                item_list_prompt = f"""
-You are a shopping list analyzer. Respond with a JSON list like {{'items_for_removal': list[str]}} of 'items' which may be removed from the list since they have now been purchased based on the following purchase data (extracted from a receipt).
-You are also provided with a reference shopping list: {reference_list}
-The names of items must be inferred from the purchase data and the reference list. Only return items you are confident are in the purchase data. Also respond with a json list matched_items of each item you think should be removed and the entry on the reciept that you matched to it. Here is the purchase \n{purchase_data_str}
-"""
-                max_retries = 3
-                items_to_remove = {"items": []}  # Initialize with empty list
-                for attempt in range(max_retries):
-                    llm_response = send_text_prompt("", bearer_token, api_url, item_list_prompt)
-                    if not llm_response:
-                        if attempt == max_retries - 1:
-                            raise HTTPException(status_code=500,
-                                                detail=f"LLM processing failed for {file.filename}")
-                        else:
-                            time.sleep(1)
-                            continue
-
-                    try:
-                        items_to_remove = json.loads(llm_response)
-                        if 'items_for_removal' in items_to_remove:
-                            break  # Success, exit retry loop
-                        elif attempt == max_retries - 1:
-                            print("No 'items_for_removal' key found in LLM response after multiple retries.")
-                            break  # keep items_to_remove as empty list.
-                        else:
-                            print(f"No 'items_for_removal' key (attempt {attempt + 1}), retrying...")
-                            time.sleep(1)
-
-                    except (KeyError, json.JSONDecodeError) as e:
-                        if attempt == max_retries - 1:
-                            print(f"Error parsing LLM response after multiple retries: {e}")
-                            raise HTTPException(status_code=500,
-                                            detail=f"Error parsing LLM response for {file.filename}.") from e
-                        else:
-                            print(f"Error parsing LLM response (attempt {attempt + 1}), retrying...")
-                            time.sleep(1)
-                # Merge the responses, correctly combining with the potentially multiple receipts.
-                combined_response = {} # Initialize empty dict
-                if 'receipts' in purchase_data_json:
-                  combined_response['receipts'] = purchase_data_json['receipts']
-                else:
-                  combined_response['receipts'] = []
-
-                combined_response['items_for_removal'] = items_to_remove.get('items_for_removal', []) # Get 'items', defaulting to [].
-                combined_response['matched_items'] = items_to_remove.get('matched_items', [])
-
-                all_responses.append(combined_response)
-
-            finally:
-                if os.path.exists(temp_filepath):
-                    os.remove(temp_filepath)
-                if 'cropped_image_path' in locals() and os.path.exists(cropped_image_path):
-                    os.remove(cropped_image_path)
-    
-    # If multiple files, still maintain a consistent response structure
-        if len(all_responses) == 1:  # If just a single file, return that response directly
-            print(all_responses[0])
-            return JSONResponse(content=all_responses[0])  # No need for a wrapper
-        else: # Multiple files, wrap in a list.
-            return JSONResponse(content={"responses": all_responses}) #wrap in 'responses'
+                result = await process_receipt(filename, contents, reference_list, emit, user_id)
+                metrics.receipts.inc(outcome="ok")
+                emit("result", {"filename": filename, **result})
+            except HTTPException as e:
+                metrics.receipts.inc(outcome="error")
+                emit("error", {"filename": filename, "error": e.detail})
+            except Exception as e:
+                metrics.receipts.inc(outcome="error")
+                print(f"Unexpected error processing {filename}: {e}")
+                emit("error", {"filename": filename, "error": f"Unexpected error processing {filename}"})
 
-    finally:
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+    async def stream():
+        tasks = [asyncio.create_task(process_slot(filename, contents)) for filename, contents in uploads]
+        finished = asyncio.gather(*tasks)
+        finished.add_done_callback(lambda _: emit("done", {"files": len(uploads)}))
+        try:
+            while True:
+                event, data = await events.get()
+                yield sse_event(event, data)
+                if event == "done":
+                    break
+        finally:
+            # Client went away: stop the remaining work.
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/jobs/", status_code=202)
+async def submit_job(request: Request, files: List[UploadFile] = File(...),
+                     reference_list: Optional[str] = Form(None), user_id: Optional[str] = Form(None)):
+    """
+    Queues the same work as /process-images/ and returns a job ID immediately.
+
+    Poll GET /jobs/{job_id} for the result. The work continues even if the
+    client disconnects. Responds 503 with Retry-After when the queue is full.
+    """
+    reference_list = await resolve_reference_list(request, reference_list, user_id)
+    uploads = await read_uploads(files)
+    try:
+        job_id = job_queue.submit(uploads, reference_list, user_id)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(job_retry_after)})
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Returns a job's status ("queued", "running", "done" or "failed").
+
+    Includes "result" (the /process-images/ response body) when done, or
+    "error" when failed. Finished jobs are kept for JOB_TTL seconds.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired job {job_id}")
+    return job
+
+
+class ListDelta(BaseModel):
+    base_version: int = 0
+    add: List[str] = []
+    remove: List[str] = []
+
+
+def require_history(request: Request):
+    if history is None:
+        raise HTTPException(status_code=404, detail="History is disabled (HISTORY_DB)")
+    check_history_token(request)
+
+
+def check_history_token(request: Request):
+    if history_token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {history_token}"):
+        raise HTTPException(status_code=401, detail="Missing or wrong history token")
+
+
+@app.post("/lists/{user_id}/sync")
+async def sync_list(user_id: str, delta: ListDelta, request: Request):
+    """
+    Applies a client's list changes and returns what changed since its base version.
+
+    The client sends the entries it added and removed since it last synced at
+    base_version. The response has the new "version" and the entries
+    "added" and "removed" since base_version (including the client's own),
+    which the client applies to catch up with changes from other devices.
+    Entries are compared case-insensitively and stored in lowercase.
+    """
+    require_history(request)
+    return await asyncio.to_thread(history.apply_delta, user_id, delta.base_version, delta.add, delta.remove)
+
+
+@app.get("/lists/{user_id}")
+async def get_list(user_id: str, request: Request, since: Optional[int] = None):
+    """
+    Returns the user's stored list as {"version", "entries"}, or only the
+    changes since a version ({"version", "added", "removed"}) when `since` is given.
+    """
+    require_history(request)
+    if since is not None:
+        return await asyncio.to_thread(history.list_changes, user_id, since)
+    version, entries = await asyncio.to_thread(history.list_entries, user_id)
+    return {"version": version, "entries": entries}
+
+
+@app.get("/history/{user_id}/receipts")
+async def receipt_history(user_id: str, request: Request, store: Optional[str] = None, date_from: Optional[str] = None,
+                          date_to: Optional[str] = None, item: Optional[str] = None, limit: int = 50,
+                          offset: int = 0):
+    """
+    Returns the user's stored receipts with their items, newest first.
+
+    Filters: `store` (store name prefix), `date_from` and `date_to`
+    (YYYY-MM-DD, inclusive) and `item` (words in an item's name).
+    """
+    require_history(request)
+    receipts = await asyncio.to_thread(history.query_receipts, user_id, store, date_from, date_to, item,
+                                       min(limit, 500), offset)
+    return {"receipts": receipts}
+
+
+@app.get("/history/{user_id}/items")
+async def item_history(user_id: str, item: str, request: Request, limit: int = 50):
+    """Returns past purchases of an item (by words in its name) with the store, date and price of each."""
+    require_history(request)
+    return {"items": await asyncio.to_thread(history.query_items, user_id, item, min(limit, 500))}
+
+
+@app.post("/generate-recipe/")
+async def generate_recipe(ingredients: str = Form(...)):
+    """
+    Generates a recipe from a comma-separated ingredient list.
+
+    Recipes are cached by the normalized, order-insensitive ingredient set.
+    A cached recipe for a subset of the ingredients is served straight away,
+    and identical concurrent requests share one generation.
+
+    Returns:
+        {"recipe": ..., "ingredients": [...], "source": ...}, see RecipeCache.get_or_generate.
+    """
+    try:
+        return await recipe_cache.get_or_generate(ingredients.split(","), allow_subset=recipe_subset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except json.JSONDecodeError as e:
+        print(f"Error decoding recipe JSON: {e}")
+        raise HTTPException(status_code=502, detail="Recipe generation returned invalid JSON")
+    except Exception as e:
+        print(f"Recipe generation failed: {e}")
+        raise HTTPException(status_code=502, detail="Recipe generation failed")
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Exposes stage and LLM call histograms, retry/failover/receipt counters and
+    the crop, cache, batching, breaker and job queue counters in the
+    Prometheus text format.
+    """
+    families = [
+        metrics.render_family("freshtrack_crop_results_total", "counter",
+                              "Crops by detection stage that produced them (original = fallback to the whole photo)",
+                              [({"stage": stage}, count) for stage, count in crop_stage_counts.items()]),
+        metrics.render_family("freshtrack_ocr_bytes_total", "counter", "Image bytes sent to the vision model",
+                              [({}, ocr_bytes_sent["bytes"])]),
+        metrics.render_family("freshtrack_ocr_receipts_total", "counter",
+                              "Receipts by how they were read (local_parser, text_llm or vision)",
+                              [({"path": path}, count) for path, count in ocr_paths.items()]),
+    ]
+    caches = {"ocr": ocr_cache, "list_compare": list_memo}
+    cache_stats = {name: cache.stats() for name, cache in caches.items() if cache is not None}
+    families.append(metrics.render_family("freshtrack_cache_hits_total", "counter", "Cache hits",
+                                          [({"cache": name}, stats["hits"]) for name, stats in cache_stats.items()]))
+    families.append(metrics.render_family("freshtrack_cache_misses_total", "counter", "Cache misses",
+                                          [({"cache": name}, stats["misses"]) for name, stats in cache_stats.items()]))
+    if list_compare_batcher is not None:
+        families.append(metrics.render_family("freshtrack_list_batch_total", "counter",
+                                              "List compare jobs by how they were sent",
+                                              [({"kind": kind}, count) for kind, count in list_compare_batcher.counts.items()]))
+    families.append(metrics.render_family("freshtrack_llm_breaker_open", "gauge",
+                                          "1 if the host's circuit breaker is not closed",
+                                          [({"host": host}, int(state != "closed"))
+                                           for host, state in llm_client.breaker_states().items()]))
+    if job_queue is not None:
+        families.append(metrics.render_family("freshtrack_jobs_queued", "gauge", "Jobs waiting for a worker",
+                                              [({}, job_queue.queued())]))
+    return PlainTextResponse(metrics.render(families), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats/crop")
+async def crop_stats():
+    """Returns how many crops each detection stage produced since startup, the image bytes sent to OCR and how receipts were read."""
+    total = sum(crop_stage_counts.values())
+    receipts = ocr_bytes_sent["receipts"]
+    return {
+        "stages": dict(crop_stage_counts),
+        "total": total,
+        "fast_hit_rate": crop_stage_counts["fast"] / total if total else None,
+        "ocr_bytes": {
+            "total": ocr_bytes_sent["bytes"],
+            "receipts": receipts,
+            "mean": ocr_bytes_sent["bytes"] / receipts if receipts else None,
+        },
+        "ocr_paths": dict(ocr_paths),
+        "pool": crop_pool.stats() if crop_pool is not None else None,
+    }
+
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """Returns hit/miss counters of the OCR result cache and the list compare memo."""
+    return {
+        "ocr": ocr_cache.stats() if ocr_cache is not None else None,
+        "list_compare": list_memo.stats() if list_memo is not None else None,
+        "recipes": recipe_cache.stats(),
+        "history": history.stats() if history is not None else None,
+    }
+
+
+@app.get("/stats/llm")
+async def llm_stats():
+    """Returns the circuit breaker state per LLM host, the observed p95 latency per call type and the routed backends."""
+    return {
+        "breakers": llm_client.breaker_states(),
+        "p95": {call_type: tracker.percentile(95) for call_type, tracker in llm_client.latencies.items()},
+        "backends": llm_client.router.stats() if llm_client.router is not None else None,
+    }
+
+
+@app.get("/stats/batch")
+async def batch_stats():
+    """Returns how many list compare jobs were sent in batches, alone, or retried alone after a batch."""
+    return list_compare_batcher.stats() if list_compare_batcher is not None else None
@@ -0,0 +1,159 @@
+import re
+from difflib import SequenceMatcher
+from typing import Iterable
+
+# Receipt abbreviations, expanded before matching. Values may be several words.
+ABBREVIATIONS = {
+    "appl": "apple", "aple": "apple", "avcdo": "avocado", "bnls": "boneless", "bnna": "banana",
+    "bf": "beef", "brd": "bread", "brst": "breast", "btr": "butter", "bttr": "butter",
+    "cf": "coffee", "chdr": "cheddar", "chkn": "chicken", "chs": "cheese", "ckn": "chicken",
+    "crm": "cream", "crt": "carrot", "frz": "frozen", "grk": "greek", "grn": "green",
+    "grnd": "ground", "hvy": "heavy", "jce": "juice", "lg": "large", "lttc": "lettuce",
+    "mlk": "milk", "mozz": "mozzarella", "oj": "orange juice", "org": "organic", "pnt": "peanut",
+    "pot": "potato", "rst": "roast", "sdwch": "sandwich", "shrd": "shredded", "slcd": "sliced",
+    "sltd": "salted", "sm": "small", "spgt": "spaghetti", "stk": "steak", "swt": "sweet",
+    "tom": "tomato", "tky": "turkey", "veg": "vegetable", "whl": "whole", "wht": "white",
+    "ygrt": "yogurt", "yog": "yogurt",
+}
+
+# Different words for the same grocery item, mapped to one canonical word.
+SYNONYMS = {
+    "cola": "soda", "pop": "soda", "scallion": "green onion", "cilantro": "coriander",
+    "garbanzo": "chickpea", "aubergine": "eggplant", "courgette": "zucchini", "mince": "ground",
+    "hamburger": "ground beef", "tp": "toilet paper", "spud": "potato", "catsup": "ketchup",
+}
+
+# Tokens that say nothing about what the item is: units, pack sizes, store brands.
+STOPWORDS = {
+    "ct", "oz", "lb", "lbs", "ea", "pk", "pck", "gal", "qt", "pt", "fl", "ml", "l", "kg", "g",
+    "gv", "kirk", "kroger", "ks", "mm", "the", "of", "and", "a", "with", "x",
+}
+
+# Words that describe a variant of an item rather than a different item, so a receipt
+# token of this kind that the list entry does not mention does not count against the match.
+MODIFIERS = {
+    "boneless", "skinless", "fresh", "frozen", "organic", "large", "small", "medium", "whole",
+    "sliced", "shredded", "salted", "unsalted", "ground", "heavy", "greek", "lean", "natural", "raw",
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z]+")
+
+
+def singularize(token: str) -> str:
+    """Very small English singularizer, good enough for grocery nouns."""
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 4 and token.endswith(("oes", "ches", "shes")):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def normalize_tokens(text: str) -> list[str]:
+    """Lowercases, expands abbreviations and synonyms, singularizes and drops noise tokens."""
+    tokens = []
+    for raw in TOKEN_PATTERN.findall(str(text).lower()):
+        for word in ABBREVIATIONS.get(raw, raw).split():
+            for canonical in SYNONYMS.get(word, SYNONYMS.get(singularize(word), word)).split():
+                token = singularize(canonical)
+                if token not in STOPWORDS and len(token) > 1:
+                    tokens.append(token)
+    return tokens
+
+
+def token_similarity(list_token: str, receipt_token: str) -> float:
+    """
+    Similarity of a normalized list token to a normalized receipt token, from 0 to 1.
+
+    A receipt token that is a prefix of the list token is a truncated
+    abbreviation ("straw" for "strawberry") and scores high. The other way
+    round the receipt names a longer, often different, item ("egg" in
+    "eggplant", "corn" in "cornflakes"), so that scores below the default
+    accept threshold and the entry is left to the LLM.
+    """
+    if list_token == receipt_token:
+        return 1.0
+    ratio = SequenceMatcher(None, list_token, receipt_token).ratio()
+    if len(receipt_token) >= 3 and list_token.startswith(receipt_token):
+        return max(ratio, 0.9)
+    if len(list_token) >= 3 and receipt_token.startswith(list_token):
+        return max(ratio, 0.6)
+    return ratio
+
+
+class ReceiptIndex:
+    """Inverted index from normalized tokens (and their 3 letter prefixes) to receipt items."""
+
+    def __init__(self, items: Iterable[dict]):
+        self.items = list(items)
+        self.tokens = []
+        self._index: dict[str, set[int]] = {}
+        for position, item in enumerate(self.items):
+            tokens = set(normalize_tokens(item.get('friendly_name', '')) + normalize_tokens(item.get('name', '')))
+            self.tokens.append(tokens)
+            for token in tokens:
+                self._index.setdefault(token, set()).add(position)
+                self._index.setdefault(token[:3], set()).add(position)
+
+    def candidates(self, tokens: list[str]) -> set[int]:
+        """Positions of the items sharing a token or a token prefix with the query."""
+        found = set()
+        for token in tokens:
+            found |= self._index.get(token, set())
+            found |= self._index.get(token[:3], set())
+        return found
+
+    def score(self, tokens: list[str], position: int) -> float:
+        """
+        How well an item and the query tokens cover each other, from 0 to 1.
+
+        The lower of the query coverage (the mean of each query token's best
+        match among the item's tokens) and the item coverage (the same for
+        each item token other than MODIFIERS). Item words the query does not
+        mention lower the score, so "orange" is not a confident match for
+        "Orange Juice" but "milk" still is for "Whole Milk".
+        """
+        item_tokens = self.tokens[position]
+        if not tokens or not item_tokens:
+            return 0.0
+        query_coverage = sum(max(token_similarity(token, other) for other in item_tokens) for token in tokens) / len(tokens)
+        core = [other for other in item_tokens if other not in MODIFIERS]
+        if not core:
+            return query_coverage
+        item_coverage = sum(max(token_similarity(token, other) for token in tokens) for other in core) / len(core)
+        return min(query_coverage, item_coverage)
+
+    def best_match(self, entry: str) -> tuple[float, dict]:
+        """Returns the best (score, item) for a list entry, or (0.0, None) when nothing is close."""
+        tokens = normalize_tokens(entry)
+        best_score, best_item = 0.0, None
+        for position in self.candidates(tokens):
+            score = self.score(tokens, position)
+            if score > best_score:
+                best_score, best_item = score, self.items[position]
+        return best_score, best_item
+
+
+def match_list(entries: list[str], items: Iterable[dict], accept: float = 0.85, reject: float = 0.35) -> dict:
+    """
+    Matches shopping list entries against receipt items locally.
+
+    Entries scoring at least `accept` are removed, and entries below `reject`
+    (no item comes close) are kept. Everything in between is returned under
+    'uncertain' so the caller can ask the LLM about those entries only.
+
+    Returns:
+        A dict with 'items_for_removal', 'matched_items' (in the list compare
+        response shape) and 'uncertain'.
+    """
+    index = ReceiptIndex(items)
+    result = {'items_for_removal': [], 'matched_items': [], 'uncertain': []}
+    for entry in entries:
+        score, item = index.best_match(entry)
+        if item is not None and score >= accept:
+            result['items_for_removal'].append(entry)
+            result['matched_items'].append({'name_on_list': entry, 'name_on_receipt': item.get('name', '')})
+        elif score >= reject:
+            result['uncertain'].append(entry)
+    return result
@@ -0,0 +1,125 @@
+"""Minimal Prometheus-style metrics and per-request Server-Timing.
+
+Counters and histograms register themselves on creation and render() dumps
+them in the Prometheus text format. Timings recorded while a request is
+being handled are also summed into that request's Server-Timing entries.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage durations (seconds) of the request being handled, for the Server-Timing header.
+request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+_registry: list = []
+_lock = threading.Lock()
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in sorted(labels.items()))
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_family(name: str, kind: str, help_text: str, samples: Iterable[tuple[dict, float]]) -> str:
+    """Renders one metric family from (labels, value) samples."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{format_labels(labels)} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> str:
+        return render_family(self.name, "counter", self.help_text,
+                             ((dict(key), value) for key, value in self.values.items()))
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self.series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+stage_seconds = Histogram("freshtrack_stage_seconds", "Duration of pipeline stages")
+llm_request_seconds = Histogram("freshtrack_llm_request_seconds",
+                                "Duration of LLM calls, retries and hedges included")
+llm_retries = Counter("freshtrack_llm_retries_total", "LLM requests retried, by reason")
+llm_failovers = Counter("freshtrack_llm_failovers_total", "LLM calls moved off a failing backend")
+receipts = Counter("freshtrack_receipts_total", "Receipts processed, by outcome")
+llm_answers = Counter("freshtrack_llm_answers_total", "LLM JSON answers by outcome (valid, repaired, invalid)")
+
+
+def add_request_timing(name: str, seconds: float) -> None:
+    """Adds a duration to the current request's Server-Timing entry `name`, if a request is being handled."""
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def record_timing(name: str, seconds: float) -> None:
+    """Adds a stage duration to the histogram and to the current request's Server-Timing."""
+    stage_seconds.observe(seconds, stage=name)
+    add_request_timing(name, seconds)
+
+
+@contextmanager
+def timer(name: str):
+    """Times the block as stage `name`, see record_timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - started)
+
+
+def server_timing_header(timings: dict) -> str:
+    """Formats stage durations as a Server-Timing header value (milliseconds)."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def render(extra: Iterable[str] = ()) -> str:
+    """All registered metrics plus already rendered extra families, in the Prometheus text format."""
+    with _lock:
+        families = [metric.render() for metric in _registry]
+    return "".join(families) + "".join(extra)
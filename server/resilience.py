@@ -0,0 +1,229 @@
+"""Retries, hedging and circuit breaking for the LLM calls.
+
+Each call type (OCR, text) has a Policy read from the environment with its
+own prefix, e.g. for LLM_OCR:
+
+    LLM_OCR_ATTEMPTS     tries per call, first one included (default 3)
+    LLM_OCR_BASE_DELAY   backoff base in seconds; attempt n waits a random
+                         time up to BASE_DELAY * 2**n (default 0.5)
+    LLM_OCR_MAX_DELAY    cap on a single wait, Retry-After included (default 20)
+    LLM_OCR_HEDGE        "p95" to send a duplicate request once the call is
+                         slower than the observed p95, a number of seconds for
+                         a fixed threshold, or "off" (default off)
+
+Circuit breakers are kept per host: once LLM_BREAKER_THRESHOLD (default 5)
+of the last 20 calls failed, and at least half of them, calls fail fast for
+LLM_BREAKER_RESET seconds (default 30). Then one trial call decides whether
+to close the breaker again.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+import metrics
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(httpx.HTTPError):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+
+class Policy:
+    """Retry and hedging settings for one call type."""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 20.0,
+                 hedge: Optional[str] = None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults) -> "Policy":
+        policy = cls(**defaults)
+        policy.attempts = int(os.environ.get(f"{prefix}_ATTEMPTS", policy.attempts))
+        policy.base_delay = float(os.environ.get(f"{prefix}_BASE_DELAY", policy.base_delay))
+        policy.max_delay = float(os.environ.get(f"{prefix}_MAX_DELAY", policy.max_delay))
+        hedge = os.environ.get(f"{prefix}_HEDGE", policy.hedge or "off")
+        policy.hedge = None if hedge == "off" else hedge
+        return policy
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait before retry number `attempt` (0 based): Retry-After if given, else full jitter."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails fast for `reset_after` seconds once the host looks down: at least
+    `threshold` of the last `window` calls failed, and at least half of them.
+
+    Looking at the failure ratio rather than consecutive failures keeps a
+    burst of concurrent calls against a flaky but working host from
+    tripping the breaker.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0, window: int = 20):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.outcomes = deque(maxlen=window)
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self) -> bool:
+        """True if a call may go out. In half-open state only one trial call is let through."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.outcomes.append(True)
+        if self.opened_at is not None and self._trial:
+            self.outcomes.clear()
+            self.opened_at = None
+        self._trial = False
+
+    def release_trial(self) -> None:
+        """Gives back a trial call that ended without an outcome (cancelled), so the next call can be the trial."""
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if self._trial or (failures >= self.threshold and failures * 2 >= len(self.outcomes)):
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+class LatencyTracker:
+    """Rolling window of call latencies, for the hedging threshold."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def retry_after_seconds(response: Optional[httpx.Response]) -> Optional[float]:
+    """Parses a Retry-After header (seconds or HTTP date), or None."""
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    return isinstance(error, (httpx.TransportError, httpx.TimeoutException))
+
+
+def hedge_delay(policy: Policy, tracker: LatencyTracker) -> Optional[float]:
+    if policy.hedge is None:
+        return None
+    if policy.hedge == "p95":
+        return tracker.percentile(95)
+    return float(policy.hedge)
+
+
+async def hedged(send: Callable[[], Awaitable[T]], delay: Optional[float]) -> T:
+    """Runs send(); if it has not finished after `delay` seconds, races a duplicate and returns the first success."""
+    first = asyncio.ensure_future(send())
+    if delay is None:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+
+    tasks = {first, asyncio.ensure_future(send())}
+    try:
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call(send: Callable[[], Awaitable[T]], policy: Policy, breaker: CircuitBreaker,
+               tracker: LatencyTracker) -> T:
+    """
+    Calls send() under a policy: circuit breaker check, optional hedging, and
+    retries with jittered exponential backoff (or the server's Retry-After) on
+    429, 5xx, timeouts and connection errors. Waits never block the event loop.
+
+    Raises:
+        CircuitOpenError: If the breaker is open.
+        httpx.HTTPError: The last error once retries are exhausted, or any
+            non-retryable error straight away.
+    """
+    for attempt in range(policy.attempts):
+        if not breaker.allow():
+            raise CircuitOpenError("Circuit breaker open, not calling the LLM API")
+        started = time.monotonic()
+        try:
+            result = await hedged(send, hedge_delay(policy, tracker))
+        except asyncio.CancelledError:
+            breaker.release_trial()  # E.g. the client of a streamed response went away
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()  # The host answered; the request itself is bad
+                raise
+            breaker.record_failure()
+            if attempt == policy.attempts - 1:
+                raise
+            response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+            metrics.llm_retries.inc(reason=response.status_code if response is not None else type(e).__name__)
+            delay = policy.backoff(attempt, retry_after_seconds(response))
+            print(f"LLM call failed ({e}), retry {attempt + 1}/{policy.attempts - 1} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        tracker.add(time.monotonic() - started)
+        return result
@@ -0,0 +1,234 @@
+"""Routing LLM calls across several OpenAI-compatible backends.
+
+Backends are configured with LLM_BACKENDS, a JSON list (or the path of a
+JSON file holding one) of objects like:
+
+    {"name": "ollama", "url": "http://localhost:11434/v1/chat/completions",
+     "model": "llava", "capabilities": ["vision", "text"], "weight": 2,
+     "max_concurrency": 2}
+
+    url              chat completions endpoint (required)
+    name             label for stats and logs (defaults to url)
+    model            replaces the model named in the payload (optional)
+    token_env        environment variable holding the bearer token
+                     (defaults to the caller's token)
+    capabilities     "vision" and/or "text" (default both)
+    weight           preference multiplier, higher is preferred (default 1)
+    max_concurrency  requests in flight at once (default 8)
+
+Each call goes to the backend with the lowest score, its EWMA latency for
+that capability scaled by how busy it is and divided by its weight. A
+failed backend is skipped for the rest of the call and its latency estimate
+is penalised, so the retry goes elsewhere.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+import metrics
+import resilience
+
+T = TypeVar("T")
+
+
+class Backend:
+    """One OpenAI-compatible endpoint with its limits and latency estimates."""
+
+    def __init__(self, url: str, name: Optional[str] = None, model: Optional[str] = None,
+                 token_env: Optional[str] = None, capabilities: tuple[str, ...] = ("vision", "text"),
+                 weight: float = 1.0, max_concurrency: int = 8, alpha: float = 0.3):
+        self.url = url
+        self.name = name or url
+        self.model = model
+        self.token_env = token_env
+        self.capabilities = set(capabilities)
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.alpha = alpha
+        self.ewma: dict[str, float] = {}  # Latency estimate per capability
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.breaker = resilience.CircuitBreaker()
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    def token(self, default: str) -> str:
+        return os.environ.get(self.token_env, default) if self.token_env else default
+
+    def observe(self, capability: str, seconds: float) -> None:
+        previous = self.ewma.get(capability)
+        self.ewma[capability] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+
+    def penalise(self, capability: str) -> None:
+        """Doubles the latency estimate after a failure, so the backend is tried less until it recovers."""
+        self.ewma[capability] = self.ewma.get(capability, 1.0) * 2
+
+    def stats(self) -> dict:
+        return {"url": self.url, "model": self.model, "ewma": self.ewma, "in_flight": self.in_flight,
+                "calls": self.calls, "failures": self.failures, "breaker": self.breaker.state}
+
+
+class Router:
+    """Picks a backend per call by EWMA latency, load and weight, and fails over between them."""
+
+    def __init__(self, backends: list[Backend]):
+        self.backends = backends
+
+    def score(self, backend: Backend, capability: str) -> float:
+        known = [b.ewma[capability] for b in self.backends if capability in b.ewma]
+        # Untried backends get the best known latency so they are explored early.
+        latency = backend.ewma.get(capability, min(known) if known else 1.0)
+        load = 1 + backend.in_flight / backend.max_concurrency
+        return latency * load / backend.weight
+
+    def pick(self, capability: str, exclude: set = frozenset()) -> Optional[Backend]:
+        """Best backend for the capability, preferring ones with free capacity and a closed breaker."""
+        candidates = [b for b in self.backends if capability in b.capabilities and b not in exclude
+                      and b.breaker.state != "open"]
+        if not candidates:
+            return None
+        free = [b for b in candidates if b.in_flight < b.max_concurrency]
+        return min(free or candidates, key=lambda b: self.score(b, capability))
+
+    async def call(self, capability: str, send: Callable[[Backend], Awaitable[T]],
+                   policy: resilience.Policy, hedge_delay: Optional[float] = None) -> T:
+        """
+        Runs send(backend) on the best backend, moving to the next best on a
+        retryable failure. Once every backend has failed, waits per the
+        policy's backoff and starts over, up to policy.attempts rounds.
+        With hedge_delay, a slow call is duplicated on the same backend as in resilience.hedged.
+
+        Raises:
+            resilience.CircuitOpenError: If no backend for the capability is available.
+            httpx.HTTPError: The last error once attempts are exhausted, or a non-retryable one.
+        """
+        last_error: Optional[Exception] = None
+        for attempt in range(policy.attempts):
+            tried = set()
+            while True:
+                backend = self.pick(capability, tried)
+                if backend is None:
+                    break
+                tried.add(backend)
+                if not backend.breaker.allow():
+                    continue
+                try:
+                    return await self._send(backend, capability, send, hedge_delay)
+                except Exception as e:
+                    if not resilience.is_retryable(e):
+                        raise
+                    last_error = e
+                    metrics.llm_failovers.inc(backend=backend.name)
+                    print(f"LLM backend {backend.name} failed ({e}), trying the next one")
+            if attempt < policy.attempts - 1 and last_error is not None:
+                await asyncio.sleep(policy.backoff(attempt))
+        if last_error is None:
+            raise resilience.CircuitOpenError(f"No LLM backend available for {capability}")
+        raise last_error
+
+    async def _send(self, backend: Backend, capability: str, send: Callable[[Backend], Awaitable[T]],
+                    hedge_delay: Optional[float] = None) -> T:
+        backend.in_flight += 1
+        backend.calls += 1
+        started = time.monotonic()
+        try:
+            async with backend._slots:
+                result = await resilience.hedged(lambda: send(backend), hedge_delay)
+        except Exception as e:
+            self._failed(backend, capability, e)
+            raise
+        except BaseException:
+            backend.breaker.release_trial()  # Cancelled before an outcome
+            raise
+        finally:
+            backend.in_flight -= 1
+        backend.breaker.record_success()
+        backend.observe(capability, time.monotonic() - started)
+        return result
+
+    async def stream(self, capability: str, open_stream: Callable[[Backend], AsyncIterator[T]],
+                     policy: resilience.Policy) -> AsyncIterator[T]:
+        """
+        Like call for a streamed response: yields what open_stream(backend) yields.
+
+        The backend holds its slot until the stream ends, and its latency is
+        observed over the whole stream. A failure before the first item fails
+        over like call; after it the error is raised, since the caller
+        already has part of the answer.
+
+        Raises:
+            resilience.CircuitOpenError: If no backend for the capability is available.
+            httpx.HTTPError: The last error once attempts are exhausted, a non-retryable one or one mid-stream.
+        """
+        last_error: Optional[Exception] = None
+        for attempt in range(policy.attempts):
+            tried = set()
+            while True:
+                backend = self.pick(capability, tried)
+                if backend is None:
+                    break
+                tried.add(backend)
+                if not backend.breaker.allow():
+                    continue
+                started = False
+                try:
+                    async for item in self._stream(backend, capability, open_stream):
+                        started = True
+                        yield item
+                    return
+                except Exception as e:
+                    if started or not resilience.is_retryable(e):
+                        raise
+                    last_error = e
+                    metrics.llm_failovers.inc(backend=backend.name)
+                    print(f"LLM backend {backend.name} failed ({e}), trying the next one")
+            if attempt < policy.attempts - 1 and last_error is not None:
+                await asyncio.sleep(policy.backoff(attempt))
+        if last_error is None:
+            raise resilience.CircuitOpenError(f"No LLM backend available for {capability}")
+        raise last_error
+
+    async def _stream(self, backend: Backend, capability: str,
+                      open_stream: Callable[[Backend], AsyncIterator[T]]) -> AsyncIterator[T]:
+        backend.in_flight += 1
+        backend.calls += 1
+        started = time.monotonic()
+        try:
+            async with backend._slots:
+                async for item in open_stream(backend):
+                    yield item
+        except Exception as e:
+            self._failed(backend, capability, e)
+            raise
+        except BaseException:
+            backend.breaker.release_trial()  # Cancelled before an outcome
+            raise
+        finally:
+            backend.in_flight -= 1
+        backend.breaker.record_success()
+        backend.observe(capability, time.monotonic() - started)
+
+    @staticmethod
+    def _failed(backend: Backend, capability: str, error: Exception) -> None:
+        backend.failures += 1
+        if resilience.is_retryable(error):
+            backend.breaker.record_failure()
+            backend.penalise(capability)
+        else:
+            backend.breaker.record_success()  # The backend answered; the request itself is bad
+
+    def stats(self) -> dict:
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+def load_router(config: Optional[str] = None) -> Optional[Router]:
+    """Builds a Router from LLM_BACKENDS (JSON or a path to a JSON file), or None if it is unset."""
+    config = config if config is not None else os.environ.get("LLM_BACKENDS")
+    if not config:
+        return None
+    if os.path.isfile(config):
+        with open(config) as f:
+            config = f.read()
+    return Router([Backend(**entry) for entry in json.loads(config)])
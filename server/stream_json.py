@@ -0,0 +1,70 @@
+"""Incremental extraction of receipt items from a streamed receipt_extraction JSON document."""
+import json
+from typing import Optional
+
+
+class ReceiptItemStream:
+    """
+    Feeds on chunks of a receipt_extraction JSON document as the model produces
+    them and returns each receipts[*].items[*] object as soon as it closes.
+
+    Only brackets, strings and keys are tracked, so each chunk is scanned once
+    and a completed item is decoded from its own slice of the buffer. The full
+    text stays available in `text` for the final json.loads.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._position = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._key: Optional[str] = None
+        # Open containers as (bracket, start offset, key the container sits under).
+        self._stack: list[tuple[str, int, Optional[str]]] = []
+
+    def feed(self, chunk: str) -> list[dict]:
+        """Adds a chunk of the document and returns the items completed by it."""
+        self.text += chunk
+        items = []
+        text = self.text
+        for position in range(self._position, len(text)):
+            char = text[position]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start:position + 1]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = position
+            elif char == ":":
+                self._key = json.loads(self._last_string) if self._last_string else None
+            elif char in "{[":
+                parent_is_object = self._stack and self._stack[-1][0] == "{"
+                self._stack.append((char, position, self._key if parent_is_object else None))
+                self._key = None
+            elif char in "}]":
+                if not self._stack:
+                    continue  # Unmatched closer (prose or a stray bracket); the final parse reports it
+                bracket, start, _ = self._stack.pop()
+                if bracket == "{" and self._in_items():
+                    try:
+                        items.append(json.loads(text[start:position + 1]))
+                    except json.JSONDecodeError:
+                        pass  # Let the final parse report malformed output
+                self._key = None
+            elif char == ",":
+                self._key = None
+        self._position = len(text)
+        return items
+
+    def _in_items(self) -> bool:
+        """True if the innermost open container is receipts[*].items."""
+        stack = self._stack
+        return (len(stack) >= 3 and stack[-1][0] == "[" and stack[-1][2] == "items"
+                and stack[-2][0] == "{" and stack[-3][0] == "[" and stack[-3][2] == "receipts")
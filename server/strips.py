@@ -0,0 +1,107 @@
+"""Splitting tall receipts into bands for OCR and merging the per-band results."""
+import cv2
+import numpy as np
+from typing import Optional
+
+
+def split_rows(gray: np.ndarray, band_height: int, overlap: int) -> list[tuple[int, int]]:
+    """Chooses overlapping (top, bottom) row ranges covering a tall receipt.
+
+    Each cut is placed on the emptiest row (least ink) in the last quarter
+    of the band, so cuts fall between printed lines. Bands then extend
+    `overlap` rows past the cut on both sides, so a line clipped by a bad
+    cut is still read whole by one of the two bands.
+    """
+    height = gray.shape[0]
+    if height <= band_height * 1.25:
+        return [(0, height)]
+
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    row_ink = (ink > 0).mean(axis=1)
+    # Ignore single noisy rows when looking for whitespace.
+    row_ink = np.convolve(row_ink, np.ones(5) / 5, mode="same")
+
+    cuts = []
+    start = 0
+    while height - start > band_height * 1.25:
+        window_start = start + int(band_height * 0.75)
+        window_end = start + band_height
+        cut = window_start + int(np.argmin(row_ink[window_start:window_end]))
+        cuts.append(cut)
+        start = cut
+
+    bounds = [0] + cuts + [height]
+    return [(max(0, top - overlap if i else 0), min(height, bottom + overlap))
+            for i, (top, bottom) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def split_into_strips(image: np.ndarray, strip_aspect: float, overlap: float = 0.1) -> list[np.ndarray]:
+    """Cuts a receipt taller than strip_aspect times its width into overlapping horizontal bands.
+
+    Args:
+        image: The cropped receipt.
+        strip_aspect: Band height as a multiple of the image width.
+        overlap: Rows shared by neighbouring bands, as a fraction of the band height.
+
+    Returns:
+        The bands from top to bottom; just [image] if it is not tall enough to split.
+    """
+    band_height = int(image.shape[1] * strip_aspect)
+    if band_height <= 0:
+        return [image]
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return [image[top:bottom] for top, bottom in split_rows(gray, band_height, int(band_height * overlap))]
+
+
+def item_key(item: dict) -> tuple:
+    return (str(item.get('name', '')).strip().upper(), round(float(item.get('price') or 0), 2))
+
+
+def is_found(value) -> bool:
+    return value not in (None, "", "Not Found")
+
+
+def merge_strip_receipts(results: list[dict], window: int = 4) -> dict:
+    """Merges receipt_extraction results of consecutive bands into one receipt.
+
+    Items are concatenated in band order. An item at the head of a band that
+    equals (same name and price) one of the last `window` items of the band
+    above was read twice in the overlap and is dropped. Store, Address and
+    Date come from the first band that has them (the header is at the top);
+    totalCost and numItems come from the last band that reports them (the
+    totals are at the bottom). If no band reports a total, it is the sum of
+    the item prices, and numItems defaults to the merged item count.
+    """
+    merged = {"Store": "Not Found", "Address": "Not Found", "Date": "Not Found", "numItems": 0,
+              "totalCost": 0.0, "items": []}
+    reported_total: Optional[float] = None
+    reported_count: Optional[int] = None
+    previous_tail: list[tuple] = []
+
+    for result in results:
+        band_items = []
+        for receipt in result.get('receipts', []):
+            for field in ("Store", "Address", "Date"):
+                if not is_found(merged[field]) and is_found(receipt.get(field)):
+                    merged[field] = receipt[field]
+            if (receipt.get('totalCost') or 0) > 0:
+                reported_total = float(receipt['totalCost'])
+            if (receipt.get('numItems') or 0) > 0:
+                reported_count = int(receipt['numItems'])
+            band_items.extend(receipt.get('items', []))
+
+        # Drop the leading items that repeat the tail of the previous band.
+        skip = 0
+        for item in band_items[:window]:
+            if item_key(item) in previous_tail:
+                previous_tail.remove(item_key(item))
+                skip += 1
+            else:
+                break
+        merged["items"].extend(band_items[skip:])
+        previous_tail = [item_key(item) for item in band_items[-window:]]
+
+    computed_total = round(sum(float(item.get('price') or 0) for item in merged["items"]), 2)
+    merged["totalCost"] = reported_total if reported_total is not None else computed_total
+    merged["numItems"] = reported_count if reported_count is not None else len(merged["items"])
+    return {"receipts": [merged]}
@@ -0,0 +1,28 @@
+from cache import ListCompareMemo, SQLiteCache
+
+
+def test_answer_naming_other_entries_is_not_split_unless_they_are_dropped():
+    answer = {"items_for_removal": ["Milk", "caviar"], "matched_items": [{"name_on_list": "caviar"}]}
+    assert ListCompareMemo.decisions_from_result(["milk", "eggs"], answer) is None
+
+    decisions = ListCompareMemo.decisions_from_result(["milk", "eggs"], answer, drop_unknown=True)
+    assert ListCompareMemo.assemble(["milk", "eggs"], decisions) == {"items_for_removal": ["milk"], "matched_items": []}
+
+
+def test_sqlite_cache_round_trip_and_eviction(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), max_entries=2, touch_interval=0)
+    cache.set("a", {"receipts": [1]})
+    cache.set("b", [2])
+    assert cache.get("a") == {"receipts": [1]}  # Now more recently used than "b"
+    cache.set("c", "three")
+    assert cache.get("b") is None
+    assert cache.get("a") == {"receipts": [1]} and cache.get("c") == "three"
+    assert len(cache) == 2
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 1
+
+
+def test_sqlite_cache_expires_entries(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    cache.set("a", 1)
+    cache._conn.execute("UPDATE cache SET created = created - 120")
+    assert cache.get("a") is None and len(cache) == 0
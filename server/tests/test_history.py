@@ -0,0 +1,11 @@
+from history import HistoryStore
+
+
+def test_version_only_changes_when_the_list_does(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    assert store.apply_delta("u1", 0, add=["Milk", "eggs"])["version"] == 1
+    assert store.apply_delta("u1", 1, add=["milk"], remove=["bread"])["version"] == 1
+    assert store.apply_delta("u1", 1, remove=["MILK"]) == {"version": 2, "added": [], "removed": ["milk"]}
+    assert store.apply_delta("u1", 2, remove=["milk"])["version"] == 2
+    assert store.list_entries("u1") == (2, ["eggs"])
+    assert store.apply_delta("u2", 0, remove=["eggs"])["version"] == 0
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from llm_json import SchemaError, compile_schema, loads_lenient, repair_json
+
+
+def test_truncated_answer_keeps_the_whole_items():
+    text = '{"items": [{"name": "MILK", "price": 3.49}, {"name": "EGG'
+    assert json.loads(repair_json(text)) == {"items": [{"name": "MILK", "price": 3.49}]}
+
+
+def test_trailing_commas():
+    assert loads_lenient('{"items": [1, 2, ], "total": 3, }') == {"items": [1, 2], "total": 3}
+
+
+def test_single_quotes_unquoted_keys_and_python_literals():
+    text = "{'name': 'Joe\\'s \"best\"', taxable: True, upc: None}"
+    assert loads_lenient(text) == {"name": 'Joe\'s "best"', "taxable": True, "upc": None}
+
+
+def test_code_fence_and_prose_around_the_answer():
+    text = 'Here you go:\n```json\n{"items_for_removal": ["milk"]}\n```\nAnything else?'
+    assert loads_lenient(text) == {"items_for_removal": ["milk"]}
+
+
+@pytest.mark.parametrize("number", ["1.2e1", "-3E-2", "5e+3", "12"])
+def test_numbers_with_exponents_stay_numbers(number):
+    assert json.loads(repair_json(f'{{totalCost: {number}, "items": [1,')) == {
+        "totalCost": float(number) if "e" in number.lower() else int(number), "items": [1]}
+
+
+def test_schema_coerces_prices_and_rejects_unusable_answers():
+    validate = compile_schema({"type": "object", "required": ["price"], "properties": {"price": {"type": "number"}}})
+    assert validate({"Price": "$3.49"}) == {"price": 3.49}
+    with pytest.raises(SchemaError):
+        validate({"price": "free"})
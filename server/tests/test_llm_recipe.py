@@ -0,0 +1,62 @@
+import asyncio
+
+from llm_recipe import RecipeCache, canonical_ingredients
+
+
+def test_canonical_key_ignores_case_plurals_and_order():
+    assert canonical_ingredients(["Onions", " garlic "]) == canonical_ingredients(["garlic", "onion"])
+
+
+def test_model_gets_the_users_names_not_the_canonical_ones():
+    sent = []
+
+    async def generate(ingredients):
+        sent.append(ingredients)
+        return {"title": "Dip"}
+
+    async def run():
+        cache = RecipeCache()
+        first = await cache.get_or_generate(["Hummus", "Tomatoes", "tomato"], generate=generate)
+        second = await cache.get_or_generate(["tomato", "hummus"], generate=generate)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert sent == [["hummus", "tomatoes"]]
+    assert first["source"] == "generated" and second["source"] == "exact"
+
+
+def test_generation_is_cached_even_if_its_requester_is_cancelled():
+    calls = []
+
+    async def generate(ingredients):
+        calls.append(ingredients)
+        await asyncio.sleep(0.01)
+        return {"title": "Soup"}
+
+    async def run():
+        cache = RecipeCache()
+        first = asyncio.ensure_future(cache.get_or_generate(["leek", "potato"], generate=generate))
+        await asyncio.sleep(0)
+        first.cancel()
+        second = await cache.get_or_generate(["potato", "leek"], generate=generate)
+        third = await cache.get_or_generate(["leeks", "potatoes"], generate=generate)
+        return second, third
+
+    second, third = asyncio.run(run())
+    assert len(calls) == 1
+    assert second["source"] == "coalesced" and third["source"] == "exact"
+
+
+def test_ingredient_sets_are_bounded_by_the_cache_size():
+    async def generate(ingredients):
+        return {"title": " ".join(ingredients)}
+
+    async def run():
+        cache = RecipeCache(max_entries=2)
+        for ingredient in ["apple", "bean", "carrot", "date", "egg"]:
+            await cache.get_or_generate([ingredient, "salt"], generate=generate)
+        return cache
+
+    cache = asyncio.run(run())
+    assert len(cache._sets) <= 2
+    assert set(cache._sets) == {"egg|salt", "date|salt"}
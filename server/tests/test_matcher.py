@@ -0,0 +1,53 @@
+import pytest
+
+from matcher import match_list, token_similarity
+
+ITEMS = [
+    {"name": "EGGPLANT", "friendly_name": "Eggplant"},
+    {"name": "PNT BTR", "friendly_name": "Peanut Butter"},
+    {"name": "HAMBRGR BUNS", "friendly_name": "Hamburger Buns"},
+    {"name": "CORNFLAKES", "friendly_name": "Cornflakes"},
+]
+
+
+def test_longer_receipt_word_is_not_a_confident_match():
+    result = match_list(["eggs", "peas", "ham", "corn"], ITEMS)
+    assert result["items_for_removal"] == []
+    assert result["matched_items"] == []
+    assert sorted(result["uncertain"]) == ["corn", "eggs", "peas"]  # "ham" is not even close to the buns
+
+
+@pytest.mark.parametrize("entry, item", [
+    ("orange", {"name": "OJ", "friendly_name": "Orange Juice"}),
+    ("butter", {"name": "PNT BTR", "friendly_name": "Peanut Butter"}),
+    ("apple", {"name": "APPL JCE", "friendly_name": "Apple Juice"}),
+    ("chicken", {"name": "CHKN BRTH", "friendly_name": "Chicken Broth"}),
+])
+def test_item_words_missing_from_the_entry_are_not_a_confident_match(entry, item):
+    result = match_list([entry], [item])
+    assert result["items_for_removal"] == []
+    assert result["uncertain"] == [entry]
+
+
+def test_modifiers_on_the_receipt_do_not_block_a_match():
+    items = [{"name": "ORG LG EGGS", "friendly_name": "Organic Large Eggs"},
+             {"name": "OJ", "friendly_name": "Orange Juice"}]
+    assert match_list(["eggs", "orange juice"], items)["items_for_removal"] == ["eggs", "orange juice"]
+
+
+def test_truncated_receipt_word_still_matches():
+    result = match_list(["strawberries"], [{"name": "STRAW", "friendly_name": "STRAW"}])
+    assert result["items_for_removal"] == ["strawberries"]
+
+
+def test_abbreviations_and_exact_words_match():
+    items = [{"name": "GV WHL MILK", "friendly_name": "Whole Milk"},
+             {"name": "BNLS CHKN BRST", "friendly_name": "Chicken Breast"}]
+    result = match_list(["milk", "chicken breast", "caviar"], items)
+    assert result["items_for_removal"] == ["milk", "chicken breast"]
+    assert "caviar" not in result["uncertain"]
+
+
+def test_prefix_scores_depend_on_direction():
+    assert token_similarity("strawberry", "straw") >= 0.85
+    assert token_similarity("egg", "eggplant") < 0.85
@@ -0,0 +1,70 @@
+import asyncio
+
+import httpx
+import pytest
+
+import resilience
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+    breaker.opened_at -= breaker.reset_after  # Skip the wait
+    assert breaker.state == "half-open"
+
+
+def test_breaker_opens_then_half_opens_then_closes():
+    breaker = resilience.CircuitBreaker(threshold=2, reset_after=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    breaker.opened_at -= 60
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()  # Only one trial call at a time
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = resilience.CircuitBreaker(threshold=2, reset_after=60)
+    open_breaker(breaker)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_cancelled_trial_call_releases_the_trial():
+    breaker = resilience.CircuitBreaker(threshold=2, reset_after=60)
+    open_breaker(breaker)
+    started = asyncio.Event()
+
+    async def send():
+        started.set()
+        await asyncio.sleep(60)
+
+    async def run():
+        task = asyncio.ensure_future(resilience.call(send, resilience.Policy(), breaker, resilience.LatencyTracker()))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+
+
+def test_non_retryable_trial_answer_closes_the_breaker():
+    breaker = resilience.CircuitBreaker(threshold=2, reset_after=60)
+    open_breaker(breaker)
+    request = httpx.Request("POST", "http://llm/v1")
+
+    async def send():
+        raise httpx.HTTPStatusError("bad request", request=request, response=httpx.Response(400, request=request))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(resilience.call(send, resilience.Policy(), breaker, resilience.LatencyTracker()))
+    assert breaker.state == "closed"
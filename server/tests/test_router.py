@@ -0,0 +1,87 @@
+import asyncio
+
+import httpx
+import pytest
+
+import resilience
+from router import Backend, Router
+
+
+def collect(router, open_stream):
+    async def run():
+        return [item async for item in router.stream("vision", open_stream, resilience.Policy(base_delay=0))]
+    return asyncio.run(run())
+
+
+def test_stream_fails_over_before_the_first_item_and_holds_the_slot():
+    slow, fast = Backend("http://a", name="a", weight=5), Backend("http://b", name="b")
+    router = Router([slow, fast])
+    in_flight = []
+
+    async def open_stream(backend):
+        in_flight.append(backend.in_flight)
+        if backend is slow:
+            raise httpx.ConnectError("refused")
+        yield "he"
+        in_flight.append(backend.in_flight)
+        yield "llo"
+
+    assert collect(router, open_stream) == ["he", "llo"]
+    assert in_flight == [1, 1, 1]
+    assert slow.failures == 1 and slow.in_flight == 0 and fast.in_flight == 0
+    assert "vision" in fast.ewma
+
+
+def test_stream_does_not_fail_over_mid_stream():
+    first, second = Backend("http://a", name="a", weight=5), Backend("http://b", name="b")
+    calls = []
+
+    async def open_stream(backend):
+        calls.append(backend.name)
+        yield "partial"
+        raise httpx.ReadTimeout("stalled")
+
+    with pytest.raises(httpx.ReadTimeout):
+        collect(Router([first, second]), open_stream)
+    assert calls == ["a"] and first.failures == 1
+
+
+def test_bad_request_during_the_trial_closes_the_breaker():
+    backend = Backend("http://a", name="a")
+    for _ in range(backend.breaker.threshold):
+        backend.breaker.record_failure()
+    backend.breaker.opened_at -= backend.breaker.reset_after
+    request = httpx.Request("POST", "http://a")
+
+    async def send(backend):
+        raise httpx.HTTPStatusError("bad request", request=request, response=httpx.Response(400, request=request))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(Router([backend]).call("text", send, resilience.Policy(base_delay=0)))
+    assert backend.breaker.state == "closed" and backend.breaker.allow()
+
+
+def test_cancelled_trial_stream_releases_the_backend():
+    backend = Backend("http://a", name="a")
+    for _ in range(backend.breaker.threshold):
+        backend.breaker.record_failure()
+    backend.breaker.opened_at -= backend.breaker.reset_after
+    started = asyncio.Event()
+
+    async def open_stream(backend):
+        started.set()
+        await asyncio.sleep(60)
+        yield "never"
+
+    async def run():
+        async def consume():
+            return [item async for item in Router([backend]).stream("vision", open_stream, resilience.Policy())]
+        task = asyncio.ensure_future(consume())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert backend.in_flight == 0
+    assert backend.breaker.state == "half-open" and backend.breaker.allow()
@@ -0,0 +1,15 @@
+from stream_json import ReceiptItemStream
+
+DOCUMENT = '{"receipts": [{"Store": "A]", "items": [{"name": "MILK", "price": 3.49}, {"name": "EGGS", "price": 2.5}]}]}'
+
+
+def test_items_are_returned_as_they_close_across_chunks():
+    stream = ReceiptItemStream()
+    items = [item for start in range(0, len(DOCUMENT), 7) for item in stream.feed(DOCUMENT[start:start + 7])]
+    assert items == [{"name": "MILK", "price": 3.49}, {"name": "EGGS", "price": 2.5}]
+
+
+def test_unmatched_closers_are_ignored():
+    stream = ReceiptItemStream()
+    assert stream.feed("] } ") == []
+    assert stream.feed(DOCUMENT + "]}") == [{"name": "MILK", "price": 3.49}, {"name": "EGGS", "price": 2.5}]